@@ -28,3 +28,12 @@ try:
 except ImportError:
     def get_user_model():
         return get_model(*user_model_label.rsplit('.', 1))
+
+
+try:
+    from django.core.cache import caches
+except ImportError:  # django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
@@ -42,6 +42,17 @@ SESSION_KEY = getattr(settings, 'OAUTH_SESSION_KEY', 'oauth')
 
 SINGLE_ACCESS_TOKEN = getattr(settings, 'OAUTH_SINGLE_ACCESS_TOKEN', False)
 
+# Only store the digest of access tokens, refresh tokens and grant codes
+HASH_TOKENS = getattr(settings, 'OAUTH_HASH_TOKENS', False)
+
+# Store client secrets hashed with the password hashers
+HASH_CLIENT_SECRETS = getattr(settings, 'OAUTH_HASH_CLIENT_SECRETS', False)
+
+# Number of seconds and maximum number of successful verifications of hashed
+# client secrets remembered per process (0 disables the cache)
+CLIENT_SECRET_CACHE_TTL = getattr(settings, 'OAUTH_CLIENT_SECRET_CACHE_TTL', 300)
+CLIENT_SECRET_CACHE_SIZE = getattr(settings, 'OAUTH_CLIENT_SECRET_CACHE_SIZE', 1000)
+
 LOGO_FOLDER = getattr(settings, 'OAUTH2_LOGO_FOLDER', 'logos')
 
 IMAGE_STORAGE = getattr(settings, 'OAUTH2_IMAGE_STORAGE', None)
@@ -51,3 +62,129 @@ LIMIT_NUM_REFRESH_TOKEN = getattr(settings, 'OAUTH_LIMIT_NUM_REFRESH_TOKEN', 0)
 
 # Do not invalidate the refresh token when using the it to refresh access token
 KEEP_REFRESH_TOKEN = getattr(settings, 'OAUTH_KEEP_REFRESH_TOKEN', False)
+
+# Number of seconds concurrent refreshes with the same refresh token receive
+# the tokens issued to the first one (0 disables it, see provider.oauth2.refresh)
+REFRESH_GRACE_PERIOD = getattr(settings, 'OAUTH_REFRESH_GRACE_PERIOD', 0)
+
+# Alias of the cache shared by all processes to coalesce refreshes
+REFRESH_CACHE = getattr(settings, 'OAUTH_REFRESH_CACHE', 'default')
+
+# Number of resolved access tokens kept in the per-process token cache used by
+# the authentication middleware (0 disables the cache)
+TOKEN_CACHE_SIZE = getattr(settings, 'OAUTH_TOKEN_CACHE_SIZE', 0)
+
+# Maximum number of seconds a resolved access token is kept in the token cache
+TOKEN_CACHE_TTL = getattr(settings, 'OAUTH_TOKEN_CACHE_TTL', 60)
+
+# Alias of the Django cache (see settings.CACHES) shared by all processes to
+# store resolved access tokens (None disables the shared token cache)
+TOKEN_SHARED_CACHE = getattr(settings, 'OAUTH_TOKEN_SHARED_CACHE', None)
+
+# Maximum number of seconds a resolved access token is kept in the shared cache
+TOKEN_SHARED_CACHE_TTL = getattr(settings, 'OAUTH_TOKEN_SHARED_CACHE_TTL', 300)
+
+# Names of the user fields the authentication middleware loads along with the
+# access token (None loads all of them); other fields are loaded on access
+TOKEN_USER_FIELDS = getattr(settings, 'OAUTH_TOKEN_USER_FIELDS', None)
+
+# Only load the user from the database when an attribute other than its
+# primary key is accessed
+LAZY_USER = getattr(settings, 'OAUTH_LAZY_USER', False)
+
+# Number of seconds tokens found to be invalid are remembered by the token
+# caches (0 disables negative caching)
+NEGATIVE_TOKEN_CACHE_TTL = getattr(settings, 'OAUTH_NEGATIVE_TOKEN_CACHE_TTL', 0)
+
+# Number of invalid tokens remembered by the per-process negative token cache
+NEGATIVE_TOKEN_CACHE_SIZE = getattr(settings, 'OAUTH_NEGATIVE_TOKEN_CACHE_SIZE', 10000)
+
+# Number of live access tokens the per-process Bloom filter is sized for
+# (0 disables the filter)
+TOKEN_BLOOM_CAPACITY = getattr(settings, 'OAUTH_TOKEN_BLOOM_CAPACITY', 0)
+
+# False positive rate of the Bloom filter at full capacity
+TOKEN_BLOOM_ERROR_RATE = getattr(settings, 'OAUTH_TOKEN_BLOOM_ERROR_RATE', 0.001)
+
+# Alias of the cache journaling the access tokens issued since the Bloom
+# filter was built, shared by all processes
+TOKEN_BLOOM_CACHE = getattr(settings, 'OAUTH_TOKEN_BLOOM_CACHE', 'default')
+
+# Number of seconds after which the Bloom filter is rebuilt from live tokens
+TOKEN_BLOOM_REBUILD_INTERVAL = getattr(settings, 'OAUTH_TOKEN_BLOOM_REBUILD_INTERVAL', 3600)
+
+# Keep all clients in memory instead of querying them on every token request
+# (see provider.oauth2.registry)
+CLIENT_REGISTRY = getattr(settings, 'OAUTH_CLIENT_REGISTRY', False)
+
+# Alias of the cache holding the generation counter of the client registry
+CLIENT_REGISTRY_CACHE = getattr(settings, 'OAUTH_CLIENT_REGISTRY_CACHE', None)
+
+# Number of seconds between checks of the client registry for changes made by
+# other processes
+CLIENT_REGISTRY_CHECK_INTERVAL = getattr(settings, 'OAUTH_CLIENT_REGISTRY_CHECK_INTERVAL', 5)
+
+# Format of issued access tokens, "opaque", "signed" or "jwt" (see provider.oauth2.tokens)
+TOKEN_FORMAT = getattr(settings, 'OAUTH_TOKEN_FORMAT', 'opaque')
+
+# Per client overrides of TOKEN_FORMAT keyed by client_id
+CLIENT_TOKEN_FORMATS = getattr(settings, 'OAUTH_CLIENT_TOKEN_FORMATS', {})
+
+# Key used to sign access tokens
+TOKEN_SIGNING_KEY = getattr(settings, 'OAUTH_TOKEN_SIGNING_KEY', settings.SECRET_KEY)
+
+# Private keys used to sign "jwt" access tokens, a list of dicts with a "kid"
+# and a PEM encoded "key" (see provider.oauth2.jws)
+TOKEN_SIGNING_KEYS = getattr(settings, 'OAUTH_TOKEN_SIGNING_KEYS', [])
+
+# kid of the key new "jwt" access tokens are signed with, defaults to the first
+TOKEN_SIGNING_KID = getattr(settings, 'OAUTH_TOKEN_SIGNING_KID', None)
+
+# Number of seconds the public key set may be cached by resource servers
+JWKS_MAX_AGE = getattr(settings, 'OAUTH_JWKS_MAX_AGE', 86400)
+
+# Maximum number of tokens checked per introspection request
+INTROSPECTION_MAX_TOKENS = getattr(settings, 'OAUTH_INTROSPECTION_MAX_TOKENS', 100)
+
+# How revocation of signed access tokens is checked: "database", "cache" or
+# None to only verify signature and expiry
+SIGNED_TOKEN_REVOCATION = getattr(settings, 'OAUTH_SIGNED_TOKEN_REVOCATION', 'database')
+
+# Maximum number of password verifications run at once per process (0 for no
+# limit, see provider.oauth2.passwords)
+PASSWORD_POOL_SIZE = getattr(settings, 'OAUTH_PASSWORD_POOL_SIZE', 0)
+
+# Maximum number of password grant requests waiting for a verification slot
+PASSWORD_POOL_QUEUE = getattr(settings, 'OAUTH_PASSWORD_POOL_QUEUE', 10)
+
+# Number of seconds a password grant request waits for a verification slot
+PASSWORD_POOL_TIMEOUT = getattr(settings, 'OAUTH_PASSWORD_POOL_TIMEOUT', 5)
+
+# Token requests allowed per client and per user, keyed by Client.status
+# (see provider.oauth2.ratelimit)
+TOKEN_RATE_LIMITS = getattr(settings, 'OAUTH_TOKEN_RATE_LIMITS', {})
+
+# Alias of the Django cache (see settings.CACHES) shared by all processes to
+# count token requests
+TOKEN_RATE_LIMIT_CACHE = getattr(settings, 'OAUTH_TOKEN_RATE_LIMIT_CACHE', 'default')
+
+# Maximum number of access tokens issued by a single client_credentials_batch
+# request
+CLIENT_CREDENTIALS_BATCH_SIZE = getattr(settings, 'OAUTH_CLIENT_CREDENTIALS_BATCH_SIZE', 100)
+
+# Dotted path of the class generating tokens, codes and client credentials
+# (see provider.generators)
+TOKEN_GENERATOR = getattr(settings, 'OAUTH_TOKEN_GENERATOR', 'provider.generators.RandomTokenGenerator')
+
+# Characters generated tokens, codes and client credentials are made of
+TOKEN_ALPHABET = getattr(settings, 'OAUTH_TOKEN_ALPHABET', '0123456789abcdef')
+
+# Number of random characters of generated tokens, codes and client secrets
+TOKEN_LENGTH = getattr(settings, 'OAUTH_TOKEN_LENGTH', 40)
+
+# Number of random characters of generated client ids
+CLIENT_ID_LENGTH = getattr(settings, 'OAUTH_CLIENT_ID_LENGTH', 20)
+
+# Prefixes of generated values keyed by kind, "client_id", "client_secret",
+# "code", "access_token" or "refresh_token"
+TOKEN_PREFIXES = getattr(settings, 'OAUTH_TOKEN_PREFIXES', {})
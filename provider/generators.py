@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Generation of tokens, codes and client credentials.
+
+Tokens are drawn from the operating system's CSPRNG (:func:`os.urandom`).
+:class:`RandomTokenGenerator` reads random bytes in large chunks and maps
+them onto :attr:`provider.constants.TOKEN_ALPHABET` with a single
+``bytes.translate`` call per chunk, so generating a token is mostly slicing
+a buffer.
+
+The generator class is configured with
+:attr:`provider.constants.TOKEN_GENERATOR` and the size of what it generates
+with :attr:`provider.constants.TOKEN_LENGTH` and
+:attr:`provider.constants.CLIENT_ID_LENGTH`. Each kind of value can be
+prefixed, see :attr:`provider.constants.TOKEN_PREFIXES`, to tell them apart
+at a glance or in secret scanners.
+"""
+
+import os
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from . import constants
+
+
+class RandomTokenGenerator(object):
+    """
+    Generate random strings of characters from ``alphabet`` without bias.
+
+    Random bytes are mapped onto the alphabet by their value modulo its
+    size. Bytes above the largest multiple of the size are dropped so every
+    character is equally likely. The characters are buffered up to
+    ``buffer_size`` bytes of entropy at a time. The buffer is refilled after
+    a fork so processes never share random bytes.
+    """
+    #: Number of random bytes read from the operating system at once.
+    buffer_size = 4096
+
+    def __init__(self, alphabet):
+        size = len(alphabet)
+        if not 1 < size <= 128 or len(set(alphabet)) != size or \
+                any(ord(c) > 0x7f for c in alphabet):
+            raise ValueError("The alphabet must have between 2 and 128 "
+                "distinct ASCII characters.")
+        self.alphabet = alphabet
+        self._table = bytes(bytearray(ord(alphabet[i % size])
+            for i in range(256)))
+        self._deleted = bytes(bytearray(range(256 - 256 % size, 256)))
+        self._buffer = b''
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _fill(self, length):
+        chunks = [self._buffer]
+        available = len(self._buffer)
+        while available < length:
+            chunk = os.urandom(max(self.buffer_size, length)).translate(
+                self._table, self._deleted)
+            chunks.append(chunk)
+            available += len(chunk)
+        self._buffer = b''.join(chunks)
+
+    def generate(self, length):
+        """
+        Return a random string of ``length`` characters.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._buffer = b''
+                self._pid = os.getpid()
+            if len(self._buffer) < length:
+                self._fill(length)
+            value = self._buffer[:length]
+            self._buffer = self._buffer[length:]
+        return value.decode('ascii')
+
+
+_generators = {}
+
+# Characters separating the parts of signed access tokens, see
+# provider.oauth2.tokens.is_signed
+RESERVED_CHARACTERS = ':.'
+
+
+def check_characters(alphabet, prefixes):
+    """
+    Raise ``ImproperlyConfigured`` if generated values could be mistaken for
+    signed access tokens.
+    """
+    for name, value in [('OAUTH_TOKEN_ALPHABET', alphabet)] + [
+            ('OAUTH_TOKEN_PREFIXES[{!r}]'.format(kind), prefix)
+            for kind, prefix in sorted(prefixes.items())]:
+        if any(c in value for c in RESERVED_CHARACTERS):
+            raise ImproperlyConfigured('{} must not contain any of {!r}.'
+                .format(name, RESERVED_CHARACTERS))
+
+
+def get_generator():
+    """
+    Return the generator configured by
+    :attr:`provider.constants.TOKEN_GENERATOR` and
+    :attr:`provider.constants.TOKEN_ALPHABET`, created once per process.
+    """
+    key = (constants.TOKEN_GENERATOR, constants.TOKEN_ALPHABET,
+        tuple(sorted(constants.TOKEN_PREFIXES.items())))
+    generator = _generators.get(key)
+    if generator is None:
+        check_characters(constants.TOKEN_ALPHABET, constants.TOKEN_PREFIXES)
+        generator = import_string(key[0])(key[1])
+        generator = _generators.setdefault(key, generator)
+    return generator
+
+
+def generate(kind, length=None):
+    """
+    Return a new value of ``kind``, one of the keys of
+    :attr:`provider.constants.TOKEN_PREFIXES`, with its prefix.
+    """
+    if length is None:
+        length = constants.TOKEN_LENGTH
+    return constants.TOKEN_PREFIXES.get(kind, '') + \
+        get_generator().generate(length)
+
+
+def generate_client_id():
+    return generate('client_id', constants.CLIENT_ID_LENGTH)
+
+
+def generate_client_secret():
+    return generate('client_secret')
+
+
+def generate_code():
+    return generate('code')
+
+
+def generate_access_token():
+    return generate('access_token')
+
+
+def generate_refresh_token():
+    return generate('refresh_token')
@@ -4,3 +4,8 @@ class Oauth2(AppConfig):
     name = 'provider.oauth2'
     label = 'oauth2'
     verbose_name = "Provider Oauth2"
+
+    def ready(self):
+        # Connect the signal handlers keeping the token caches, the
+        # revocation list and the client registry consistent
+        from . import bloom, cache, registry, tokens
@@ -1,7 +1,42 @@
-from ..utils import now
+import base64
+import binascii
+
+from .. import constants
+from ..utils import hash_token, now, request_data
 from .forms import (ClientAuthForm, PublicClientAuthForm, PublicPasswordGrantForm)
+from . import tokens
+from .cache import resolve_token
 from .models import AccessToken
-import json
+from .registry import check_client_secret, client_registry
+
+# TODO this is a quick fix from rest_framework
+HTTP_HEADER_ENCODING = 'iso-8859-1'
+
+# Grant types public clients may authenticate for with their client id alone
+PUBLIC_GRANT_TYPES = ('password', 'refresh_token', 'authorization_code')
+
+
+def get_basic_credentials(request):
+    """
+    Return the ``(client_id, client_secret)`` pair of the HTTP Basic
+    authorization header of ``request`` or ``None`` if there is none or it is
+    malformed.
+    """
+    auth = request.META.get('HTTP_AUTHORIZATION')
+    if not auth:
+        return None
+
+    try:
+        scheme, credentials = auth.split(' ', 1)
+        if scheme.lower() != 'basic':
+            return None
+        credentials = base64.b64decode(credentials.strip().encode('ascii'))
+        client_id, client_secret = credentials.decode(
+            HTTP_HEADER_ENCODING).split(':', 1)
+    except (ValueError, TypeError, UnicodeError, binascii.Error):
+        # Auth header was malformed, unpacking went wrong
+        return None
+    return client_id, client_secret
 
 
 class BaseBackend(object):
@@ -28,21 +63,18 @@ class BasicClientBackend(object):
         if auth is None or auth == '':
             return None
 
-        try:
-            basic, base64 = auth.split(' ')
-            client_id, client_secret = base64.decode('base64').split(':')
-
-            form = ClientAuthForm({
-                'client_id': client_id,
-                'client_secret': client_secret})
-
-            if form.is_valid():
-                return form.cleaned_data.get('client')
+        credentials = get_basic_credentials(request)
+        if credentials is None:
             return None
 
-        except ValueError:
-            # Auth header was malformed, unpacking went wrong
-            return None
+        client_id, client_secret = credentials
+        form = ClientAuthForm({
+            'client_id': client_id,
+            'client_secret': client_secret})
+
+        if form.is_valid():
+            return form.cleaned_data.get('client')
+        return None
 
 
 class RequestParamsClientBackend(object):
@@ -83,31 +115,135 @@ class PublicClientBackend(object):
         return None
 
 class PublicPasswordJsonBackend(object):
+    """
+    Backend that tries to authenticate a public client using the password
+    grant with its client ID, posted form encoded or as a JSON object.
+    """
 
     def authenticate(self, request=None):
         if request is None:
             return None
-        try:
-            data = request.body
-            if type(data) is bytes:
-                data = data.decode("utf-8")
-            param = json.loads(data)
-        except ValueError:
-            return None
-        form = PublicPasswordGrantForm(param)
+        form = PublicPasswordGrantForm(request_data(request))
         if form.is_valid():
             return form.cleaned_data.get('client')
         return None
 
 
+class ClientBackend(object):
+    """
+    Backend that authenticates a client in a single pass over the request.
+
+    It picks the one method the request uses, in this order, and looks the
+    client up once:
+
+    * HTTP authorization headers as defined in :rfc:`2.3.1`.
+    * ``client_id`` and ``client_secret`` request parameters.
+    * A ``client_id`` request parameter alone, for public clients using one
+      of the :attr:`PUBLIC_GRANT_TYPES`.
+
+    Posted parameters may be form encoded or a JSON object, see
+    :func:`provider.utils.request_data`.
+
+    This replaces chaining :class:`BasicClientBackend`,
+    :class:`RequestParamsClientBackend`, :class:`PublicClientBackend` and
+    :class:`PublicPasswordJsonBackend`, which build a form per backend and
+    may each parse the request again.
+    """
+    #: Whether public clients may authenticate with their client id alone.
+    allow_public = True
+
+    def get_params(self, request):
+        """
+        Return the request parameters, posted ones taking precedence.
+        """
+        if request.method == 'POST':
+            data = request_data(request)
+            if data:
+                return data
+        return request.GET
+
+    def get_credentials(self, request):
+        """
+        Return ``(client_id, client_secret, grant_type)`` of the method the
+        request authenticates with. ``client_secret`` is ``None`` for public
+        clients; ``client_id`` is ``None`` if no method applies.
+        """
+        credentials = get_basic_credentials(request)
+        if credentials is not None:
+            return credentials[0], credentials[1], None
+
+        params = self.get_params(request)
+        if params.get('client_secret'):
+            return params.get('client_id'), params['client_secret'], None
+        if not self.allow_public:
+            return None, None, None
+        if params.get('client_id'):
+            return params['client_id'], None, params.get('grant_type')
+        return None, None, None
+
+    def authenticate(self, request=None):
+        if request is None:
+            return None
+
+        client_id, client_secret, grant_type = self.get_credentials(request)
+        if not client_id:
+            return None
+
+        client = client_registry.get(client_id)
+        if client is None:
+            return None
+
+        if client_secret is not None:
+            if check_client_secret(client, client_secret):
+                return client
+            return None
+
+        if client.client_type == constants.PUBLIC and \
+                grant_type in PUBLIC_GRANT_TYPES:
+            return client
+        return None
+
+
+class ConfidentialClientBackend(ClientBackend):
+    """
+    :class:`ClientBackend` accepting confidential clients only, which have
+    to present their secret.
+    """
+    allow_public = False
+
+
 class AccessTokenBackend(object):
     """
     Authenticate a user via access token and client object.
+
+    Returns the :class:`provider.oauth2.models.AccessToken` or, for tokens
+    served from a cache, its :class:`provider.oauth2.cache.TokenRecord`.
     """
 
     def authenticate(self, access_token=None, client=None):
-        try:
-            return AccessToken.objects.get(token=access_token,
-                expires__gt=now(), client=client)
-        except AccessToken.DoesNotExist:
+        if not access_token:
+            return None
+
+        def load_token(**lookup):
+            try:
+                return AccessToken.objects.with_user_is_active().get(
+                    expires__gt=now(), **lookup)
+            except AccessToken.DoesNotExist:
+                return None
+
+        def load_opaque_token():
+            token = load_token(token_hash=hash_token(access_token))
+            if token is not None:
+                # The plaintext may not be stored
+                token.token = access_token
+            return token
+
+        if tokens.is_signed(access_token):
+            token = tokens.resolve(access_token,
+                lambda pk: load_token(pk=pk))
+        else:
+            token = resolve_token(access_token, load_opaque_token)
+
+        if token is None or token.client_id != getattr(client, 'pk', None):
             return None
+        return token
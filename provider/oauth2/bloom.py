@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Bloom filter shielding the database from unknown access tokens.
+
+:attr:`token_filter` holds the digests of the live access tokens (see
+:func:`provider.utils.hash_token`). A token the filter has never seen is
+definitely unknown and can be rejected without querying
+:class:`provider.oauth2.models.AccessToken`.
+
+The filter is opt-in; it stays disabled until
+:attr:`provider.constants.TOKEN_BLOOM_CAPACITY` is set. Each process builds
+it from the database in a background thread and rebuilds it every
+:attr:`provider.constants.TOKEN_BLOOM_REBUILD_INTERVAL` seconds to forget
+expired tokens. Every process also journals the tokens it issues in the
+cache named by :attr:`provider.constants.TOKEN_BLOOM_CACHE` for twice that
+interval, so a token missing from the filter is only rejected if it isn't
+journaled either, which takes a cache round trip but no query.
+
+The filter never rejects a valid token: until the first build completes,
+once the last build is too old for the journal to cover the tokens issued
+since, or when the journal was lost (the cache was flushed or restarted),
+lookups fall through to the database. The journal must be shared by all
+processes and must not evict entries before they expire.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+from django.db import connections
+from django.db.models.signals import post_save
+
+from .. import constants
+from ..compat import get_cache
+from ..utils import now
+from .models import AccessToken
+from .signals import access_tokens_created
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """
+    Fixed size Bloom filter of strings sized for ``capacity`` items at a
+    false positive rate of ``error_rate``.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(
+            self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _indexes(self, value):
+        digest = hashlib.sha256(value.encode('utf-8')).digest()
+        # Double hashing, see Kirsch & Mitzenmacher
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, value):
+        for index in self._indexes(value):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[index >> 3] & (1 << (index & 7))
+                   for index in self._indexes(value))
+
+
+class TokenFilter(object):
+    """
+    :class:`BloomFilter` of live access tokens, complemented by a journal of
+    the tokens issued since it was built.
+    """
+    key_prefix = 'oauth2:bloom'
+
+    #: Whether the filter is rebuilt by a background thread, started once
+    #: per process. Otherwise the lookup finding it due rebuilds it.
+    background = True
+
+    def __init__(self):
+        # The filter, when its build started and the journal epoch then,
+        # swapped at once
+        self._state = (None, 0, None)
+        # Digests added while a new filter is being built, None otherwise
+        self._pending = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return constants.TOKEN_BLOOM_CAPACITY > 0
+
+    @property
+    def cache(self):
+        return get_cache(constants.TOKEN_BLOOM_CACHE)
+
+    @property
+    def journal_ttl(self):
+        return 2 * constants.TOKEN_BLOOM_REBUILD_INTERVAL
+
+    @property
+    def epoch_key(self):
+        return '{}:epoch'.format(self.key_prefix)
+
+    def make_key(self, digest):
+        return '{}:{}'.format(self.key_prefix, digest)
+
+    def _get_epoch(self):
+        """
+        Return the epoch of the journal, which changes whenever the cache
+        loses it.
+        """
+        cache = self.cache
+        epoch = int(time.time() * 1000)
+        if not cache.add(self.epoch_key, epoch, None):
+            epoch = cache.get(self.epoch_key, epoch)
+        return epoch
+
+    def rebuild(self):
+        """
+        Build a new filter without holding the lock and swap it in. Does
+        nothing if another thread is already building one.
+        """
+        with self._lock:
+            if self._pending is not None:
+                return
+            self._pending = []
+        try:
+            # Tokens committed after the query are journaled since then
+            built_at = time.time()
+            epoch = self._get_epoch()
+            bloom = BloomFilter(constants.TOKEN_BLOOM_CAPACITY,
+                constants.TOKEN_BLOOM_ERROR_RATE)
+            for digest in AccessToken.objects.filter(expires__gt=now(),
+                    token_hash__isnull=False).values_list(
+                    'token_hash', flat=True).iterator():
+                bloom.add(digest)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            for digest in self._pending:
+                bloom.add(digest)
+            self._pending = None
+            self._state = (bloom, built_at, epoch)
+
+    def _run(self):
+        while True:
+            try:
+                self.rebuild()
+            except Exception:
+                logger.exception('Building the access token filter failed.')
+            finally:
+                for connection in connections.all():
+                    connection.close()
+            time.sleep(constants.TOKEN_BLOOM_REBUILD_INTERVAL)
+
+    def _schedule(self):
+        if not self.background:
+            if time.time() - self._state[1] >= \
+                    constants.TOKEN_BLOOM_REBUILD_INTERVAL:
+                self.rebuild()
+            return
+
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Threads don't survive a fork, neither does a build in progress
+            self._pid = os.getpid()
+            self._pending = None
+            thread = threading.Thread(target=self._run,
+                name='oauth2-token-filter')
+            thread.daemon = True
+            thread.start()
+
+    def might_contain(self, digest):
+        """
+        Return ``False`` if ``digest`` is definitely not the digest of a live
+        access token.
+        """
+        if not self.enabled:
+            return True
+
+        self._schedule()
+        bloom, built_at, epoch = self._state
+        # Tokens issued that long after the build may have left the journal
+        if bloom is None or \
+                time.time() - built_at >= self.journal_ttl * 3 / 4:
+            return True
+        if digest in bloom:
+            return True
+
+        key = self.make_key(digest)
+        entries = self.cache.get_many([self.epoch_key, key])
+        if entries.get(self.epoch_key) != epoch:
+            return True
+        return key in entries
+
+    def add_many(self, digests):
+        """
+        Add the digests of newly issued tokens to the filter and the journal.
+        """
+        if not self.enabled or not digests:
+            return
+        self.cache.set_many(dict((self.make_key(digest), True)
+            for digest in digests), self.journal_ttl)
+        with self._lock:
+            bloom = self._state[0]
+            for digest in digests:
+                if bloom is not None:
+                    bloom.add(digest)
+                if self._pending is not None:
+                    self._pending.append(digest)
+
+    def clear(self):
+        with self._lock:
+            self._state = (None, 0, None)
+
+
+token_filter = TokenFilter()
+
+
+def add_access_token(sender, instance, created=False, **kwargs):
+    """
+    Signal handler adding new access tokens to the filter.
+    """
+    if created:
+        token_filter.add_many([instance.token_hash])
+
+
+def add_created_access_tokens(sender, tokens, **kwargs):
+    """
+    Signal handler adding access tokens created in bulk to the filter.
+    """
+    token_filter.add_many([token.token_hash for token in tokens])
+
+
+post_save.connect(add_access_token, sender=AccessToken,
+    dispatch_uid='provider.oauth2.bloom.add_access_token')
+access_tokens_created.connect(add_created_access_tokens, sender=AccessToken,
+    dispatch_uid='provider.oauth2.bloom.add_created_access_tokens')
@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+"""
+Caching of resolved access tokens.
+
+Resolving a bearer token costs an indexed lookup on
+:class:`provider.oauth2.models.AccessToken` for every API request. Two
+cache tiers keep the few fields needed to authenticate a request (see
+:class:`TokenRecord`) so repeated requests with the same token skip that
+lookup:
+
+* :class:`TokenCache` - a bounded per-process LRU, enabled by setting
+  :attr:`provider.constants.TOKEN_CACHE_SIZE`.
+* :class:`SharedTokenCache` - stored in one of the configured Django cache
+  backends and shared by all worker processes, enabled by setting
+  :attr:`provider.constants.TOKEN_SHARED_CACHE`.
+
+Tokens found to be invalid can be remembered for a short while too, see
+:class:`NegativeTokenCache`, and unknown tokens can be rejected up front by
+the Bloom filter in :attr:`provider.oauth2.bloom`.
+
+All tiers are keyed by the digest of the token (see
+:func:`provider.utils.hash_token`) so plaintext tokens are neither kept in
+memory nor sent to the cache server. All tiers are disabled by default.
+
+Entries never outlive the token they describe and are evicted whenever the
+token is saved (e.g. expired by
+:meth:`provider.oauth2.views.AccessTokenView.invalidate_access_token`) or
+deleted (e.g. by :func:`provider.oauth2.views.revoke_token`), and when their
+user is deactivated. Evictions of the shared tier are visible to all
+processes, the per-process tier of other processes catches up after at most
+:attr:`provider.constants.TOKEN_CACHE_TTL` seconds.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_init, post_save
+
+from .. import constants
+from ..compat import get_cache
+from ..utils import hash_token, now
+from .bloom import token_filter
+from .models import AccessToken
+from .signals import access_tokens_invalidated
+
+
+class TokenRecord(namedtuple('TokenRecord',
+        ('id', 'user_id', 'client_id', 'scope', 'expires', 'user_is_active'))):
+    """
+    Compact representation of an access token holding everything required
+    to authenticate a request.
+
+    ``user_is_active`` is the ``is_active`` flag of the token's user or
+    ``None`` if it is not known, e.g. for signed tokens. Tokens are looked
+    up annotated with it, see
+    :meth:`provider.oauth2.managers.AccessTokenQuerySet.with_user_is_active`.
+    """
+    __slots__ = ()
+
+    def __new__(cls, id, user_id, client_id, scope, expires,
+            user_is_active=None):
+        return super(TokenRecord, cls).__new__(cls, id, user_id, client_id,
+            scope, expires, user_is_active)
+
+    @classmethod
+    def from_token(cls, token):
+        return cls(token.id, token.user_id, token.client_id, token.scope,
+            token.expires, getattr(token, 'user_is_active', None))
+
+    def get_expire_delta(self, reference=None):
+        """
+        Return the number of seconds until the token expires.
+        """
+        if reference is None:
+            reference = now()
+        return (self.expires - reference).total_seconds()
+
+
+class TokenCache(object):
+    """
+    Thread safe LRU mapping of token digests to :class:`TokenRecord`
+    instances.
+
+    Each entry lives for at most :attr:`ttl` seconds and never past the
+    expiry of the token itself. When the cache holds more than
+    :attr:`max_size` entries the least recently used ones are evicted.
+
+    ``hits``, ``misses`` and ``evictions`` count cache activity since the
+    last call to :meth:`clear` and are meant to help sizing the cache.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self):
+        """
+        Defaults to :attr:`provider.constants.TOKEN_CACHE_SIZE`.
+        """
+        if self._max_size is None:
+            return constants.TOKEN_CACHE_SIZE
+        return self._max_size
+
+    @property
+    def ttl(self):
+        """
+        Defaults to :attr:`provider.constants.TOKEN_CACHE_TTL`.
+        """
+        if self._ttl is None:
+            return constants.TOKEN_CACHE_TTL
+        return self._ttl
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, digest):
+        """
+        Return the cached :class:`TokenRecord` for ``digest`` or ``None``.
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            record, deadline = entry
+            if deadline <= time.time():
+                del self._entries[digest]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return record
+
+    def set(self, digest, record):
+        """
+        Cache ``record`` for ``digest``. Records of tokens that already
+        expired are not cached.
+        """
+        if not self.enabled:
+            return
+
+        lifetime = self.get_lifetime(record)
+        if lifetime <= 0:
+            return
+
+        with self._lock:
+            self._entries[digest] = (record, time.time() + lifetime)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_lifetime(self, record):
+        return min(self.ttl, record.get_expire_delta())
+
+    def delete(self, digest):
+        with self._lock:
+            self._entries.pop(digest, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Return a ``dict`` with the current size and counters of the cache.
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class NegativeTokenCache(TokenCache):
+    """
+    :class:`TokenCache` of tokens known to be invalid, saving repeated
+    lookups of garbage or long expired tokens.
+
+    Enabled by setting :attr:`provider.constants.NEGATIVE_TOKEN_CACHE_TTL`.
+    """
+
+    @property
+    def max_size(self):
+        """
+        Defaults to :attr:`provider.constants.NEGATIVE_TOKEN_CACHE_SIZE`.
+        """
+        if self._max_size is None:
+            return constants.NEGATIVE_TOKEN_CACHE_SIZE
+        return self._max_size
+
+    @property
+    def ttl(self):
+        """
+        Defaults to :attr:`provider.constants.NEGATIVE_TOKEN_CACHE_TTL`.
+        """
+        if self._ttl is None:
+            return constants.NEGATIVE_TOKEN_CACHE_TTL
+        return self._ttl
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    def get_lifetime(self, record):
+        return self.ttl
+
+    def add(self, digest):
+        self.set(digest, True)
+
+    def __contains__(self, digest):
+        return self.get(digest) is not None
+
+
+class SharedTokenCache(object):
+    """
+    :class:`TokenRecord` storage in a Django cache backend shared by all
+    processes.
+
+    Every entry is stamped with the cache generation
+    it was written in; :meth:`invalidate_all` bumps the generation, which
+    invalidates all entries at once without scanning the cache. Reading an
+    entry and the current generation takes a single round trip.
+
+    Invalid tokens are remembered for
+    :attr:`provider.constants.NEGATIVE_TOKEN_CACHE_TTL` seconds.
+    """
+    key_prefix = 'oauth2:token'
+
+    def __init__(self, alias=None, ttl=None):
+        self._alias = alias
+        self._ttl = ttl
+
+    @property
+    def alias(self):
+        """
+        Defaults to :attr:`provider.constants.TOKEN_SHARED_CACHE`.
+        """
+        if self._alias is None:
+            return constants.TOKEN_SHARED_CACHE
+        return self._alias
+
+    @property
+    def ttl(self):
+        """
+        Defaults to :attr:`provider.constants.TOKEN_SHARED_CACHE_TTL`.
+        """
+        if self._ttl is None:
+            return constants.TOKEN_SHARED_CACHE_TTL
+        return self._ttl
+
+    @property
+    def enabled(self):
+        return bool(self.alias)
+
+    @property
+    def cache(self):
+        if not self.enabled:
+            return None
+        return get_cache(self.alias)
+
+    @property
+    def generation_key(self):
+        return '{}:generation'.format(self.key_prefix)
+
+    def make_key(self, digest):
+        return '{}:{}'.format(self.key_prefix, digest)
+
+    def _init_generation(self, cache):
+        # Seed a lost generation counter from the clock so it can't fall back
+        # to a generation that older entries were written in.
+        generation = int(time.time() * 1000)
+        if not cache.add(self.generation_key, generation, None):
+            generation = cache.get(self.generation_key, generation)
+        return generation
+
+    def get_or_load(self, digest, loader):
+        """
+        Return the :class:`TokenRecord` cached for ``digest``. On a miss,
+        ``loader`` is called and a non ``None`` result is cached.
+        """
+        def load(digests):
+            result = loader()
+            return {} if result is None else {digest: result}
+        return self.get_many_or_load([digest], load).get(digest)
+
+    def get_many_or_load(self, digests, loader):
+        """
+        Batch version of :meth:`get_or_load` reading all ``digests`` in a
+        single round trip. ``loader`` is called with the list of digests not
+        found in the cache and must return a ``dict`` of the valid ones.
+
+        Returns a ``dict`` mapping the valid digests to their
+        :class:`TokenRecord` or loader result.
+        """
+        cache = self.cache
+        if cache is None:
+            return loader(list(digests))
+
+        keys = OrderedDict((self.make_key(digest), digest)
+            for digest in digests)
+        values = cache.get_many([self.generation_key] + list(keys))
+        generation = values.get(self.generation_key)
+
+        results = {}
+        missing = []
+        for key, digest in keys.items():
+            entry = values.get(key)
+            if generation is not None and entry is not None \
+                    and entry[0] == generation:
+                # Invalid tokens are stored without a record
+                if len(entry) == 1:
+                    continue
+                record = TokenRecord(*entry[1:])
+                if record.get_expire_delta() > 0:
+                    results[digest] = record
+                    continue
+            missing.append(digest)
+
+        if not missing:
+            return results
+
+        if generation is None:
+            generation = self._init_generation(cache)
+
+        loaded = loader(missing)
+        entries = {}
+        invalid = {}
+        for digest in missing:
+            result = loaded.get(digest)
+            if result is None:
+                invalid[self.make_key(digest)] = (generation,)
+                continue
+            results[digest] = result
+            record = TokenRecord.from_token(result)
+            timeout = min(self.ttl, record.get_expire_delta())
+            if timeout > 0:
+                entries.setdefault(int(math.ceil(timeout)), {})[
+                    self.make_key(digest)] = (generation,) + tuple(record)
+
+        for timeout, data in entries.items():
+            cache.set_many(data, timeout)
+        if invalid and constants.NEGATIVE_TOKEN_CACHE_TTL > 0:
+            cache.set_many(invalid, constants.NEGATIVE_TOKEN_CACHE_TTL)
+        return results
+
+    def delete(self, digest):
+        cache = self.cache
+        if cache is not None:
+            cache.delete(self.make_key(digest))
+
+    def delete_many(self, digests):
+        cache = self.cache
+        if cache is not None and digests:
+            cache.delete_many([self.make_key(digest) for digest in digests])
+
+    def invalidate_all(self):
+        """
+        Invalidate every entry in all processes by bumping the generation.
+        """
+        cache = self.cache
+        if cache is None:
+            return
+        try:
+            cache.incr(self.generation_key)
+        except ValueError:
+            self._init_generation(cache)
+
+
+token_cache = TokenCache()
+
+negative_token_cache = NegativeTokenCache()
+
+shared_token_cache = SharedTokenCache()
+
+
+def resolve_token(token, loader):
+    """
+    Resolve ``token`` through the per-process and the shared token cache,
+    calling ``loader`` if neither holds it.
+
+    ``loader`` must return an object with the attributes of
+    :class:`TokenRecord`, usually an
+    :class:`provider.oauth2.models.AccessToken`, or ``None`` if the token is
+    not valid. The return value is either a :class:`TokenRecord` or whatever
+    ``loader`` returned.
+    """
+    digest = hash_token(token)
+    record = token_cache.get(digest)
+    if record is not None:
+        return record
+
+    if digest in negative_token_cache:
+        return None
+
+    if not token_filter.might_contain(digest):
+        return None
+
+    result = shared_token_cache.get_or_load(digest, loader)
+    if result is None:
+        negative_token_cache.add(digest)
+        return None
+
+    token_cache.set(digest, TokenRecord.from_token(result))
+    return result
+
+
+def resolve_tokens(tokens, loader):
+    """
+    Batch version of :func:`resolve_token`. ``loader`` is called once with
+    the list of tokens not found in any cache and must return a ``dict``
+    mapping the valid ones to their access token.
+
+    Returns a ``dict`` mapping the valid tokens to their :class:`TokenRecord`
+    or loader result.
+    """
+    digests = dict((hash_token(token), token) for token in tokens)
+    results = {}
+    missing = []
+    for digest, token in digests.items():
+        record = token_cache.get(digest)
+        if record is not None:
+            results[token] = record
+        elif digest in negative_token_cache:
+            continue
+        elif token_filter.might_contain(digest):
+            missing.append(digest)
+
+    if not missing:
+        return results
+
+    def load(missing):
+        loaded = loader([digests[digest] for digest in missing])
+        return dict((hash_token(token), result)
+            for token, result in loaded.items())
+
+    loaded = shared_token_cache.get_many_or_load(missing, load)
+    for digest in missing:
+        result = loaded.get(digest)
+        if result is None:
+            negative_token_cache.add(digest)
+            continue
+        token_cache.set(digest, TokenRecord.from_token(result))
+        results[digests[digest]] = result
+    return results
+
+
+def get_digest(instance):
+    """
+    Return the digest ``instance`` is cached by.
+    """
+    return instance.token_hash or hash_token(instance.token)
+
+
+def evict_access_token(sender, instance, **kwargs):
+    """
+    Signal handler dropping an access token from both caches whenever it is
+    changed or deleted.
+    """
+    if kwargs.get('created'):
+        return
+    digest = get_digest(instance)
+    token_cache.delete(digest)
+    shared_token_cache.delete(digest)
+
+
+def evict_deleted_access_token(sender, instance, **kwargs):
+    """
+    Signal handler dropping a deleted access token from both caches. Tokens
+    that expired on their own are never served from the caches, which saves
+    a round trip to the shared cache per row when purging them with
+    ``clean_tokens``.
+    """
+    digest = get_digest(instance)
+    token_cache.delete(digest)
+    if instance.expires > now():
+        shared_token_cache.delete(digest)
+
+
+def evict_invalidated_access_tokens(sender, tokens, **kwargs):
+    """
+    Signal handler dropping access tokens invalidated in bulk from both
+    caches.
+    """
+    reference = now()
+    for id, digest, expires in tokens:
+        token_cache.delete(digest)
+    shared_token_cache.delete_many([digest
+        for id, digest, expires in tokens if expires > reference])
+
+
+def track_user_is_active(sender, instance, **kwargs):
+    """
+    Signal handler remembering whether a loaded user is active, so that
+    :func:`evict_inactive_user_access_tokens` can tell deactivations apart.
+    """
+    instance._oauth2_was_active = getattr(instance, 'is_active', True)
+
+
+def evict_inactive_user_access_tokens(sender, instance, created=False,
+        update_fields=None, **kwargs):
+    """
+    Signal handler dropping the live access tokens of a deactivated user
+    from both caches. Only saves deactivating the user take a query, and
+    none at all while both caches are disabled.
+    """
+    if update_fields is not None and 'is_active' not in update_fields:
+        return
+    was_active = getattr(instance, '_oauth2_was_active', True)
+    is_active = getattr(instance, 'is_active', True)
+    instance._oauth2_was_active = is_active
+    if created or is_active or not was_active:
+        return
+    if not token_cache.enabled and not shared_token_cache.enabled:
+        return
+    digests = [token_hash or hash_token(token) for token_hash, token in
+        AccessToken.objects.filter(user=instance, expires__gt=now())
+            .values_list('token_hash', 'token')]
+    for digest in digests:
+        token_cache.delete(digest)
+    shared_token_cache.delete_many(digests)
+
+
+post_save.connect(evict_access_token, sender=AccessToken,
+    dispatch_uid='provider.oauth2.cache.evict_access_token')
+post_delete.connect(evict_deleted_access_token, sender=AccessToken,
+    dispatch_uid='provider.oauth2.cache.evict_deleted_access_token')
+access_tokens_invalidated.connect(evict_invalidated_access_tokens,
+    sender=AccessToken,
+    dispatch_uid='provider.oauth2.cache.evict_invalidated_access_tokens')
+post_init.connect(track_user_is_active,
+    sender=getattr(settings, 'AUTH_USER_MODEL', 'auth.User'),
+    dispatch_uid='provider.oauth2.cache.track_user_is_active')
+post_save.connect(evict_inactive_user_access_tokens,
+    sender=getattr(settings, 'AUTH_USER_MODEL', 'auth.User'),
+    dispatch_uid='provider.oauth2.cache.evict_inactive_user_access_tokens')
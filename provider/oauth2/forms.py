@@ -2,7 +2,6 @@
 
 
 from django import forms
-from django.contrib.auth import authenticate
 from django.utils.encoding import smart_text
 from django.utils.translation import ugettext as _
 
@@ -10,8 +9,10 @@ from .. import scope
 from ..constants import RESPONSE_TYPE_CHOICES, SCOPES
 from ..compat import get_user_model
 from ..forms import OAuthForm, OAuthValidationError
-from ..utils import now
+from ..utils import hash_token, now
 from .models import Client, Grant, RefreshToken
+from .passwords import password_pool
+from .registry import check_client_secret, client_registry
 
 
 class ClientForm(forms.ModelForm):
@@ -38,10 +39,9 @@ class ClientAuthForm(forms.Form):
 
     def clean(self):
         data = self.cleaned_data
-        try:
-            client = Client.objects.get(client_id=data.get('client_id'),
-                client_secret=data.get('client_secret'))
-        except Client.DoesNotExist:
+        client = client_registry.get(data.get('client_id'))
+        if client is None or not check_client_secret(client,
+                data.get('client_secret')):
             raise forms.ValidationError(_("Client could not be validated with "
                 "key pair."))
 
@@ -68,9 +68,8 @@ class PublicClientAuthForm(forms.Form):
     def clean(self):
         data = self.cleaned_data
 
-        try:
-            client = Client.objects.get(client_id=data.get('client_id'))
-        except Client.DoesNotExist:
+        client = client_registry.get(data.get('client_id'))
+        if client is None:
             raise forms.ValidationError(_('Client not found'))
 
         if client.client_type != 1:  # public
@@ -257,12 +256,15 @@ class RefreshTokenGrantForm(ScopeMixin, OAuthForm):
             raise OAuthValidationError({'error': 'invalid_request'})
 
         try:
-            token = RefreshToken.objects.get(token=token,
-                expired=False, client=self.client)
+            refresh_token = RefreshToken.objects.get(
+                token_hash=hash_token(token), expired=False,
+                client=self.client)
         except RefreshToken.DoesNotExist:
             raise OAuthValidationError({'error': 'invalid_grant'})
 
-        return token
+        # The plaintext may not be stored
+        refresh_token.token = token
+        return refresh_token
 
     def clean(self):
         """
@@ -299,7 +301,8 @@ class AuthorizationCodeGrantForm(ScopeMixin, OAuthForm):
 
         try:
             self.cleaned_data['grant'] = Grant.objects.get(
-                code=code, client=self.client, expires__gt=now())
+                code_hash=hash_token(code), client=self.client,
+                expires__gt=now())
         except Grant.DoesNotExist:
             raise OAuthValidationError({'error': 'invalid_grant'})
 
@@ -350,7 +353,7 @@ class PasswordGrantForm(ScopeMixin, OAuthForm):
     def clean(self):
         data = self.cleaned_data
 
-        user = authenticate(username=data.get('username'),
+        user = password_pool.authenticate(username=data.get('username'),
             password=data.get('password'))
 
         if user is None:
@@ -396,7 +399,7 @@ class EmailAndPasswordGrantForm(ScopeMixin, OAuthForm):
     def clean(self):
         data = self.cleaned_data
 
-        user = authenticate(username=data.get('username'),
+        user = password_pool.authenticate(username=data.get('username'),
             password=data.get('password'))
 
         if user is None:
@@ -421,9 +424,8 @@ class PublicPasswordGrantForm(PasswordGrantForm):
     def clean(self):
         data = super(PublicPasswordGrantForm, self).clean()
 
-        try:
-            client = Client.objects.get(client_id=data.get('client_id'))
-        except Client.DoesNotExist:
+        client = client_registry.get(data.get('client_id'))
+        if client is None:
             raise OAuthValidationError({'error': 'invalid_client'})
 
         if client.client_type != 1: # public
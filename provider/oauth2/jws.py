@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Asymmetrically signed JSON Web Tokens (:rfc:`7515`, :rfc:`7519`).
+
+Access tokens in the ``"jwt"`` format (see :attr:`provider.oauth2.tokens`)
+are signed with a private key from
+:attr:`provider.constants.TOKEN_SIGNING_KEYS`. The matching public keys are
+published as a JSON Web Key Set by :func:`provider.oauth2.views.jwks`, so
+resource servers can verify tokens without calling back into the provider.
+
+RSA keys sign with ``RS256``, P-256 elliptic curve keys with ``ES256``. Each
+token names the key it was signed with in its ``kid`` header. To rotate
+keys, add the new key to :attr:`provider.constants.TOKEN_SIGNING_KEYS`, wait
+for :attr:`provider.constants.JWKS_MAX_AGE` seconds so resource servers pick
+it up, point :attr:`provider.constants.TOKEN_SIGNING_KID` at it and remove
+the old key once the last token signed with it expired.
+
+Requires the `cryptography <https://cryptography.io>`_ package.
+"""
+
+import base64
+import json
+import threading
+from collections import OrderedDict
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signing import BadSignature
+
+from .. import constants
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+    from cryptography.hazmat.primitives.asymmetric.utils import (
+        decode_dss_signature, encode_dss_signature)
+except ImportError:  # pragma: no cover
+    default_backend = None
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def b64decode(data):
+    data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def int_to_b64(value, length=None):
+    if length is None:
+        length = (value.bit_length() + 7) // 8
+    return b64encode(value.to_bytes(length, 'big'))
+
+
+class SigningKey(object):
+    """
+    Private key from :attr:`provider.constants.TOKEN_SIGNING_KEYS`
+    identified by ``kid``.
+    """
+
+    def __init__(self, kid, pem):
+        if default_backend is None:
+            raise ImproperlyConfigured('Signing access tokens with '
+                'OAUTH_TOKEN_SIGNING_KEYS requires the cryptography package.')
+        if isinstance(pem, type('')):
+            pem = pem.encode('ascii')
+
+        self.kid = kid
+        self.key = serialization.load_pem_private_key(pem, password=None,
+            backend=default_backend())
+
+        if isinstance(self.key, rsa.RSAPrivateKey):
+            self.alg = 'RS256'
+        elif isinstance(self.key, ec.EllipticCurvePrivateKey) and \
+                isinstance(self.key.curve, ec.SECP256R1):
+            self.alg = 'ES256'
+        else:
+            raise ImproperlyConfigured('Signing key "{}" must be an RSA or a '
+                'P-256 elliptic curve key.'.format(kid))
+
+    def sign(self, data):
+        if self.alg == 'RS256':
+            return self.key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+        # JWS uses the raw concatenation of r and s instead of DER
+        r, s = decode_dss_signature(
+            self.key.sign(data, ec.ECDSA(hashes.SHA256())))
+        return r.to_bytes(32, 'big') + s.to_bytes(32, 'big')
+
+    def verify(self, data, signature):
+        public_key = self.key.public_key()
+        try:
+            if self.alg == 'RS256':
+                public_key.verify(signature, data, padding.PKCS1v15(),
+                    hashes.SHA256())
+            else:
+                if len(signature) != 64:
+                    return False
+                public_key.verify(encode_dss_signature(
+                    int.from_bytes(signature[:32], 'big'),
+                    int.from_bytes(signature[32:], 'big')),
+                    data, ec.ECDSA(hashes.SHA256()))
+        except InvalidSignature:
+            return False
+        return True
+
+    def to_jwk(self):
+        """
+        Return the public key as a JSON Web Key (:rfc:`7517`).
+        """
+        numbers = self.key.public_key().public_numbers()
+        if self.alg == 'RS256':
+            jwk = {'kty': 'RSA', 'n': int_to_b64(numbers.n),
+                'e': int_to_b64(numbers.e)}
+        else:
+            jwk = {'kty': 'EC', 'crv': 'P-256', 'x': int_to_b64(numbers.x, 32),
+                'y': int_to_b64(numbers.y, 32)}
+        jwk.update({'kid': self.kid, 'alg': self.alg, 'use': 'sig'})
+        return jwk
+
+
+_keys = {}
+_keys_lock = threading.Lock()
+
+
+def get_keys():
+    """
+    Return an ``OrderedDict`` of the configured :class:`SigningKey` instances
+    keyed by ``kid``. Parsed keys are kept for the lifetime of the process.
+    """
+    config = tuple((key['kid'], key['key'])
+        for key in constants.TOKEN_SIGNING_KEYS)
+    with _keys_lock:
+        keys = _keys.get(config)
+        if keys is None:
+            keys = OrderedDict((kid, SigningKey(kid, pem))
+                for kid, pem in config)
+            _keys.clear()
+            _keys[config] = keys
+    return keys
+
+
+def get_signing_key():
+    """
+    Return the :class:`SigningKey` new tokens are signed with.
+    """
+    keys = get_keys()
+    if not keys:
+        raise ImproperlyConfigured('Issuing "jwt" access tokens requires '
+            'OAUTH_TOKEN_SIGNING_KEYS.')
+    kid = constants.TOKEN_SIGNING_KID
+    if kid is None:
+        return next(iter(keys.values()))
+    try:
+        return keys[kid]
+    except KeyError:
+        raise ImproperlyConfigured('OAUTH_TOKEN_SIGNING_KID "{}" is not in '
+            'OAUTH_TOKEN_SIGNING_KEYS.'.format(kid))
+
+
+def dumps(claims):
+    """
+    Return ``claims`` as a compact JWS signed with :func:`get_signing_key`.
+    """
+    key = get_signing_key()
+    header = {'typ': 'JWT', 'alg': key.alg, 'kid': key.kid}
+    signing_input = '.'.join(
+        b64encode(json.dumps(part, separators=(',', ':')).encode('utf-8'))
+        for part in (header, claims))
+    return '{}.{}'.format(signing_input,
+        b64encode(key.sign(signing_input.encode('ascii'))))
+
+
+def loads(value):
+    """
+    Return the claims of the compact JWS ``value``. Raises
+    :class:`django.core.signing.BadSignature` if it wasn't signed by one of
+    the configured keys. Expiry is not checked.
+    """
+    try:
+        header, claims, signature = value.split('.')
+        signing_input = '{}.{}'.format(header, claims).encode('ascii')
+        header = json.loads(b64decode(header).decode('utf-8'))
+        key = get_keys().get(header.get('kid'))
+        if key is None or header.get('alg') != key.alg or \
+                not key.verify(signing_input, b64decode(signature)):
+            raise BadSignature('Invalid token signature')
+        return json.loads(b64decode(claims).decode('utf-8'))
+    except (TypeError, ValueError, AttributeError):
+        raise BadSignature('Malformed token')
+
+
+def jwks():
+    """
+    Return the JSON Web Key Set of all configured keys.
+    """
+    return {'keys': [key.to_jwk() for key in get_keys().values()]}
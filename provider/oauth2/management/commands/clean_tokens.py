@@ -4,6 +4,7 @@
 from django.core.management.base import BaseCommand
 from django.utils.timezone import now
 
+from ...cache import shared_token_cache
 from ...models import AccessToken, Grant, RefreshToken
 
 
@@ -14,6 +15,8 @@ class Command(BaseCommand):
         self._do_clean('refresh tokens', RefreshToken.objects.filter(expired=True))
         self._do_clean('grants', Grant.objects.filter(expires__lt=now()))
         self._do_clean('access tokens', AccessToken.objects.filter(expires__lt=now()))
+        # Drop every token cached by the workers in one go
+        shared_token_cache.invalidate_all()
 
     def _do_clean(self, name, queryset):
         self.stdout.write("Finding expired {}...".format(name), ending='')
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+
+from django.core.management.base import BaseCommand
+
+from ....utils import hash_secret, is_hashed_secret
+from ...models import Client
+from ...registry import client_registry
+
+
+class Command(BaseCommand):
+    help = 'Hashes client secrets that are still stored in plaintext'
+
+    def handle(self, *args, **options):
+        count = 0
+        for pk, client_secret in Client.objects.values_list(
+                'pk', 'client_secret').iterator():
+            if is_hashed_secret(client_secret):
+                continue
+            # Update the column alone, only matching unchanged secrets
+            count += Client.objects.filter(pk=pk,
+                client_secret=client_secret).update(
+                client_secret=hash_secret(client_secret))
+        # Updates skip the signals reloading the registry
+        client_registry.invalidate()
+        self.stdout.write("Hashed {:d} client secrets".format(count))
@@ -1,11 +1,198 @@
 # -*- coding: utf-8 -*-
 
 
-from django.db import models
+from datetime import timedelta
 
-from ..utils import now
+from django.db import IntegrityError, models, transaction
 
+from .. import constants
+from ..utils import hash_token, now
+from .signals import access_tokens_created, access_tokens_invalidated
+
+
+def get_single_key(user, client, scope):
+    """
+    Return the value identifying the live access token of ``user``,
+    ``client`` and ``scope`` in
+    :attr:`provider.constants.SINGLE_ACCESS_TOKEN` mode.
+    """
+    return hash_token('{}:{}:{}'.format(getattr(user, 'pk', ''), client.pk,
+        scope))
+
+
+def get_expired():
+    """
+    Return the expiry set on invalidated tokens and grants.
+    """
+    return now() - timedelta(days=1)
+
+
+class GrantQuerySet(models.QuerySet):
+    def invalidate(self):
+        """
+        Expire the grants with a single ``UPDATE`` or, with
+        :attr:`provider.constants.DELETE_EXPIRED`, delete them with a single
+        ``DELETE``.
+        """
+        if constants.DELETE_EXPIRED:
+            self.delete()
+        else:
+            self.update(expires=get_expired(), modified=now())
+
+
+class RefreshTokenQuerySet(models.QuerySet):
+    def invalidate(self):
+        """
+        Expire the refresh tokens with a single ``UPDATE`` or, with
+        :attr:`provider.constants.DELETE_EXPIRED`, delete them with a single
+        ``DELETE``.
+        """
+        if constants.DELETE_EXPIRED:
+            self.delete()
+        else:
+            self.update(expired=True, modified=now())
+
+    def invalidate_over_limit(self, limit):
+        """
+        Invalidate all but the ``limit`` newest refresh tokens. One query
+        finds the newest token to invalidate, one statement invalidates it
+        and all older ones, however many there are.
+        """
+        cutoff = list(self.order_by('-pk').values_list('pk',
+            flat=True)[limit:limit + 1])
+        if cutoff:
+            self.filter(pk__lte=cutoff[0]).invalidate()
+
+
+class AccessTokenQuerySet(models.QuerySet):
+    def with_user_is_active(self):
+        """
+        Annotate the access tokens with the ``is_active`` flag of their user
+        as ``user_is_active``, which the token caches keep.
+        """
+        return self.annotate(user_is_active=models.F('user__is_active'))
+
+    def invalidate(self):
+        """
+        Expire the access tokens and release their ``single_key`` with a
+        single ``UPDATE`` or, with :attr:`provider.constants.DELETE_EXPIRED`,
+        delete them and their refresh tokens.
+
+        The ``UPDATE`` doesn't send ``post_save``, so the tokens are listed
+        first and :attr:`provider.oauth2.signals.access_tokens_invalidated`
+        is sent for them to drop them from the caches. Deleting sends
+        ``post_delete``, which does the same; the refresh tokens have nothing
+        to cascade to and go with a single ``DELETE``.
+        """
+        if constants.DELETE_EXPIRED:
+            self.delete()
+            return
+
+        tokens = [(id, token_hash or hash_token(token), expires)
+            for id, token_hash, token, expires in self.values_list(
+                'id', 'token_hash', 'token', 'expires')]
+        if not tokens:
+            return
+
+        self.update(expires=get_expired(), single_key=None, modified=now())
+        access_tokens_invalidated.send(sender=self.model, tokens=tokens)
+
+
+class AccessTokenManager(models.Manager.from_queryset(AccessTokenQuerySet)):
+    #: Number of times :meth:`get_or_create_single` retries losing an insert
+    #: race before giving up.
+    single_attempts = 3
 
-class AccessTokenManager(models.Manager):
     def get_token(self, token):
-        return self.get(token=token, expires__gt=now())
+        access_token = self.get(token_hash=hash_token(token), expires__gt=now())
+        # The plaintext may not be stored
+        access_token.token = token
+        return access_token
+
+    def get_tokens(self, tokens):
+        """
+        Return a ``dict`` mapping the valid ones of ``tokens`` to their access
+        token, fetched with a single query. Tokens of inactive users aren't
+        valid.
+        """
+        hashes = dict((hash_token(token), token) for token in tokens)
+        access_tokens = {}
+        for access_token in self.with_user_is_active().filter(
+                models.Q(user__isnull=True) | models.Q(user__is_active=True),
+                token_hash__in=list(hashes), expires__gt=now()):
+            access_token.token = hashes[access_token.token_hash]
+            access_tokens[access_token.token] = access_token
+        return access_tokens
+
+    def create_many(self, tokens):
+        """
+        Insert the unsaved access ``tokens`` with a single ``INSERT`` and
+        return them.
+
+        Backends that don't return primary keys from a bulk insert take one
+        more query to fetch them. ``post_save`` isn't sent, so
+        :attr:`provider.oauth2.signals.access_tokens_created` is sent
+        instead.
+        """
+        for token in tokens:
+            if not token.expires:
+                token.expires = token.client.get_default_token_expiry()
+            token.token_hash = hash_token(token.token)
+        self.bulk_create(tokens)
+
+        missing = [token for token in tokens if token.pk is None]
+        if missing:
+            pks = dict(self.filter(token_hash__in=[token.token_hash
+                for token in missing]).values_list('token_hash', 'pk'))
+            for token in missing:
+                token.pk = pks[token.token_hash]
+
+        access_tokens_created.send(sender=self.model, tokens=tokens)
+        return tokens
+
+    def get_or_create_single(self, user, client, scope, replace=False,
+            since=None):
+        """
+        Return ``(access_token, created)`` for the single live access token
+        of ``user``, ``client`` and ``scope``.
+
+        The token holds the unique ``single_key`` column, so concurrent
+        requests can't both insert one. Fetching a live token takes a single
+        query, which also fetches its refresh token. An expired token
+        releases the key to a new one. With ``replace``, so does a live one
+        issued before ``since``, the time the request began, because tokens
+        whose plaintext isn't stored can't be handed out again. A live token
+        issued since then was just handed out by a concurrent request and is
+        returned instead. Nothing is deleted.
+        """
+        if since is None:
+            since = now()
+        key = get_single_key(user, client, scope)
+        for attempt in range(self.single_attempts):
+            try:
+                access_token = self.select_related('refresh_token').get(
+                    single_key=key)
+            except self.model.DoesNotExist:
+                pass
+            else:
+                live = access_token.expires > now()
+                if live and (not replace or access_token.created >= since):
+                    # The key matched, so these are the token's own. Caching
+                    # them spares the token response fetching them again
+                    access_token.client = client
+                    access_token.user = user
+                    return access_token, False
+                if live:
+                    access_token.expires = get_expired()
+                access_token.single_key = None
+                access_token.save(update_fields=['expires', 'single_key',
+                    'modified'])
+
+            try:
+                with transaction.atomic():
+                    return self.create(user=user, client=client, scope=scope,
+                        single_key=key), True
+            except IntegrityError:
+                # Another request inserted the token first
+                if attempt == self.single_attempts - 1:
+                    raise
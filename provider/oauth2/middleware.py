@@ -7,15 +7,70 @@ from django.http.response import HttpResponse
 from django.utils.functional import SimpleLazyObject
 from django.utils.timezone import now
 
+from provider.utils import hash_token
+
+from provider import constants
+from provider.oauth2 import tokens
+from provider.oauth2.cache import TokenRecord, resolve_token
 from provider.oauth2.models import AccessToken
 
 __author__ = 'amaru'
 
+# Access token columns needed to authenticate a request, everything else is
+# loaded lazily on access
+TOKEN_FIELDS = ('id', 'token', 'token_hash', 'user', 'client', 'scope',
+    'expires')
+
+
 class HttpResponseUnauthorized(HttpResponse):
     status_code = 401
 
 
-def _get_user(request):
+def _user_fields():
+    """
+    Return the user fields to load or ``None`` to load all of them.
+    """
+    if constants.TOKEN_USER_FIELDS is None:
+        return None
+    return tuple(set(constants.TOKEN_USER_FIELDS) | set(['is_active']))
+
+
+def _load_token(**lookup):
+    """
+    Fetch a valid access token of an active user together with that user in
+    a single query. The user is left out when it is loaded lazily.
+    """
+    queryset = AccessToken.objects.only(*TOKEN_FIELDS)
+    if not constants.LAZY_USER:
+        fields = TOKEN_FIELDS
+        if _user_fields() is not None:
+            fields += tuple('user__' + f for f in _user_fields())
+        queryset = AccessToken.objects.select_related('user').only(*fields)
+    queryset = queryset.with_user_is_active()
+    try:
+        return queryset.get(expires__gt=now(), user__is_active=True, **lookup)
+    except AccessToken.DoesNotExist:
+        return None
+
+
+def _user_queryset():
+    queryset = get_user_model().objects.all()
+    if _user_fields() is not None:
+        queryset = queryset.only(*_user_fields())
+    return queryset
+
+
+def _load_user(user_id):
+    try:
+        return _user_queryset().get(pk=user_id)
+    except get_user_model().DoesNotExist:
+        return None
+
+
+def _get_token_value(request):
+    """
+    Return the access token presented with ``request`` or ``None``.
+    """
     oauth_token = None
     try:
         auth_header = request.META['HTTP_AUTHORIZATION']
@@ -23,7 +78,7 @@ def _get_user(request):
             try:
                 oauth_token = auth_header.split(' ')[1]
             except IndexError:
-                return AnonymousUser()
+                return None
     except KeyError:
         pass
 
@@ -45,19 +100,91 @@ def _get_user(request):
         except KeyError:
             pass
 
-    if not oauth_token:
-        return AnonymousUser()
+    return oauth_token or None
 
-    try:
-        token = AccessToken.objects.get(token=oauth_token, expires__gt=now(), user__is_active=True)
-    except AccessToken.DoesNotExist:
+
+def _check_token(token):
+    """
+    Return ``token`` if its user is active, ``None`` otherwise. The user is
+    queried for tokens that don't tell, such as signed ones.
+    """
+    if token is None or token.user_id is None:
+        return None
+    is_active = token.user_is_active
+    if is_active is None:
+        is_active = get_user_model().objects.filter(pk=token.user_id,
+            is_active=True).exists()
+    return token if is_active else None
+
+
+def _resolve(oauth_token):
+    if tokens.is_signed(oauth_token):
+        token = tokens.resolve(oauth_token, lambda pk: _load_token(pk=pk))
+    else:
+        token = resolve_token(oauth_token,
+            lambda: _load_token(token_hash=hash_token(oauth_token)))
+    return _check_token(token)
+
+
+def _check_user(user):
+    if user is None or not user.is_active:
         return AnonymousUser()
+    return user
 
-    try:
-        return get_user_model().objects.get(pk=token.user_id)
-    except get_user_model().DoesNotExist:
+
+class TokenUser(SimpleLazyObject):
+    """
+    User authenticated by an access token of an active user. ``pk`` is taken
+    from the token, the user is only loaded when any other attribute is
+    accessed.
+    """
+
+    def __init__(self, user_id):
+        super(TokenUser, self).__init__(
+            lambda: _check_user(_load_user(user_id)))
+        self.__dict__['pk'] = user_id
+        self.__dict__[get_user_model()._meta.pk.attname] = user_id
+
+    def _setup(self):
+        super(TokenUser, self)._setup()
+        # Users that turned out inactive or missing lose their primary key
+        if isinstance(self._wrapped, AnonymousUser):
+            self.__dict__.pop('pk', None)
+            self.__dict__.pop(get_user_model()._meta.pk.attname, None)
+
+
+def get_token(request):
+    """
+    Return the valid access token presented with ``request`` as an
+    :class:`provider.oauth2.models.AccessToken` or
+    :class:`provider.oauth2.cache.TokenRecord`, or ``None``.
+    """
+    if not hasattr(request, '_cached_oauth_token'):
+        oauth_token = _get_token_value(request)
+        request._cached_oauth_token = None if oauth_token is None else \
+            _resolve(oauth_token)
+    return request._cached_oauth_token
+
+
+def _get_token_record(request):
+    token = get_token(request)
+    if token is None:
+        return None
+    return TokenRecord.from_token(token)
+
+
+def _get_user(request):
+    token = get_token(request)
+    if token is None or token.user_id is None:
         return AnonymousUser()
 
+    if constants.LAZY_USER:
+        return TokenUser(token.user_id)
+    # Freshly loaded tokens come with their user
+    if isinstance(token, AccessToken):
+        return _check_user(token.user)
+    return _check_user(_load_user(token.user_id))
+
 
 def get_user(request):
     if not hasattr(request, '_cached_user'):
@@ -77,8 +204,16 @@ class AuthenticationMiddleware(object):
     5. Cookie: at=<OAUTH-TOKEN>
 
     If a path requires an authenticated user, and none is presented, the method would return 401 access denied.
+
+    Besides ``request.user`` the middleware sets ``request.oauth_token``, the
+    :class:`provider.oauth2.cache.TokenRecord` of the presented token. Both
+    are resolved lazily; ``request.oauth_token`` evaluates as false if no
+    valid token was presented. With :attr:`provider.constants.LAZY_USER`,
+    ``request.user`` is a :class:`TokenUser`.
     """
 
     def process_request(self, request):
         request.user = SimpleLazyObject(lambda: get_user(request))
+        request.oauth_token = SimpleLazyObject(
+            lambda: _get_token_record(request))
         return None
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+import provider.utils
+import provider.oauth2.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesstoken',
+            name='token_hash',
+            field=models.CharField(max_length=64, unique=True, null=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='grant',
+            name='code_hash',
+            field=models.CharField(max_length=64, unique=True, null=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='refreshtoken',
+            name='token_hash',
+            field=models.CharField(max_length=64, unique=True, null=True, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='accesstoken',
+            name='token',
+            field=provider.oauth2.models.SecretField(default=provider.utils.long_token, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='grant',
+            name='code',
+            field=provider.oauth2.models.SecretField(default=provider.utils.long_token, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='refreshtoken',
+            name='token',
+            field=provider.oauth2.models.SecretField(default=provider.utils.long_token, max_length=255),
+        ),
+    ]
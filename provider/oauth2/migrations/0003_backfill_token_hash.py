@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+
+import hashlib
+
+from django.db import migrations, transaction
+
+# Rows hashed per transaction, keeping locks short on large tables
+CHUNK_SIZE = 1000
+
+SECRETS = (
+    ('Grant', 'code'),
+    ('AccessToken', 'token'),
+    ('RefreshToken', 'token'),
+)
+
+
+def backfill_hashes(apps, schema_editor):
+    db = schema_editor.connection.alias
+    for model_name, field in SECRETS:
+        model = apps.get_model('oauth2', model_name)
+        hash_field = '{}_hash'.format(field)
+        queryset = model.objects.using(db).filter(
+            **{hash_field + '__isnull': True}).exclude(**{field: ''})
+
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk).order_by('pk')
+                .values_list('pk', field)[:CHUNK_SIZE])
+            if not rows:
+                break
+            with transaction.atomic(using=db):
+                for pk, value in rows:
+                    model.objects.using(db).filter(pk=pk).update(**{
+                        hash_field: hashlib.sha256(
+                            value.encode('utf-8')).hexdigest()})
+            last_pk = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0002_token_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_hashes, migrations.RunPython.noop,
+            atomic=False),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0003_backfill_token_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesstoken',
+            name='single_key',
+            field=models.CharField(max_length=64, unique=True, null=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+import provider.generators
+import provider.oauth2.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0004_accesstoken_single_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='client',
+            name='client_id',
+            field=models.CharField(default=provider.generators.generate_client_id, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='client',
+            name='client_secret',
+            field=models.CharField(default=provider.generators.generate_client_secret, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='grant',
+            name='code',
+            field=provider.oauth2.models.SecretField(default=provider.generators.generate_code, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='accesstoken',
+            name='token',
+            field=provider.oauth2.models.SecretField(default=provider.generators.generate_access_token, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='refreshtoken',
+            name='token',
+            field=provider.oauth2.models.SecretField(default=provider.generators.generate_refresh_token, max_length=255),
+        ),
+    ]
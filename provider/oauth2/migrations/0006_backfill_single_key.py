@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+
+import hashlib
+from datetime import timedelta
+
+from django.db import migrations, transaction
+
+from provider import constants
+from provider.utils import now
+
+# Rows keyed per transaction, keeping locks short on large tables
+CHUNK_SIZE = 1000
+
+
+def get_single_key(user_id, client_id, scope):
+    # Same as provider.oauth2.managers.get_single_key
+    value = '{}:{}:{}'.format('' if user_id is None else user_id, client_id,
+        scope)
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def backfill_single_keys(apps, schema_editor):
+    """
+    Key the live access tokens issued in SINGLE_ACCESS_TOKEN mode before the
+    single_key column existed. Of several live tokens of a user, client and
+    scope the latest one keeps being handed out and the others are expired.
+    """
+    if not constants.SINGLE_ACCESS_TOKEN:
+        return
+
+    db = schema_editor.connection.alias
+    model = apps.get_model('oauth2', 'AccessToken')
+    started = now()
+    live = model.objects.using(db).filter(expires__gt=started)
+    keys = set(live.exclude(single_key=None).values_list('single_key',
+        flat=True))
+    queryset = live.filter(single_key=None)
+
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('-pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__lt=last_pk)
+        rows = list(chunk.values_list('pk', 'user_id', 'client_id',
+            'scope')[:CHUNK_SIZE])
+        if not rows:
+            break
+        duplicates = []
+        with transaction.atomic(using=db):
+            for pk, user_id, client_id, scope in rows:
+                key = get_single_key(user_id, client_id, scope)
+                if key in keys:
+                    duplicates.append(pk)
+                    continue
+                keys.add(key)
+                model.objects.using(db).filter(pk=pk).update(single_key=key)
+            model.objects.using(db).filter(pk__in=duplicates).update(
+                expires=started - timedelta(days=1), modified=started)
+        last_pk = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0005_token_generators'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_single_keys, migrations.RunPython.noop,
+            atomic=False),
+    ]
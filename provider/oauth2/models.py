@@ -17,10 +17,14 @@ from django.utils.translation import ugettext_lazy as _
 
 from .. import constants, scope
 from ..validators import validate_uris
+from ..generators import (
+    generate_access_token, generate_client_id, generate_client_secret,
+    generate_code, generate_refresh_token)
 from ..utils import (
-    now, short_token, long_token, get_code_expiry, get_token_expiry,
-    serialize_instance, deserialize_instance)
-from .managers import AccessTokenManager
+    now, get_code_expiry, get_token_expiry,
+    hash_token, hash_secret, is_hashed_secret, serialize_instance,
+    deserialize_instance)
+from .managers import AccessTokenManager, GrantQuerySet, RefreshTokenQuerySet
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
@@ -56,6 +60,19 @@ class ScopeField(models.IntegerField):
         return 'scope'
 
 
+class SecretField(models.CharField):
+    """
+    Holds a token or code. Tokens and codes are looked up by the digest
+    stored next to them; their plaintext is not persisted when
+    :attr:`provider.constants.HASH_TOKENS` is set.
+    """
+    def pre_save(self, model_instance, add):
+        value = super(SecretField, self).pre_save(model_instance, add)
+        if constants.HASH_TOKENS:
+            return ''
+        return value
+
+
 def client_logo_image_path(instance, filename):
     filename_split = os.path.splitext(filename)
     ext = filename_split[1]
@@ -80,6 +97,10 @@ class Client(models.Model):
     * :attr:`client_type`
 
     Clients are outlined in the :rfc:`2` and its subsections.
+
+    With :attr:`provider.constants.HASH_CLIENT_SECRETS`, :attr:`client_secret`
+    is hashed on save and the plaintext of the new secret is left in
+    ``raw_client_secret``.
     """
 
     user = models.ForeignKey(
@@ -115,10 +136,10 @@ class Client(models.Model):
         auto_now_add=True)
     client_id = models.CharField(
         max_length=255,
-        default=short_token)
+        default=generate_client_id)
     client_secret = models.CharField(
         max_length=255,
-        default=long_token)
+        default=generate_client_secret)
     client_type = models.IntegerField(
         choices=constants.CLIENT_TYPES,
         default=constants.CONFIDENTIAL)
@@ -130,6 +151,14 @@ class Client(models.Model):
     def __str__(self):
         return self.redirect_uri
 
+    def save(self, *args, **kwargs):
+        if constants.HASH_CLIENT_SECRETS and \
+                not is_hashed_secret(self.client_secret):
+            # Keep the plaintext around so it can be shown once
+            self.raw_client_secret = self.client_secret
+            self.client_secret = hash_secret(self.client_secret)
+        return super(Client, self).save(*args, **kwargs)
+
     def get_default_token_expiry(self):
         public = (self.client_type == 1)
         return get_token_expiry(public)
@@ -186,9 +215,12 @@ class Grant(models.Model):
         blank=True, null=True)
     client = models.ForeignKey(
         Client)
-    code = models.CharField(
+    code = SecretField(
         max_length=255,
-        default=long_token)
+        default=generate_code)
+    code_hash = models.CharField(
+        max_length=64,
+        unique=True, null=True, editable=False)
     expires = models.DateTimeField(
         default=get_code_expiry)
     redirect_uri = models.CharField(
@@ -200,12 +232,19 @@ class Grant(models.Model):
     modified = models.DateTimeField(
         auto_now=True)
 
+    objects = GrantQuerySet.as_manager()
+
     class Meta:
         app_label = 'oauth2'
 
     def __str__(self):
         return self.code
 
+    def save(self, *args, **kwargs):
+        if self.code:
+            self.code_hash = hash_token(self.code)
+        return super(Grant, self).save(*args, **kwargs)
+
 
 @python_2_unicode_compatible
 class AccessToken(models.Model):
@@ -227,14 +266,23 @@ class AccessToken(models.Model):
 
     * :meth:`get_expire_delta` - returns an integer representing seconds to
         expiry
+
+    With :attr:`provider.constants.SINGLE_ACCESS_TOKEN`, the token handed
+    out for a user, client and scope holds the unique ``single_key``; see
+    :meth:`provider.oauth2.managers.AccessTokenManager.get_or_create_single`.
     """
     user = models.ForeignKey(
         AUTH_USER_MODEL,
         null=True, blank=True)
-    token = models.CharField(
+    token = SecretField(
         max_length=255,
-        default=long_token,
-        db_index=True)
+        default=generate_access_token)
+    token_hash = models.CharField(
+        max_length=64,
+        unique=True, null=True, editable=False)
+    single_key = models.CharField(
+        max_length=64,
+        unique=True, null=True, editable=False)
     client = models.ForeignKey(
         Client)
     expires = models.DateTimeField()
@@ -260,6 +308,8 @@ class AccessToken(models.Model):
     def save(self, *args, **kwargs):
         if not self.expires:
             self.expires = self.client.get_default_token_expiry()
+        if self.token:
+            self.token_hash = hash_token(self.token)
         return super(AccessToken, self).save(*args, **kwargs)
 
     def get_expire_delta(self, reference=None):
@@ -299,9 +349,12 @@ class RefreshToken(models.Model):
     user = models.ForeignKey(
         AUTH_USER_MODEL,
         blank=True, null=True)
-    token = models.CharField(
+    token = SecretField(
         max_length=255,
-        default=long_token)
+        default=generate_refresh_token)
+    token_hash = models.CharField(
+        max_length=64,
+        unique=True, null=True, editable=False)
     access_token = models.OneToOneField(
         AccessToken,
         related_name='refresh_token')
@@ -314,8 +367,15 @@ class RefreshToken(models.Model):
     modified = models.DateTimeField(
         auto_now=True)
 
+    objects = RefreshTokenQuerySet.as_manager()
+
     class Meta:
         app_label = 'oauth2'
 
     def __str__(self):
         return self.token
+
+    def save(self, *args, **kwargs):
+        if self.token:
+            self.token_hash = hash_token(self.token)
+        return super(RefreshToken, self).save(*args, **kwargs)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for password verification.
+
+Password grants call :func:`django.contrib.auth.authenticate`, which spends
+most of its time hashing the password on purpose. A burst of password grants
+pins every request thread on hashing and starves cheap requests such as
+refreshes and introspection.
+
+With :attr:`provider.constants.PASSWORD_POOL_SIZE` set, :attr:`password_pool`
+lets at most that many verifications run at once per process. Up to
+:attr:`provider.constants.PASSWORD_POOL_QUEUE` further requests wait for a
+slot for at most :attr:`provider.constants.PASSWORD_POOL_TIMEOUT` seconds.
+Any other request is turned away at once with a ``temporarily_unavailable``
+error instead of tying up a thread.
+
+Verifications run on the thread of the request, which keeps the database
+connection and transaction of the request in use by authentication backends.
+"""
+
+import threading
+import time
+
+from django.contrib.auth import authenticate
+from django.utils.translation import ugettext as _
+
+from .. import constants
+from ..forms import OAuthValidationError
+
+
+def unavailable():
+    return OAuthValidationError({
+        'error': 'temporarily_unavailable',
+        'error_description': _("Too many password verifications in "
+            "progress, try again later.")})
+
+
+class PasswordPool(object):
+    """
+    Bounded set of slots for password verifications with a bounded queue of
+    requests waiting for one.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self.active = 0
+        self.waiting = 0
+        self.clear()
+
+    @property
+    def size(self):
+        return constants.PASSWORD_POOL_SIZE
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def acquire(self):
+        """
+        Take a slot, waiting for one if the queue has room. Raises
+        :class:`provider.forms.OAuthValidationError` if the pool is saturated
+        or no slot frees up in time.
+        """
+        condition = self._condition
+        with condition:
+            if self.active < self.size:
+                self.active += 1
+                self.admitted += 1
+                return
+
+            if self.waiting >= constants.PASSWORD_POOL_QUEUE:
+                self.rejected += 1
+                raise unavailable()
+
+            self.waiting += 1
+            started = time.time()
+            deadline = started + constants.PASSWORD_POOL_TIMEOUT
+            try:
+                while self.active >= self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise unavailable()
+                    condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            waited = time.time() - started
+            self.active += 1
+            self.admitted += 1
+            self.queued += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def authenticate(self, **credentials):
+        """
+        :func:`django.contrib.auth.authenticate` in a slot of the pool.
+        """
+        if not self.enabled:
+            return authenticate(**credentials)
+
+        self.acquire()
+        try:
+            return authenticate(**credentials)
+        finally:
+            self.release()
+
+    def clear(self):
+        """
+        Reset the counters.
+        """
+        with self._condition:
+            self.admitted = self.queued = self.rejected = self.timeouts = 0
+            self.wait_time = self.max_wait_time = 0.0
+
+    def stats(self):
+        """
+        Return a ``dict`` with the current load and counters of the pool.
+        ``wait_time`` is the total number of seconds admitted requests spent
+        in the queue.
+        """
+        with self._condition:
+            return {
+                'size': self.size,
+                'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+
+
+password_pool = PasswordPool()
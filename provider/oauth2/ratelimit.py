@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limiting of the token endpoint.
+
+:attr:`provider.constants.TOKEN_RATE_LIMITS` maps the
+:attr:`provider.oauth2.models.Client.status` of a client to the number of
+token requests allowed per period, counted separately for each grant type:
+
+::
+
+    OAUTH_TOKEN_RATE_LIMITS = {
+        ClientStatus.TEST: {'client': (60, 60), 'user': (5, 60)},
+        ClientStatus.LIVE: {'client': (6000, 60), 'user': (10, 60)},
+    }
+
+``client`` limits all requests of a client, ``user`` the requests naming the
+same ``username`` or ``email`` on a password grant. Clients with a status
+that is not listed are not limited.
+
+Requests are counted in the cache named by
+:attr:`provider.constants.TOKEN_RATE_LIMIT_CACHE`, so the limits hold across
+all processes sharing it. The counters approximate a sliding window: the
+count of the current fixed window is added to the count of the previous one,
+weighted by how much of the previous window the sliding window still
+overlaps.
+"""
+
+import math
+import time
+
+from .. import constants
+from ..compat import get_cache
+from ..utils import hash_token
+
+
+class RateLimiter(object):
+    """
+    Sliding window request counters stored in the shared cache.
+    """
+    key_prefix = 'oauth2:rate'
+
+    @property
+    def cache(self):
+        return get_cache(constants.TOKEN_RATE_LIMIT_CACHE)
+
+    def get_limits(self, client):
+        """
+        Return a ``dict`` mapping ``'client'`` and ``'user'`` to the
+        ``(requests, seconds)`` allowed for ``client``.
+        """
+        return constants.TOKEN_RATE_LIMITS.get(client.status, {})
+
+    def make_key(self, name, value, grant_type, period, window):
+        return '{}:{}:{}:{}:{}:{}'.format(self.key_prefix, name,
+            hash_token(value), grant_type, period, window)
+
+    def get_retry_after(self, limit, period, current, previous, elapsed):
+        """
+        Return the number of seconds until another request is allowed, or
+        ``None`` if one is allowed now.
+        """
+        weight = 1 - elapsed / float(period)
+        if previous * weight + current < limit:
+            return None
+        if current >= limit:
+            # Only the next window has room
+            return period - elapsed
+        # The previous window fades out until the estimate drops below limit
+        return period - elapsed - period * (limit - current) / float(previous)
+
+    def check(self, client, grant_type, user=None):
+        """
+        Count a token request of ``client`` for ``grant_type`` made on behalf
+        of ``user``, a username or email. Returns the number of seconds to
+        wait if the request exceeds a limit, in which case it is not counted,
+        or ``None``.
+        """
+        limits = self.get_limits(client)
+        counters = []
+        if 'client' in limits:
+            counters.append(('client', client.client_id) + limits['client'])
+        if 'user' in limits and user:
+            counters.append(('user', user) + limits['user'])
+        if not counters:
+            return None
+
+        now = time.time()
+        keys = []
+        for name, value, limit, period in counters:
+            window = int(now // period)
+            keys.append((
+                self.make_key(name, value, grant_type, period, window),
+                self.make_key(name, value, grant_type, period, window - 1),
+                limit, period, now - window * period))
+
+        cache = self.cache
+        counts = cache.get_many([k for key in keys for k in key[:2]])
+
+        retry_after = None
+        for current_key, previous_key, limit, period, elapsed in keys:
+            wait = self.get_retry_after(limit, period,
+                counts.get(current_key, 0), counts.get(previous_key, 0),
+                elapsed)
+            if wait is not None:
+                retry_after = max(retry_after or 0, wait)
+        if retry_after is not None:
+            return max(int(math.ceil(retry_after)), 1)
+
+        for current_key, previous_key, limit, period, elapsed in keys:
+            # Kept until the next window no longer looks back at it
+            if not cache.add(current_key, 1, int(math.ceil(period * 2))):
+                try:
+                    cache.incr(current_key)
+                except ValueError:
+                    cache.add(current_key, 1, int(math.ceil(period * 2)))
+        return None
+
+
+rate_limiter = RateLimiter()
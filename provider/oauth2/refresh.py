@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight refreshes.
+
+Clients firing several requests in parallel often refresh with the same
+refresh token more than once. Only the first refresh succeeds since it
+invalidates the refresh token, so the others fail with ``invalid_grant``.
+
+With :attr:`provider.constants.REFRESH_GRACE_PERIOD`, the first request takes
+a lease on the refresh token in the cache named by
+:attr:`provider.constants.REFRESH_CACHE` and issues the new tokens. Requests
+refreshing with the same token meanwhile wait for it and, for the rest of the
+grace period, receive the same response. If the first request fails, a
+waiting request takes the lease over or, when another one was faster, fails
+with ``invalid_grant``.
+
+The cached response holds the new tokens, so it is keyed by the client and
+the digest of the old refresh token; only its holder can fetch it.
+"""
+
+import time
+
+from .. import constants
+from ..compat import get_cache
+from ..utils import hash_token
+
+
+class RefreshFlights(object):
+    """
+    Leases and results of refreshes in progress, stored in the shared cache.
+    """
+    key_prefix = 'oauth2:refresh'
+
+    #: Number of seconds between checks for the result of a refresh another
+    #: request is issuing.
+    poll_interval = 0.05
+
+    @property
+    def cache(self):
+        return get_cache(constants.REFRESH_CACHE)
+
+    @property
+    def enabled(self):
+        return constants.REFRESH_GRACE_PERIOD > 0
+
+    def make_key(self, client, refresh_token):
+        return '{}:{}:{}'.format(self.key_prefix, client.pk,
+            hash_token(refresh_token))
+
+    def get(self, key):
+        """
+        Return the response data issued for ``key`` with its ``expires_in``
+        brought up to date, or ``None``.
+        """
+        result = self.cache.get(key)
+        if result is None:
+            return None
+        data, expires = result
+        return dict(data, expires_in=max(int(round(expires - time.time())), 0))
+
+    def acquire(self, key):
+        """
+        Take the lease on ``key``. Returns ``False`` if another request holds
+        it.
+        """
+        return self.cache.add(key + ':lease', True,
+            constants.REFRESH_GRACE_PERIOD)
+
+    def wait(self, key):
+        """
+        Wait until the request holding the lease on ``key`` is done and
+        return its result or ``None`` if it failed.
+        """
+        cache = self.cache
+        deadline = time.time() + constants.REFRESH_GRACE_PERIOD
+        while time.time() < deadline:
+            data = self.get(key)
+            if data is not None or cache.get(key + ':lease') is None:
+                return data
+            time.sleep(self.poll_interval)
+        return self.get(key)
+
+    def release(self, key, data=None):
+        """
+        Release the lease on ``key``, sharing the response ``data`` of a
+        successful refresh for the grace period.
+        """
+        cache = self.cache
+        if data is not None:
+            cache.set(key, (data, time.time() + data['expires_in']),
+                constants.REFRESH_GRACE_PERIOD)
+        cache.delete(key + ':lease')
+
+
+refresh_flights = RefreshFlights()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Per-process registry of clients.
+
+Authenticating a client costs a lookup on
+:class:`provider.oauth2.models.Client` for every token request. Deployments
+have few clients that rarely change, so :attr:`client_registry` keeps all of
+them in memory, keyed by ``client_id``.
+
+The registry is opt-in; it stays disabled until
+:attr:`provider.constants.CLIENT_REGISTRY` is set. It is loaded on first use
+and dropped whenever this process saves or deletes a client. Other processes
+learn about changes through a generation counter stored in the cache named
+by :attr:`provider.constants.CLIENT_REGISTRY_CACHE`, which they check at most
+every :attr:`provider.constants.CLIENT_REGISTRY_CHECK_INTERVAL` seconds.
+Without that cache, the registry is reloaded at that interval instead.
+
+Client secrets are verified with :func:`check_client_secret`, which
+remembers successful verifications of hashed secrets (see
+:attr:`provider.constants.HASH_CLIENT_SECRETS`) for
+:attr:`provider.constants.CLIENT_SECRET_CACHE_TTL` seconds.
+"""
+
+import threading
+import time
+
+from django.contrib.auth.hashers import check_password
+from django.db.models.signals import post_delete, post_save
+from django.utils.crypto import constant_time_compare
+
+from .. import constants
+from ..compat import get_cache
+from ..utils import hash_token, is_hashed_secret
+from .cache import TokenCache
+from .models import Client
+
+
+class ClientRegistry(object):
+    """
+    Thread safe mapping of ``client_id`` to
+    :class:`provider.oauth2.models.Client` instances. The instances are
+    shared by all requests and must not be modified.
+    """
+    generation_key = 'oauth2:clients:generation'
+
+    def __init__(self):
+        self._clients = None
+        self._client_ids = None
+        self._generation = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return constants.CLIENT_REGISTRY
+
+    @property
+    def cache(self):
+        if not constants.CLIENT_REGISTRY_CACHE:
+            return None
+        return get_cache(constants.CLIENT_REGISTRY_CACHE)
+
+    def _get_generation(self, cache):
+        generation = cache.get(self.generation_key)
+        if generation is None:
+            # Seed a lost generation counter from the clock so it can't fall
+            # back to a generation another process already loaded
+            generation = int(time.time() * 1000)
+            if not cache.add(self.generation_key, generation, None):
+                generation = cache.get(self.generation_key, generation)
+        return generation
+
+    def _load(self):
+        with self._lock:
+            if self._clients is not None and time.time() - self._checked_at \
+                    < constants.CLIENT_REGISTRY_CHECK_INTERVAL:
+                return self._clients, self._client_ids
+
+            cache = self.cache
+            generation = None
+            if cache is not None:
+                generation = self._get_generation(cache)
+            if self._clients is None or generation is None or \
+                    generation != self._generation:
+                clients = list(Client.objects.all())
+                self._clients = dict((c.client_id, c) for c in clients)
+                self._client_ids = dict((c.pk, c.client_id) for c in clients)
+                self._generation = generation
+            self._checked_at = time.time()
+            return self._clients, self._client_ids
+
+    def get(self, client_id):
+        """
+        Return the client with ``client_id`` or ``None``.
+        """
+        if not self.enabled:
+            try:
+                return Client.objects.get(client_id=client_id)
+            except Client.DoesNotExist:
+                return None
+        return self._load()[0].get(client_id)
+
+    def get_client_ids(self, pks):
+        """
+        Return a ``dict`` mapping the primary keys ``pks`` to the
+        ``client_id`` of their client.
+        """
+        if not self.enabled:
+            return dict(Client.objects.filter(pk__in=set(pks)).values_list(
+                'pk', 'client_id'))
+        client_ids = self._load()[1]
+        return dict((pk, client_ids[pk]) for pk in pks if pk in client_ids)
+
+    def invalidate(self):
+        """
+        Reload the registry in all processes on next use.
+        """
+        with self._lock:
+            self._clients = None
+        cache = self.cache
+        if cache is None:
+            return
+        try:
+            cache.incr(self.generation_key)
+        except ValueError:
+            self._get_generation(cache)
+
+
+client_registry = ClientRegistry()
+
+
+class VerifiedSecretCache(TokenCache):
+    """
+    :class:`provider.oauth2.cache.TokenCache` of successfully verified
+    client secrets, keyed by the stored hash and the digest of the presented
+    secret. Changing a secret changes its hash, so stale entries are never
+    hit.
+    """
+
+    @property
+    def max_size(self):
+        """
+        Defaults to :attr:`provider.constants.CLIENT_SECRET_CACHE_SIZE`.
+        """
+        if self._max_size is None:
+            return constants.CLIENT_SECRET_CACHE_SIZE
+        return self._max_size
+
+    @property
+    def ttl(self):
+        """
+        Defaults to :attr:`provider.constants.CLIENT_SECRET_CACHE_TTL`.
+        """
+        if self._ttl is None:
+            return constants.CLIENT_SECRET_CACHE_TTL
+        return self._ttl
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    def get_lifetime(self, record):
+        return self.ttl
+
+
+verified_secrets = VerifiedSecretCache()
+
+
+def check_client_secret(client, secret):
+    """
+    Return whether ``secret`` is the secret of ``client``, comparing in
+    constant time. Secrets that are not hashed yet are compared as they
+    are.
+    """
+    if not secret:
+        return False
+    if not is_hashed_secret(client.client_secret):
+        return constant_time_compare(client.client_secret, secret)
+
+    key = '{}:{}'.format(client.client_secret, hash_token(secret))
+    if verified_secrets.get(key) is not None:
+        return True
+    if not check_password(secret, client.client_secret):
+        return False
+    verified_secrets.set(key, True)
+    return True
+
+
+def invalidate_clients(sender, instance, **kwargs):
+    """
+    Signal handler reloading the registry whenever a client changes.
+    """
+    client_registry.invalidate()
+
+
+post_save.connect(invalidate_clients, sender=Client,
+    dispatch_uid='provider.oauth2.registry.invalidate_clients.save')
+post_delete.connect(invalidate_clients, sender=Client,
+    dispatch_uid='provider.oauth2.registry.invalidate_clients.delete')
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""
+Signals sent by :attr:`provider.oauth2`.
+"""
+
+from django.dispatch import Signal
+
+#: Sent by :meth:`provider.oauth2.managers.AccessTokenQuerySet.invalidate`
+#: after expiring access tokens with a set-based ``UPDATE``, which doesn't
+#: send ``post_save``. ``tokens`` lists the ``(id, digest, expires)`` of each
+#: token as it was before.
+access_tokens_invalidated = Signal()
+
+#: Sent by :meth:`provider.oauth2.managers.AccessTokenManager.create_many`
+#: after inserting access tokens in bulk, which doesn't send ``post_save``.
+#: ``tokens`` lists the new access tokens.
+access_tokens_created = Signal()
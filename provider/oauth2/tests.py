@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
 
+import base64
+import importlib
 import json
+import os
+import threading
+import time
 import datetime
+from io import StringIO
 from mock import patch
 
 try:
@@ -11,19 +17,52 @@ except ImportError:
     from urllib import parse as urlparse
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import OperationalError, connection
 from django.http import QueryDict
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.utils.html import escape
+from unittest import skipIf
 
-from .. import constants, scope
+from .. import constants, scope, utils
 from ..compat import skipIfCustomUser, get_user_model
 from ..templatetags.scope import scopes
+from ..forms import OAuthValidationError
 from ..views import OAuthError
-from ..utils import now as date_now
-from .forms import ClientForm
+from ..utils import hash_token, now as date_now
+from .forms import (
+    AuthorizationCodeGrantForm, ClientAuthForm, ClientCredentialsGrantForm,
+    ClientForm, PasswordGrantForm, RefreshTokenGrantForm)
 from .models import Client, Grant, AccessToken, RefreshToken
-from .backends import BasicClientBackend, RequestParamsClientBackend, AccessTokenBackend
+from .backends import (
+    AccessTokenBackend, BasicClientBackend, ClientBackend,
+    ConfidentialClientBackend, RequestParamsClientBackend)
+from .bloom import BloomFilter, token_filter
+from .cache import (
+    SharedTokenCache, TokenCache, TokenRecord, negative_token_cache,
+    shared_token_cache, token_cache)
+from .passwords import PasswordPool, password_pool
+from .ratelimit import rate_limiter
+from .refresh import refresh_flights
+from .registry import (
+    ClientRegistry, check_client_secret, client_registry, verified_secrets)
+from .middleware import AuthenticationMiddleware, TokenUser
+from .validators import (
+    AuthorizationCodeGrantValidator, ClientCredentialsGrantValidator,
+    PasswordGrantValidator, RefreshTokenGrantValidator)
+from .views import AccessTokenView, IntrospectTokenView
+from . import jws, tokens
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+except ImportError:
+    default_backend = None
 
 
 @skipIfCustomUser
@@ -716,11 +755,16 @@ class AccessTokenTest(BaseOAuth2TestCase):
 class AuthBackendTest(BaseOAuth2TestCase):
     fixtures = ['test_oauth2']
 
+    def _basic_auth(self, client, client_secret=None):
+        credentials = '{0}:{1}'.format(client.client_id,
+            client_secret or client.client_secret)
+        return 'Basic ' + base64.b64encode(
+            credentials.encode('ascii')).decode('ascii')
+
     def test_basic_client_backend(self):
         request = type('Request', (object,), {'META': {}})()
-        request.META['HTTP_AUTHORIZATION'] = "Basic " + "{0}:{1}".format(
-            self.get_client().client_id,
-            self.get_client().client_secret).encode('base64')
+        request.META['HTTP_AUTHORIZATION'] = self._basic_auth(
+            self.get_client())
 
         self.assertEqual(BasicClientBackend().authenticate(request).id,
                          2, "Didn't return the right client.")
@@ -734,6 +778,51 @@ class AuthBackendTest(BaseOAuth2TestCase):
         self.assertEqual(RequestParamsClientBackend().authenticate(request).id,
                          2, "Didn't return the right client.'")
 
+    def test_client_backend(self):
+        client = self.get_client()
+        factory = RequestFactory()
+        backend = ClientBackend()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(client, backend.authenticate(factory.post('/',
+                HTTP_AUTHORIZATION=self._basic_auth(client))))
+        with self.assertNumQueries(1):
+            self.assertEqual(client, backend.authenticate(factory.post('/', {
+                'client_id': client.client_id,
+                'client_secret': client.client_secret})))
+        with self.assertNumQueries(1):
+            self.assertIsNone(backend.authenticate(factory.post('/',
+                HTTP_AUTHORIZATION=self._basic_auth(client, 'wrong'))))
+        with self.assertNumQueries(0):
+            self.assertIsNone(backend.authenticate(factory.post('/',
+                HTTP_AUTHORIZATION='Basic !')))
+            self.assertIsNone(backend.authenticate(factory.post('/')))
+
+    def test_client_backend_public(self):
+        client = self.get_client()
+        client.client_type = constants.PUBLIC
+        client.save()
+        factory = RequestFactory()
+        backend = ClientBackend()
+
+        self.assertEqual(client, backend.authenticate(factory.post('/', {
+            'client_id': client.client_id, 'grant_type': 'password'})))
+        self.assertIsNone(backend.authenticate(factory.post('/', {
+            'client_id': client.client_id,
+            'grant_type': 'client_credentials'})))
+        self.assertEqual(client, backend.authenticate(factory.post('/',
+            json.dumps({'client_id': client.client_id,
+                'grant_type': 'password'}),
+            content_type='application/json')))
+        self.assertIsNone(ConfidentialClientBackend().authenticate(
+            factory.post('/', {'client_id': client.client_id,
+                'grant_type': 'password'})))
+
+        client.client_type = constants.CONFIDENTIAL
+        client.save()
+        self.assertIsNone(backend.authenticate(factory.post('/', {
+            'client_id': client.client_id, 'grant_type': 'password'})))
+
     def test_access_token_backend(self):
         user = self.get_user()
         client = self.get_client()
@@ -885,3 +974,1975 @@ class DeleteExpiredTest(BaseOAuth2TestCase):
                          .exists())
         self.assertFalse(RefreshToken.objects.filter(token=refresh_token)
                          .exists())
+
+    def test_keeping_refresh_token(self):
+        at = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        rt = RefreshToken.objects.create(user=at.user, client=at.client,
+            access_token=at)
+
+        with patch.object(constants, 'KEEP_REFRESH_TOKEN', True):
+            for i in range(2):
+                response = self.client.post(self.access_token_url(), {
+                    'grant_type': 'refresh_token',
+                    'refresh_token': rt.token,
+                    'client_id': self.get_client().client_id,
+                    'client_secret': self.get_client().client_secret,
+                })
+                self.assertEqual(200, response.status_code, response.content)
+
+        token = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(rt.token, token['refresh_token'])
+        self.assertFalse(AccessToken.objects.filter(pk=at.pk).exists())
+        self.assertEqual(token['access_token'],
+            RefreshToken.objects.get(pk=rt.pk).access_token.token)
+
+
+class TokenCacheTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._cache_size = constants.TOKEN_CACHE_SIZE
+        constants.TOKEN_CACHE_SIZE = 10
+        token_cache.clear()
+
+    def tearDown(self):
+        constants.TOKEN_CACHE_SIZE = self._cache_size
+        token_cache.clear()
+
+    def _record(self, expires_in=3600):
+        return TokenRecord(1, 1, 2, constants.READ,
+            date_now() + datetime.timedelta(seconds=expires_in))
+
+    def _authenticate(self, token):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='token ' + token)
+        AuthenticationMiddleware().process_request(request)
+        # evaluate the lazy user
+        request.user.pk
+        return request.user
+
+    def test_lru_eviction(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        cache.set('a', self._record())
+        cache.set('b', self._record())
+        self.assertIsNotNone(cache.get('a'))
+        cache.set('c', self._record())
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual({'size': 2, 'max_size': 2, 'hits': 3, 'misses': 1,
+            'evictions': 1}, cache.stats())
+
+    def test_ttl_capped_at_token_expiry(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        cache.set('expired', self._record(expires_in=-1))
+        self.assertIsNone(cache.get('expired'))
+
+        with patch('provider.oauth2.cache.time.time', return_value=0):
+            cache.set('short', self._record(expires_in=5))
+        with patch('provider.oauth2.cache.time.time', return_value=6):
+            self.assertIsNone(cache.get('short'))
+
+    def test_disabled_cache(self):
+        cache = TokenCache(max_size=0)
+        cache.set('a', self._record())
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, cache.stats()['misses'])
+
+    def test_middleware_uses_cache(self):
+        user = self.get_user()
+        token = AccessToken.objects.create(user=user, client=self.get_client())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(user, self._authenticate(token.token))
+        with self.assertNumQueries(1):
+            self.assertEqual(user, self._authenticate(token.token))
+        self.assertEqual(1, token_cache.stats()['hits'])
+
+    def test_invalidation(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self._authenticate(token.token)
+        self.assertIsNotNone(token_cache.get(token.token_hash))
+
+        token.expires = date_now() - datetime.timedelta(days=1)
+        token.save()
+        self.assertIsNone(token_cache.get(token.token_hash))
+        self.assertFalse(self._authenticate(token.token).is_authenticated())
+
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self._authenticate(token.token)
+        token.delete()
+        self.assertIsNone(token_cache.get(token.token_hash))
+
+
+class SharedTokenCacheTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._shared_cache = constants.TOKEN_SHARED_CACHE
+        constants.TOKEN_SHARED_CACHE = 'default'
+        cache.clear()
+
+    def tearDown(self):
+        constants.TOKEN_SHARED_CACHE = self._shared_cache
+        cache.clear()
+
+    def _authenticate(self, token):
+        return AccessTokenBackend().authenticate(access_token=token.token,
+            client=self.get_client())
+
+    def test_backend_uses_shared_cache(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        client = self.get_client()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(token, AccessTokenBackend().authenticate(
+                access_token=token.token, client=client))
+        with self.assertNumQueries(0):
+            cached = AccessTokenBackend().authenticate(
+                access_token=token.token, client=client)
+        self.assertIsInstance(cached, TokenRecord)
+        self.assertEqual(token.id, cached.id)
+        self.assertEqual(token.scope, cached.scope)
+        self.assertEqual(token.user_id, cached.user_id)
+
+        self.assertIsNone(AccessTokenBackend().authenticate(
+            access_token=token.token, client=self.get_client(3)))
+
+    def test_keys_do_not_contain_tokens(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self._authenticate(token)
+        key = shared_token_cache.make_key(token.token_hash)
+        self.assertNotIn(token.token, key)
+        self.assertIsNotNone(cache.get(key))
+
+    def test_invalidation(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self.assertIsNotNone(self._authenticate(token))
+
+        token.expires = date_now() - datetime.timedelta(days=1)
+        token.save()
+        self.assertIsNone(self._authenticate(token))
+
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self._authenticate(token)
+        token.delete()
+        self.assertIsNone(self._authenticate(token))
+
+    def test_invalidate_all(self):
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return AccessToken.objects.create(user=self.get_user(),
+                client=self.get_client())
+
+        shared = SharedTokenCache(alias='default')
+        shared.get_or_load('a', loader)
+        shared.get_or_load('a', loader)
+        self.assertEqual(1, len(loads))
+
+        shared.invalidate_all()
+        shared.get_or_load('a', loader)
+        self.assertEqual(2, len(loads))
+
+        # A lost generation counter must not revive older entries
+        cache.delete(shared.generation_key)
+        shared.get_or_load('a', loader)
+        self.assertEqual(3, len(loads))
+
+    def test_clean_tokens_invalidates_cache(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self._authenticate(token)
+        generation = cache.get(shared_token_cache.generation_key)
+
+        call_command('clean_tokens', stdout=StringIO())
+        self.assertEqual(generation + 1,
+            cache.get(shared_token_cache.generation_key))
+
+
+class AuthenticationMiddlewareTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def _request(self, token):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='token ' + token)
+        AuthenticationMiddleware().process_request(request)
+        return request
+
+    def test_single_query_per_request(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        request = self._request(token.token)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(request.user.is_authenticated())
+            self.assertEqual('test-user-1', request.user.username)
+
+    def test_user_fields_projection(self):
+        _user_fields = constants.TOKEN_USER_FIELDS
+        constants.TOKEN_USER_FIELDS = ('username', 'is_active')
+        try:
+            user = self.get_user()
+            token = AccessToken.objects.create(user=user,
+                client=self.get_client())
+            request = self._request(token.token)
+
+            with self.assertNumQueries(1):
+                self.assertEqual('test-user-1', request.user.username)
+            # Deferred fields are loaded on access
+            with self.assertNumQueries(1):
+                self.assertEqual(user.email, request.user.email)
+        finally:
+            constants.TOKEN_USER_FIELDS = _user_fields
+
+    def test_inactive_user(self):
+        user = self.get_user()
+        token = AccessToken.objects.create(user=user, client=self.get_client())
+        user.is_active = False
+        user.save()
+
+        request = self._request(token.token)
+        with self.assertNumQueries(1):
+            self.assertFalse(request.oauth_token)
+            self.assertFalse(request.user.is_authenticated())
+
+    def test_invalid_token(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(self._request('invalid').user.is_authenticated())
+        with self.assertNumQueries(0):
+            self.assertFalse(self._request('').user.is_authenticated())
+
+
+class LazyUserTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._lazy_user = constants.LAZY_USER
+        self._size = constants.TOKEN_CACHE_SIZE
+        constants.LAZY_USER = True
+        constants.TOKEN_CACHE_SIZE = 10
+        token_cache.clear()
+
+    def tearDown(self):
+        constants.LAZY_USER = self._lazy_user
+        constants.TOKEN_CACHE_SIZE = self._size
+        token_cache.clear()
+
+    def _request(self, token):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='token ' + token)
+        AuthenticationMiddleware().process_request(request)
+        return request
+
+    def test_user_is_loaded_lazily(self):
+        user = self.get_user()
+        token = AccessToken.objects.create(user=user,
+            client=self.get_client(), scope=constants.READ)
+
+        # Only the token is loaded, without joining the user
+        request = self._request(token.token)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.pk, request.user.pk)
+        self.assertIsInstance(request.user._wrapped, TokenUser)
+
+        request = self._request(token.token)
+        with self.assertNumQueries(0):
+            self.assertEqual(user.pk, request.user.pk)
+            self.assertEqual(constants.READ, request.oauth_token.scope)
+            self.assertEqual(token.client_id, request.oauth_token.client_id)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.username, request.user.username)
+            self.assertTrue(request.user.is_authenticated())
+
+    def test_inactive_user(self):
+        user = self.get_user()
+        token = AccessToken.objects.create(user=user, client=self.get_client())
+        user.is_active = False
+        user.save()
+
+        request = self._request(token.token)
+        self.assertIsNone(request.user.pk)
+        self.assertFalse(request.oauth_token)
+        self.assertFalse(request.user.is_authenticated())
+
+    def test_deactivated_user_is_evicted(self):
+        user = self.get_user()
+        token = AccessToken.objects.create(user=user, client=self.get_client())
+        self.assertEqual(user.pk, self._request(token.token).user.pk)
+        self.assertTrue(token_cache.get(token.token_hash).user_is_active)
+
+        user.is_active = False
+        user.save()
+        self.assertIsNone(token_cache.get(token.token_hash))
+        request = self._request(token.token)
+        self.assertIsNone(request.user.pk)
+        self.assertFalse(request.oauth_token)
+
+    def test_inactive_user_saves(self):
+        user = self.get_user()
+        AccessToken.objects.create(user=user, client=self.get_client())
+        user.is_active = False
+        with patch.object(constants, 'TOKEN_CACHE_SIZE', 0):
+            # No cache to evict from
+            with self.assertNumQueries(1):
+                user.save()
+        user.is_active = True
+        user.save()
+
+        user.is_active = False
+        with self.assertNumQueries(2):
+            user.save()
+        # Saving a user that was inactive already evicts nothing
+        with self.assertNumQueries(1):
+            user.save()
+        user = self.get_user()
+        with self.assertNumQueries(1):
+            user.save()
+
+    def test_no_token(self):
+        request = self._request('invalid')
+        self.assertFalse(request.oauth_token)
+        self.assertFalse(request.user.is_authenticated())
+
+
+class NegativeTokenCacheTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._ttl = constants.NEGATIVE_TOKEN_CACHE_TTL
+        self._shared_cache = constants.TOKEN_SHARED_CACHE
+        constants.NEGATIVE_TOKEN_CACHE_TTL = 5
+        negative_token_cache.clear()
+        cache.clear()
+
+    def tearDown(self):
+        constants.NEGATIVE_TOKEN_CACHE_TTL = self._ttl
+        constants.TOKEN_SHARED_CACHE = self._shared_cache
+        negative_token_cache.clear()
+        cache.clear()
+
+    def _authenticate(self, token):
+        return AccessTokenBackend().authenticate(access_token=token,
+            client=self.get_client())
+
+    def test_invalid_tokens_are_remembered(self):
+        client = self.get_client()
+        with self.assertNumQueries(1):
+            self.assertIsNone(AccessTokenBackend().authenticate(
+                access_token='invalid', client=client))
+        with self.assertNumQueries(0):
+            self.assertIsNone(AccessTokenBackend().authenticate(
+                access_token='invalid', client=client))
+
+    def test_shared_negative_cache(self):
+        constants.TOKEN_SHARED_CACHE = 'default'
+        client = self.get_client()
+        self._authenticate('invalid')
+        negative_token_cache.clear()
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(AccessTokenBackend().authenticate(
+                access_token='invalid', client=client))
+
+    def test_valid_tokens_are_not_affected(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self.assertIsNotNone(self._authenticate(token.token))
+        self.assertNotIn(token.token_hash, negative_token_cache)
+
+
+class BloomFilterTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._capacity = constants.TOKEN_BLOOM_CAPACITY
+        constants.TOKEN_BLOOM_CAPACITY = 1000
+        # Build the filter in the test's thread, which sees its transaction
+        token_filter.background = False
+        token_filter.clear()
+        cache.clear()
+
+    def tearDown(self):
+        constants.TOKEN_BLOOM_CAPACITY = self._capacity
+        token_filter.background = True
+        token_filter._pid = None
+        token_filter.clear()
+        cache.clear()
+
+    def _authenticate(self, token):
+        return AccessTokenBackend().authenticate(access_token=token,
+            client=self.get_client())
+
+    def _create_elsewhere(self):
+        # Simulate a token issued by another process, only journaled
+        with patch.object(token_filter, '_state', (None, 0, None)):
+            return AccessToken.objects.create(user=self.get_user(),
+                client=self.get_client())
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(100, 0.01)
+        for i in range(100):
+            bloom.add(str(i))
+        for i in range(100):
+            self.assertIn(str(i), bloom)
+        false_positives = sum(1 for i in range(100, 1100) if str(i) in bloom)
+        self.assertLess(false_positives, 50)
+
+    def test_unknown_tokens_are_rejected(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self.assertTrue(token_filter.might_contain(token.token_hash))
+
+        # Tokens created by this process are added right away
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        client = self.get_client()
+        with self.assertNumQueries(0):
+            self.assertTrue(token_filter.might_contain(token.token_hash))
+            self.assertIsNone(AccessTokenBackend().authenticate(
+                access_token='invalid', client=client))
+
+    def test_tokens_of_other_processes(self):
+        self.assertFalse(token_filter.might_contain(hash_token('invalid')))
+        token = self._create_elsewhere()
+        self.assertNotIn(token.token_hash, token_filter._state[0])
+        with self.assertNumQueries(0):
+            self.assertTrue(token_filter.might_contain(token.token_hash))
+        self.assertIsNotNone(self._authenticate(token.token))
+
+    def test_lost_journal(self):
+        token_filter.might_contain(hash_token('invalid'))
+        token = self._create_elsewhere()
+        cache.clear()
+        self.assertTrue(token_filter.might_contain(token.token_hash))
+        self.assertTrue(token_filter.might_contain(hash_token('invalid')))
+
+    def test_stale_filter(self):
+        token_filter.might_contain(hash_token('invalid'))
+        token_filter.background = True
+        later = time.time() + constants.TOKEN_BLOOM_REBUILD_INTERVAL * 2
+        with patch.object(token_filter, '_pid', os.getpid()), \
+                patch('provider.oauth2.bloom.time.time', return_value=later):
+            self.assertTrue(token_filter.might_contain(hash_token('invalid')))
+
+    def test_background_rebuild(self):
+        token_filter.background = True
+        with patch('provider.oauth2.bloom.threading.Thread') as thread:
+            token_filter.might_contain(hash_token('invalid'))
+            token_filter.might_contain(hash_token('invalid'))
+            self.assertEqual(1, thread.call_count)
+            self.assertTrue(thread.return_value.daemon)
+
+            # Forked processes start their own thread
+            with patch('provider.oauth2.bloom.os.getpid',
+                    return_value=os.getpid() + 1):
+                token_filter.might_contain(hash_token('invalid'))
+            self.assertEqual(2, thread.call_count)
+        token_filter._pid = os.getpid()
+
+        # The filter isn't trusted until the thread built it
+        self.assertTrue(token_filter.might_contain(hash_token('invalid')))
+
+    def test_rejections_are_not_remembered(self):
+        ttl = constants.NEGATIVE_TOKEN_CACHE_TTL
+        constants.NEGATIVE_TOKEN_CACHE_TTL = 5
+        negative_token_cache.clear()
+        try:
+            self.assertIsNone(self._authenticate('invalid'))
+            self.assertNotIn(hash_token('invalid'), negative_token_cache)
+        finally:
+            constants.NEGATIVE_TOKEN_CACHE_TTL = ttl
+            negative_token_cache.clear()
+
+    def test_rebuild(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        token_filter.might_contain(token.token_hash)
+        old = token_filter._state[0]
+        created = []
+
+        def create_while_building(*args):
+            # Filter lookups and new tokens aren't held up by the rebuild
+            self.assertTrue(token_filter.might_contain(token.token_hash))
+            created.append(AccessToken.objects.create(user=self.get_user(),
+                client=self.get_client()))
+            return BloomFilter(*args)
+
+        with patch.object(constants, 'TOKEN_BLOOM_REBUILD_INTERVAL', 0), \
+                patch('provider.oauth2.bloom.BloomFilter',
+                    side_effect=create_while_building):
+            self.assertTrue(token_filter.might_contain(token.token_hash))
+        self.assertIsNot(old, token_filter._state[0])
+        self.assertIn(created[0].token_hash, token_filter._state[0])
+
+
+class SignedTokenTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._formats = constants.CLIENT_TOKEN_FORMATS
+        self._revocation = constants.SIGNED_TOKEN_REVOCATION
+        self._shared_cache = constants.TOKEN_SHARED_CACHE
+        constants.CLIENT_TOKEN_FORMATS = {
+            self.get_client().client_id: tokens.SIGNED}
+        cache.clear()
+
+    def tearDown(self):
+        constants.CLIENT_TOKEN_FORMATS = self._formats
+        constants.SIGNED_TOKEN_REVOCATION = self._revocation
+        constants.TOKEN_SHARED_CACHE = self._shared_cache
+        cache.clear()
+
+    def _create_token(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        return token, tokens.encode(token)
+
+    def _request(self, value):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='token ' + value)
+        AuthenticationMiddleware().process_request(request)
+        return request
+
+    def test_encode_decode(self):
+        token, value = self._create_token()
+        self.assertTrue(tokens.is_signed(value))
+        self.assertFalse(tokens.is_signed(token.token))
+
+        record = tokens.decode(value)
+        self.assertEqual((token.id, token.user_id, token.client_id, token.scope),
+            record[:4])
+        self.assertTrue(abs(token.get_expire_delta() - record.get_expire_delta()) <= 1)
+
+        # Other clients keep getting opaque tokens
+        other = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client(3))
+        self.assertEqual(other.token, tokens.encode(other))
+
+    def test_tampered_and_expired_tokens(self):
+        token, value = self._create_token()
+        self.assertIsNone(tokens.decode(value[:-1]))
+        self.assertIsNone(tokens.decode('a:b:c'))
+
+        token.expires = date_now() - datetime.timedelta(seconds=1)
+        self.assertIsNone(tokens.decode(tokens.encode(token)))
+
+    def test_access_token_endpoint(self):
+        c = self.get_client()
+        response = self.client.post(self.access_token_url(), {
+            'grant_type': 'password',
+            'client_id': c.client_id,
+            'client_secret': c.client_secret,
+            'username': self.get_user().username,
+            'password': self.get_password(),
+        })
+        self.assertEqual(200, response.status_code, response.content)
+        value = json.loads(response.content.decode('utf-8'))['access_token']
+        self.assertEqual(AccessToken.objects.get(pk=tokens.decode(value).id).client, c)
+
+    def test_database_revocation(self):
+        token, value = self._create_token()
+        request = self._request(value)
+        with self.assertNumQueries(1):
+            self.assertEqual('test-user-1', request.user.username)
+
+        token.delete()
+        self.assertFalse(self._request(value).user.is_authenticated())
+
+    def test_no_revocation(self):
+        constants.SIGNED_TOKEN_REVOCATION = None
+        token, value = self._create_token()
+        token_id = token.id
+        token.delete()
+
+        client = self.get_client()
+        with self.assertNumQueries(0):
+            authenticated = AccessTokenBackend().authenticate(
+                access_token=value, client=client)
+        self.assertEqual(token_id, authenticated.id)
+
+    def test_cache_revocation(self):
+        constants.SIGNED_TOKEN_REVOCATION = 'cache'
+        constants.TOKEN_SHARED_CACHE = 'default'
+        token, value = self._create_token()
+        client = self.get_client()
+
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(AccessTokenBackend().authenticate(
+                access_token=value, client=client))
+
+        token.expires = date_now() - datetime.timedelta(days=1)
+        token.save()
+        with self.assertNumQueries(0):
+            self.assertIsNone(AccessTokenBackend().authenticate(
+                access_token=value, client=client))
+
+
+def generate_signing_key(kid, curve=False):
+    if curve:
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    else:
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+    return {'kid': kid, 'key': key.private_bytes(serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()).decode('ascii')}
+
+
+@skipIf(default_backend is None, 'cryptography is not installed')
+class JWTTokenTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    @classmethod
+    def setUpClass(cls):
+        super(JWTTokenTest, cls).setUpClass()
+        cls.keys = [generate_signing_key('rsa'),
+            generate_signing_key('ec', curve=True)]
+
+    def setUp(self):
+        self._formats = constants.CLIENT_TOKEN_FORMATS
+        self._keys = constants.TOKEN_SIGNING_KEYS
+        self._kid = constants.TOKEN_SIGNING_KID
+        constants.CLIENT_TOKEN_FORMATS = {
+            self.get_client().client_id: tokens.JWT}
+        constants.TOKEN_SIGNING_KEYS = self.keys
+
+    def tearDown(self):
+        constants.CLIENT_TOKEN_FORMATS = self._formats
+        constants.TOKEN_SIGNING_KEYS = self._keys
+        constants.TOKEN_SIGNING_KID = self._kid
+
+    def _create_token(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client(), scope=constants.READ)
+        return token, tokens.encode(token)
+
+    def _header(self, value):
+        return json.loads(jws.b64decode(value.split('.')[0]).decode('utf-8'))
+
+    def test_encode_decode(self):
+        for kid in ('rsa', 'ec'):
+            constants.TOKEN_SIGNING_KID = kid
+            token, value = self._create_token()
+            self.assertTrue(tokens.is_signed(value))
+            self.assertEqual(kid, self._header(value)['kid'])
+
+            claims = jws.loads(value)
+            self.assertEqual(str(token.user_id), claims['sub'])
+            self.assertEqual(token.client.client_id, claims['client_id'])
+            self.assertEqual('read', claims['scope'])
+
+            record = tokens.decode(value)
+            self.assertEqual((token.id, token.user_id, token.client_id,
+                token.scope), record[:4])
+
+    def test_tampered_and_expired_tokens(self):
+        token, value = self._create_token()
+        header, claims, signature = value.split('.')
+        forged = jws.b64encode(json.dumps(dict(jws.loads(value),
+            sub='2')).encode('utf-8'))
+        self.assertIsNone(tokens.decode('.'.join((header, forged, signature))))
+        self.assertIsNone(tokens.decode('a.b.c'))
+
+        token.expires = date_now() - datetime.timedelta(seconds=1)
+        self.assertIsNone(tokens.decode(tokens.encode(token)))
+
+    def test_key_rotation(self):
+        token, value = self._create_token()
+        self.assertEqual('rsa', self._header(value)['kid'])
+
+        constants.TOKEN_SIGNING_KID = 'ec'
+        self.assertEqual('ec', self._header(tokens.encode(token))['kid'])
+        self.assertIsNotNone(tokens.decode(value))
+
+        # Tokens signed with a retired key are rejected
+        constants.TOKEN_SIGNING_KEYS = self.keys[1:]
+        self.assertIsNone(tokens.decode(value))
+
+    def test_jwks_endpoint(self):
+        response = self.client.get(reverse('oauth2:jwks'))
+        self.assertEqual(200, response.status_code)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('max-age={}'.format(constants.JWKS_MAX_AGE),
+            response['Cache-Control'])
+
+        keys = json.loads(response.content.decode('utf-8'))['keys']
+        self.assertEqual(['rsa', 'ec'], [key['kid'] for key in keys])
+        self.assertEqual(['RS256', 'ES256'], [key['alg'] for key in keys])
+        self.assertNotIn('d', keys[0])
+        self.assertNotIn('d', keys[1])
+
+        public_numbers = jws.get_keys()['rsa'].key.public_key().public_numbers()
+        self.assertEqual(public_numbers.n, int.from_bytes(
+            jws.b64decode(keys[0]['n']), 'big'))
+
+    def test_access_token_endpoint(self):
+        c = self.get_client()
+        response = self.client.post(self.access_token_url(), {
+            'grant_type': 'password',
+            'client_id': c.client_id,
+            'client_secret': c.client_secret,
+            'username': self.get_user().username,
+            'password': self.get_password(),
+        })
+        self.assertEqual(200, response.status_code, response.content)
+        value = json.loads(response.content.decode('utf-8'))['access_token']
+
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='token ' + value)
+        AuthenticationMiddleware().process_request(request)
+        with self.assertNumQueries(1):
+            self.assertEqual('test-user-1', request.user.username)
+
+
+class IntrospectTokenViewTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._size = constants.TOKEN_CACHE_SIZE
+        self._shared_cache = constants.TOKEN_SHARED_CACHE
+        token_cache.clear()
+        cache.clear()
+
+    def tearDown(self):
+        constants.TOKEN_CACHE_SIZE = self._size
+        constants.TOKEN_SHARED_CACHE = self._shared_cache
+        token_cache.clear()
+        cache.clear()
+
+    def _create_tokens(self):
+        valid = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client(), scope=constants.READ)
+        expired = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client(),
+            expires=date_now() - datetime.timedelta(days=1))
+        return [valid.token, 'invalid', expired.token]
+
+    def _post(self, values, client=None):
+        client = client or self.get_client()
+        return self.client.post(reverse('oauth2:introspect'), {
+            'client_id': client.client_id,
+            'client_secret': client.client_secret,
+            'token': values,
+        })
+
+    def test_single_token(self):
+        value = self._create_tokens()[0]
+        response = self._post([value])
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertTrue(data['active'])
+        self.assertEqual('read', data['scope'])
+        self.assertEqual(self.get_client().client_id, data['client_id'])
+        self.assertEqual(str(self.get_user().pk), data['sub'])
+
+        data = json.loads(self._post(['invalid']).content.decode('utf-8'))
+        self.assertEqual({'active': False}, data)
+
+    def test_many_tokens(self):
+        values = self._create_tokens()
+        response = self._post(values)
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content.decode('utf-8'))['tokens']
+        self.assertEqual([True, False, False],
+            [result['active'] for result in data])
+
+    def test_repeated_tokens(self):
+        valid, invalid = self._create_tokens()[:2]
+        response = self._post([valid, valid])
+        data = json.loads(response.content.decode('utf-8'))['tokens']
+        self.assertEqual([True, True], [result['active'] for result in data])
+
+        with self.assertNumQueries(2):
+            results = IntrospectTokenView().introspect(
+                [invalid, valid, invalid])
+        self.assertEqual([False, True, False],
+            [result['active'] for result in results])
+
+    def test_inactive_user(self):
+        value = self._create_tokens()[0]
+        client = self.get_client()
+        with patch.object(constants, 'CLIENT_TOKEN_FORMATS',
+                {client.client_id: tokens.SIGNED}):
+            signed = tokens.encode(AccessToken.objects.create(
+                user=self.get_user(), client=client))
+        user = self.get_user()
+        user.is_active = False
+        user.save()
+
+        for revocation in ('database', 'cache', None):
+            with patch.object(constants, 'SIGNED_TOKEN_REVOCATION',
+                    revocation):
+                results = IntrospectTokenView().introspect([value, signed])
+            self.assertEqual([{'active': False}] * 2, results)
+
+    def test_single_query(self):
+        values = self._create_tokens()
+        # One query for the tokens, one for the client ids
+        with self.assertNumQueries(2):
+            results = IntrospectTokenView().introspect(values)
+        self.assertEqual([True, False, False],
+            [result['active'] for result in results])
+
+    def test_cached_tokens(self):
+        constants.TOKEN_CACHE_SIZE = 10
+        constants.TOKEN_SHARED_CACHE = 'default'
+        valid = self._create_tokens()[0]
+        other = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client()).token
+        IntrospectTokenView().introspect([valid])
+
+        # valid is only left in the shared cache, other in both caches; only
+        # the unknown token is looked up, next to the client ids
+        token_cache.clear()
+        IntrospectTokenView().introspect([other])
+        with self.assertNumQueries(2):
+            results = IntrospectTokenView().introspect(
+                [valid, other, 'invalid'])
+        self.assertEqual([True, True, False],
+            [result['active'] for result in results])
+
+    def test_client_authentication(self):
+        response = self.client.post(reverse('oauth2:introspect'),
+            {'token': self._create_tokens()[0]})
+        self.assertEqual(401, response.status_code)
+
+    def test_token_limit(self):
+        _max = constants.INTROSPECTION_MAX_TOKENS
+        constants.INTROSPECTION_MAX_TOKENS = 2
+        try:
+            response = self._post(self._create_tokens())
+        finally:
+            constants.INTROSPECTION_MAX_TOKENS = _max
+        self.assertEqual(400, response.status_code)
+
+
+class HashedTokenTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._hash_tokens = constants.HASH_TOKENS
+        self._single = constants.SINGLE_ACCESS_TOKEN
+
+    def tearDown(self):
+        constants.HASH_TOKENS = self._hash_tokens
+        constants.SINGLE_ACCESS_TOKEN = self._single
+
+    def _password_grant(self):
+        c = self.get_client()
+        response = self.client.post(self.access_token_url(), {
+            'grant_type': 'password',
+            'client_id': c.client_id,
+            'client_secret': c.client_secret,
+            'username': self.get_user().username,
+            'password': self.get_password(),
+        })
+        self.assertEqual(200, response.status_code, response.content)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_digests_are_stored(self):
+        token = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        refresh_token = RefreshToken.objects.create(user=self.get_user(),
+            client=self.get_client(), access_token=token)
+        grant = Grant.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self.assertEqual(hash_token(token.token), token.token_hash)
+        self.assertEqual(hash_token(refresh_token.token),
+            refresh_token.token_hash)
+        self.assertEqual(hash_token(grant.code), grant.code_hash)
+        self.assertEqual(token, AccessToken.objects.get_token(token.token))
+
+    def test_plaintext_is_not_stored(self):
+        constants.HASH_TOKENS = True
+        data = self._password_grant()
+        token = AccessToken.objects.get(
+            token_hash=hash_token(data['access_token']))
+        self.assertEqual('', token.token)
+        self.assertEqual('', token.refresh_token.token)
+
+        authenticated = AccessTokenBackend().authenticate(
+            access_token=data['access_token'], client=self.get_client())
+        self.assertEqual(data['access_token'], authenticated.token)
+
+        c = self.get_client()
+        response = self.client.post(self.access_token_url(), {
+            'grant_type': 'refresh_token',
+            'refresh_token': data['refresh_token'],
+            'client_id': c.client_id,
+            'client_secret': c.client_secret,
+        })
+        self.assertEqual(200, response.status_code, response.content)
+        refreshed = json.loads(response.content.decode('utf-8'))
+        self.assertTrue(refreshed['access_token'])
+        self.assertNotEqual(data['access_token'], refreshed['access_token'])
+
+    def test_single_access_token_is_replaced(self):
+        constants.HASH_TOKENS = True
+        constants.SINGLE_ACCESS_TOKEN = True
+        first = self._password_grant()['access_token']
+        second = self._password_grant()['access_token']
+        self.assertNotEqual(first, second)
+        self.assertEqual(1, AccessToken.objects.filter(
+            expires__gt=date_now()).count())
+        self.assertRaises(AccessToken.DoesNotExist,
+            AccessToken.objects.get_token, first)
+
+    def test_backfill_migration(self):
+        migration = importlib.import_module(
+            'provider.oauth2.migrations.0003_backfill_token_hash')
+        tokens = [AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client()) for i in range(3)]
+        AccessToken.objects.update(token_hash=None)
+
+        from django.apps import apps
+        with patch.object(migration, 'CHUNK_SIZE', 2):
+            with connection.schema_editor() as schema_editor:
+                migration.backfill_hashes(apps, schema_editor)
+        for token in tokens:
+            self.assertEqual(token, AccessToken.objects.get_token(token.token))
+
+
+class ClientRegistryTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._registry = constants.CLIENT_REGISTRY
+        self._cache = constants.CLIENT_REGISTRY_CACHE
+        self._interval = constants.CLIENT_REGISTRY_CHECK_INTERVAL
+        constants.CLIENT_REGISTRY = True
+        client_registry.invalidate()
+        cache.clear()
+
+    def tearDown(self):
+        constants.CLIENT_REGISTRY = self._registry
+        constants.CLIENT_REGISTRY_CACHE = self._cache
+        constants.CLIENT_REGISTRY_CHECK_INTERVAL = self._interval
+        client_registry.invalidate()
+        cache.clear()
+
+    def _authenticate(self, client):
+        form = ClientAuthForm({'client_id': client.client_id,
+            'client_secret': client.client_secret})
+        return form.cleaned_data['client'] if form.is_valid() else None
+
+    def test_no_client_query(self):
+        client = self.get_client()
+        with self.assertNumQueries(1):
+            self.assertEqual(client, self._authenticate(client))
+        with self.assertNumQueries(0):
+            self.assertEqual(client, self._authenticate(client))
+            self.assertEqual(client, client_registry.get(client.client_id))
+            self.assertIsNone(client_registry.get('unknown'))
+            self.assertEqual({client.pk: client.client_id},
+                client_registry.get_client_ids([client.pk]))
+
+    def test_invalidated_on_change(self):
+        client = self.get_client()
+        self._authenticate(client)
+        old_secret = client.client_secret
+        client.client_secret = 'new-secret'
+        client.save()
+
+        self.assertEqual(client, self._authenticate(client))
+        client.client_secret = old_secret
+        self.assertIsNone(self._authenticate(client))
+
+    def test_other_processes(self):
+        constants.CLIENT_REGISTRY_CACHE = 'default'
+        constants.CLIENT_REGISTRY_CHECK_INTERVAL = 0
+        other = ClientRegistry()
+        client = self.get_client()
+        self.assertEqual(client.client_secret,
+            other.get(client.client_id).client_secret)
+
+        with self.assertNumQueries(0):
+            other.get(client.client_id)
+
+        client.client_secret = 'new-secret'
+        client.save()
+        self.assertEqual('new-secret',
+            other.get(client.client_id).client_secret)
+
+    def test_disabled_registry(self):
+        constants.CLIENT_REGISTRY = False
+        client = self.get_client()
+        self._authenticate(client)
+        with self.assertNumQueries(1):
+            self.assertEqual(client, self._authenticate(client))
+
+
+@skipIfCustomUser
+class ClientSecretTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._hash = constants.HASH_CLIENT_SECRETS
+        constants.HASH_CLIENT_SECRETS = True
+        verified_secrets.clear()
+
+    def tearDown(self):
+        constants.HASH_CLIENT_SECRETS = self._hash
+        verified_secrets.clear()
+
+    def _authenticate(self, client_id, client_secret):
+        form = ClientAuthForm({'client_id': client_id,
+            'client_secret': client_secret})
+        return form.cleaned_data['client'] if form.is_valid() else None
+
+    def test_hashed_on_save(self):
+        client = self.get_client()
+        secret = client.client_secret
+        client.save()
+
+        self.assertEqual(secret, client.raw_client_secret)
+        self.assertNotEqual(secret, client.client_secret)
+        self.assertEqual(client, self._authenticate(client.client_id, secret))
+        self.assertIsNone(self._authenticate(client.client_id, 'wrong'))
+        self.assertIsNone(self._authenticate(client.client_id,
+            client.client_secret))
+
+    def test_verification_cached(self):
+        client = self.get_client()
+        secret = client.client_secret
+        client.save()
+
+        self.assertTrue(check_client_secret(client, secret))
+        with patch('provider.oauth2.registry.check_password') as check:
+            self.assertTrue(check_client_secret(client, secret))
+            self.assertFalse(check.called)
+
+            check.return_value = False
+            self.assertFalse(check_client_secret(client, 'wrong'))
+            self.assertTrue(check.called)
+
+    def test_verification_cache_disabled(self):
+        client = self.get_client()
+        secret = client.client_secret
+        client.save()
+
+        ttl = constants.CLIENT_SECRET_CACHE_TTL
+        constants.CLIENT_SECRET_CACHE_TTL = 0
+        try:
+            self.assertTrue(check_client_secret(client, secret))
+            self.assertTrue(check_client_secret(client, secret))
+            self.assertEqual(0, verified_secrets.stats()['size'])
+        finally:
+            constants.CLIENT_SECRET_CACHE_TTL = ttl
+
+    def test_plaintext_secret(self):
+        constants.HASH_CLIENT_SECRETS = False
+        client = self.get_client()
+        client.save()
+        self.assertEqual(client, self._authenticate(client.client_id,
+            client.client_secret))
+        self.assertFalse(check_client_secret(client, ''))
+
+    def test_hash_client_secrets_command(self):
+        secrets = dict(Client.objects.values_list('pk', 'client_secret'))
+        call_command('hash_client_secrets', stdout=StringIO())
+
+        for client in Client.objects.all():
+            self.assertNotEqual(secrets[client.pk], client.client_secret)
+            self.assertTrue(check_client_secret(client, secrets[client.pk]))
+
+        stdout = StringIO()
+        call_command('hash_client_secrets', stdout=stdout)
+        self.assertIn('Hashed 0 client secrets', stdout.getvalue())
+
+
+@skipIfCustomUser
+class GrantValidatorTest(BaseOAuth2TestCase):
+    """
+    The token endpoint validators must agree with the grant forms.
+    """
+    fixtures = ['test_oauth2']
+
+    def get_client(self):
+        client = super(GrantValidatorTest, self).get_client()
+        client.scope = constants.READ_WRITE
+        return client
+
+    def assertSameResult(self, form_class, validator_class, data, client,
+            key=None):
+        form = form_class(QueryDict(data), client=client)
+        try:
+            cleaned = validator_class(client).validate(QueryDict(data))
+        except OAuthValidationError as e:
+            self.assertFalse(form.is_valid())
+            self.assertEqual(dict(form.errors), e.args[0])
+            return e.args[0]
+
+        self.assertTrue(form.is_valid(), form.errors)
+        for name in ('scope', key):
+            if name is not None:
+                self.assertEqual(form.cleaned_data[name], cleaned[name])
+        return cleaned
+
+    def test_scope(self):
+        client = self.get_client()
+        for data in ('', 'scope=', 'scope=read', 'scope=read+write',
+                'scope=read&scope=write', 'scope=invalid', 'scope=read++write'):
+            self.assertSameResult(ClientCredentialsGrantForm,
+                ClientCredentialsGrantValidator, data, client)
+
+        client.scope = constants.READ
+        self.assertEqual('invalid_scope', self.assertSameResult(
+            ClientCredentialsGrantForm, ClientCredentialsGrantValidator,
+            'scope=write', client)['error'])
+
+    def test_authorization_code(self):
+        client = self.get_client()
+        grant = Grant.objects.create(user=self.get_user(), client=client,
+            scope=constants.READ)
+        for data in ('', 'code=invalid', 'code=' + grant.code,
+                'code={}&scope=read'.format(grant.code),
+                'code={}&scope=write'.format(grant.code)):
+            self.assertSameResult(AuthorizationCodeGrantForm,
+                AuthorizationCodeGrantValidator, data, client, 'grant')
+
+    def test_refresh_token(self):
+        client = self.get_client()
+        user = self.get_user()
+        at = AccessToken.objects.create(user=user, client=client,
+            scope=constants.READ)
+        rt = RefreshToken.objects.create(user=user, client=client,
+            access_token=at)
+        for data in ('', 'refresh_token=invalid', 'refresh_token=' + rt.token,
+                'refresh_token={}&scope=write'.format(rt.token)):
+            self.assertSameResult(RefreshTokenGrantForm,
+                RefreshTokenGrantValidator, data, client, 'refresh_token')
+
+    def test_password(self):
+        client = self.get_client()
+        for data in ('username=test-user-1&password=test',
+                'username=test-user-1&password=wrong&scope=read'):
+            self.assertSameResult(PasswordGrantForm, PasswordGrantValidator,
+                data, client, 'user')
+
+        # Missing credentials are rejected without trying to authenticate
+        with patch('provider.oauth2.passwords.authenticate') as auth:
+            with self.assertRaises(OAuthValidationError) as cm:
+                PasswordGrantValidator(client).validate(
+                    QueryDict('username=test-user-1'))
+            self.assertFalse(auth.called)
+        self.assertEqual({'error': 'invalid_request'}, cm.exception.args[0])
+
+
+@skipIfCustomUser
+class TokenIssuanceTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def _post_code(self, grant):
+        client = self.get_client()
+        return self.client.post(self.access_token_url(), {
+            'grant_type': 'authorization_code',
+            'client_id': client.client_id,
+            'client_secret': client.client_secret,
+            'code': grant.code})
+
+    def test_response_without_refresh_token_query(self):
+        grant = Grant.objects.create(user=self.get_user(),
+            client=self.get_client())
+        with CaptureQueriesContext(connection) as queries:
+            response = self._post_code(grant)
+
+        self.assertEqual(200, response.status_code, response.content)
+        token = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(token['refresh_token'], RefreshToken.objects.get(
+            access_token__token_hash=hash_token(token['access_token'])).token)
+        self.assertFalse([q for q in queries.captured_queries
+            if 'SELECT' in q['sql'] and
+            RefreshToken._meta.db_table in q['sql']])
+        self.assertFalse(Grant.objects.filter(pk=grant.pk,
+            expires__gt=date_now()).exists())
+
+    def test_failed_issuance_rolled_back(self):
+        grant = Grant.objects.create(user=self.get_user(),
+            client=self.get_client())
+        count = AccessToken.objects.count()
+
+        with patch('provider.oauth2.views.AccessTokenView.create_refresh_token',
+                side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, self._post_code, grant)
+
+        self.assertEqual(count, AccessToken.objects.count())
+        self.assertEqual(200, self._post_code(grant).status_code)
+
+
+@skipIfCustomUser
+class SingleAccessTokenTest(TransactionTestCase):
+    # Concurrent requests run in threads using their own database connections
+    fixtures = ['test_oauth2']
+
+    def get_client(self):
+        return Client.objects.get(id=2)
+
+    def get_user(self):
+        return get_user_model().objects.get(id=1)
+
+    def test_fetch_single_query(self):
+        user, client = self.get_user(), self.get_client()
+        token, created = AccessToken.objects.get_or_create_single(user,
+            client, constants.READ)
+        self.assertTrue(created)
+
+        with self.assertNumQueries(1):
+            self.assertEqual((token, False),
+                AccessToken.objects.get_or_create_single(user, client,
+                    constants.READ))
+
+    def test_expired_token_released(self):
+        user, client = self.get_user(), self.get_client()
+        token, created = AccessToken.objects.get_or_create_single(user,
+            client, constants.READ)
+        AccessToken.objects.filter(pk=token.pk).update(
+            expires=date_now() - datetime.timedelta(days=1))
+
+        new_token, created = AccessToken.objects.get_or_create_single(user,
+            client, constants.READ)
+        self.assertTrue(created)
+        self.assertNotEqual(token, new_token)
+        self.assertTrue(AccessToken.objects.filter(pk=token.pk,
+            single_key=None).exists())
+
+    def test_backfill_migration(self):
+        migration = importlib.import_module(
+            'provider.oauth2.migrations.0006_backfill_single_key')
+        user, client = self.get_user(), self.get_client()
+        tokens = [AccessToken.objects.create(user=user, client=client,
+            scope=constants.READ) for i in range(3)]
+        other = AccessToken.objects.create(user=user, client=client,
+            scope=constants.WRITE)
+
+        from django.apps import apps
+        with patch.object(constants, 'SINGLE_ACCESS_TOKEN', True), \
+                patch.object(migration, 'CHUNK_SIZE', 2):
+            with connection.schema_editor() as schema_editor:
+                migration.backfill_single_keys(apps, schema_editor)
+
+        self.assertEqual((tokens[-1], False),
+            AccessToken.objects.get_or_create_single(user, client,
+                constants.READ))
+        self.assertEqual((other, False),
+            AccessToken.objects.get_or_create_single(user, client,
+                constants.WRITE))
+        self.assertEqual(2, AccessToken.objects.filter(
+            expires__gt=date_now()).count())
+
+    def test_replace_spares_concurrent_tokens(self):
+        user, client = self.get_user(), self.get_client()
+        since = date_now()
+        token, created = AccessToken.objects.get_or_create_single(user,
+            client, constants.READ)
+
+        # Issued by a concurrent request
+        self.assertEqual((token, False),
+            AccessToken.objects.get_or_create_single(user, client,
+                constants.READ, replace=True, since=since))
+        self.assertTrue(AccessToken.objects.filter(pk=token.pk,
+            expires__gt=date_now()).exists())
+
+        # Issued before the request began
+        new_token, created = AccessToken.objects.get_or_create_single(user,
+            client, constants.READ, replace=True)
+        self.assertTrue(created)
+        self.assertFalse(AccessToken.objects.filter(pk=token.pk,
+            expires__gt=date_now()).exists())
+
+    def _grant(self, data):
+        client = self.get_client()
+        data.update(client_id=client.client_id,
+            client_secret=client.client_secret)
+        response = self.client.post(reverse('oauth2:access_token'), data)
+        self.assertEqual(200, response.status_code, response.content)
+        return json.loads(response.content.decode('utf-8'))
+
+    def _login_refresh_login(self):
+        login = {'grant_type': 'password', 'username': 'test-user-1',
+            'password': 'test'}
+        token = self._grant(dict(login))
+        refreshed = self._grant({'grant_type': 'refresh_token',
+            'refresh_token': token['refresh_token']})
+        self.assertEqual(1, AccessToken.objects.filter(
+            expires__gt=date_now()).count())
+        return refreshed, self._grant(dict(login))
+
+    def test_refreshed_token_is_single(self):
+        with patch.object(constants, 'SINGLE_ACCESS_TOKEN', True):
+            refreshed, token = self._login_refresh_login()
+        self.assertEqual(refreshed['access_token'], token['access_token'])
+        self.assertEqual(1, AccessToken.objects.filter(
+            expires__gt=date_now()).count())
+
+    def test_refreshed_token_is_replaced(self):
+        with patch.object(constants, 'SINGLE_ACCESS_TOKEN', True), \
+                patch.object(constants, 'HASH_TOKENS', True):
+            refreshed, token = self._login_refresh_login()
+        self.assertNotEqual(refreshed['access_token'], token['access_token'])
+        self.assertEqual(1, AccessToken.objects.filter(
+            expires__gt=date_now()).count())
+
+    def test_concurrent_requests(self):
+        user, client = self.get_user(), self.get_client()
+        count = AccessToken.objects.count()
+        barrier = threading.Barrier(8)
+        results, errors = [], []
+
+        def get_or_create():
+            # SQLite's shared in-memory test database locks whole tables
+            for attempt in range(50):
+                try:
+                    return AccessToken.objects.get_or_create_single(user,
+                        client, constants.READ)[0]
+                except OperationalError:
+                    if connection.vendor != 'sqlite':
+                        raise
+                    time.sleep(0.01)
+
+        def request():
+            try:
+                barrier.wait()
+                results.append(get_or_create().pk)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=request) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual(count + 1, AccessToken.objects.count())
+
+
+@skipIfCustomUser
+class RefreshFlightTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._grace = constants.REFRESH_GRACE_PERIOD
+        constants.REFRESH_GRACE_PERIOD = 10
+        cache.clear()
+
+    def tearDown(self):
+        constants.REFRESH_GRACE_PERIOD = self._grace
+        cache.clear()
+
+    def _refresh(self, refresh_token, client=None):
+        client = client or self.get_client()
+        response = self.client.post(self.access_token_url(), {
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+            'client_id': client.client_id,
+            'client_secret': client.client_secret})
+        return response.status_code, json.loads(response.content.decode('utf-8'))
+
+    def _issue(self):
+        at = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        return RefreshToken.objects.create(user=at.user, client=at.client,
+            access_token=at).token
+
+    def test_repeated_refresh_gets_same_tokens(self):
+        refresh_token = self._issue()
+        status, first = self._refresh(refresh_token)
+        self.assertEqual(200, status, first)
+
+        client = self.get_client()
+        with self.assertNumQueries(1):
+            status, second = self._refresh(refresh_token, client)
+        self.assertEqual(200, status, second)
+        self.assertEqual(first['access_token'], second['access_token'])
+        self.assertEqual(first['refresh_token'], second['refresh_token'])
+
+        status, third = self._refresh(first['refresh_token'])
+        self.assertEqual(200, status, third)
+        self.assertNotEqual(first['access_token'], third['access_token'])
+
+    def test_disabled(self):
+        constants.REFRESH_GRACE_PERIOD = 0
+        refresh_token = self._issue()
+        self.assertEqual(200, self._refresh(refresh_token)[0])
+        status, error = self._refresh(refresh_token)
+        self.assertEqual({'error': 'invalid_grant'}, error)
+
+    def test_invalid_token_not_shared(self):
+        self.assertEqual({'error': 'invalid_grant'},
+            self._refresh('invalid')[1])
+        self.assertEqual({'error': 'invalid_grant'},
+            self._refresh('invalid')[1])
+
+    def test_follower_waits_for_leader(self):
+        key = refresh_flights.make_key(self.get_client(), 'token')
+        self.assertTrue(refresh_flights.acquire(key))
+        self.assertFalse(refresh_flights.acquire(key))
+
+        data = {'access_token': 'access', 'expires_in': 3600}
+        timer = threading.Timer(0.1, refresh_flights.release, (key, data))
+        timer.start()
+        self.assertEqual(data, refresh_flights.wait(key))
+        timer.join()
+
+        key = refresh_flights.make_key(self.get_client(), 'failed')
+        refresh_flights.acquire(key)
+        threading.Timer(0.1, refresh_flights.release, (key,)).start()
+        self.assertIsNone(refresh_flights.wait(key))
+
+    def test_leader_failed(self):
+        refresh_token = self._issue()
+        key = refresh_flights.make_key(self.get_client(), refresh_token)
+        refresh_flights.acquire(key)
+
+        # Another request took the lease over after the leader failed
+        with patch.object(refresh_flights, 'wait', return_value=None):
+            status, error = self._refresh(refresh_token)
+        self.assertEqual({'error': 'invalid_grant'}, error)
+        self.assertFalse(refresh_flights.acquire(key))
+
+        # The follower takes the lease over itself
+        def wait(key):
+            refresh_flights.release(key)
+        with patch.object(refresh_flights, 'wait', side_effect=wait):
+            status, data = self._refresh(refresh_token)
+        self.assertEqual(200, status, data)
+        self.assertTrue(refresh_flights.acquire(key))
+
+
+@skipIfCustomUser
+class InvalidationTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._delete_expired = constants.DELETE_EXPIRED
+        self._cache_size = constants.TOKEN_CACHE_SIZE
+        self._shared_cache = constants.TOKEN_SHARED_CACHE
+        self._revocation = constants.SIGNED_TOKEN_REVOCATION
+        token_cache.clear()
+        cache.clear()
+
+    def tearDown(self):
+        constants.DELETE_EXPIRED = self._delete_expired
+        constants.TOKEN_CACHE_SIZE = self._cache_size
+        constants.TOKEN_SHARED_CACHE = self._shared_cache
+        constants.SIGNED_TOKEN_REVOCATION = self._revocation
+        token_cache.clear()
+        cache.clear()
+
+    def _create_refresh_tokens(self, count):
+        user, client = self.get_user(), self.get_client()
+        expires = date_now() + datetime.timedelta(days=1)
+        AccessToken.objects.bulk_create([AccessToken(user=user,
+            client=client, expires=expires, token='token-{}'.format(i))
+            for i in range(count)])
+        RefreshToken.objects.bulk_create([RefreshToken(user=user,
+            client=client, access_token=at, token='refresh-{}'.format(at.pk))
+            for at in AccessToken.objects.filter(user=user, client=client)])
+        return RefreshToken.objects.filter(user=user, client=client)
+
+    def _trim(self, limit):
+        AccessTokenView().invalidate_refresh_tokens_over_limit(
+            self.get_user(), 0, self.get_client(), limit)
+
+    def test_over_limit_query_count(self):
+        refresh_tokens = self._create_refresh_tokens(10000)
+        newest = list(refresh_tokens.order_by('-pk').values_list('pk',
+            flat=True)[:5])
+        user, client = self.get_user(), self.get_client()
+
+        with self.assertNumQueries(2):
+            AccessTokenView().invalidate_refresh_tokens_over_limit(user, 0,
+                client, 5)
+        self.assertEqual(newest, list(refresh_tokens.filter(expired=False)
+            .order_by('-pk').values_list('pk', flat=True)))
+
+        with self.assertNumQueries(1):
+            AccessTokenView().invalidate_refresh_tokens_over_limit(user, 0,
+                client, 5)
+
+    def test_over_limit_delete(self):
+        constants.DELETE_EXPIRED = True
+        refresh_tokens = self._create_refresh_tokens(20)
+        self._trim(5)
+        self.assertEqual(5, refresh_tokens.count())
+
+    def test_invalidate_evicts_access_tokens(self):
+        constants.TOKEN_CACHE_SIZE = 10
+        constants.TOKEN_SHARED_CACHE = 'default'
+        constants.SIGNED_TOKEN_REVOCATION = 'cache'
+        at = AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        backend = AccessTokenBackend()
+        self.assertEqual(at, backend.authenticate(access_token=at.token,
+            client=at.client))
+
+        with self.assertNumQueries(2):
+            AccessToken.objects.filter(user=at.user).invalidate()
+        self.assertIsNone(backend.authenticate(access_token=at.token,
+            client=at.client))
+        self.assertTrue(tokens.revocation_list.is_revoked(at.pk))
+
+    def test_invalidate_single_statement(self):
+        view = AccessTokenView()
+        grant = Grant.objects.create(user=self.get_user(),
+            client=self.get_client())
+        refresh_token = self._create_refresh_tokens(1).get()
+        for delete_expired in (False, True):
+            constants.DELETE_EXPIRED = delete_expired
+            with self.assertNumQueries(1):
+                view.invalidate_grant(grant)
+            with self.assertNumQueries(1):
+                view.invalidate_refresh_token(refresh_token)
+        self.assertFalse(Grant.objects.filter(pk=grant.pk).exists())
+        self.assertFalse(RefreshToken.objects.filter(
+            pk=refresh_token.pk).exists())
+
+    def test_invalidate_delete(self):
+        constants.DELETE_EXPIRED = True
+        refresh_tokens = self._create_refresh_tokens(10)
+        user = self.get_user()
+        # Listing the access tokens, then one DELETE each
+        with self.assertNumQueries(3):
+            AccessToken.objects.filter(user=user).invalidate()
+        self.assertFalse(refresh_tokens.exists())
+        self.assertFalse(AccessToken.objects.filter(user=user).exists())
+
+
+@skipIfCustomUser
+class PasswordPoolTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._settings = (constants.PASSWORD_POOL_SIZE,
+            constants.PASSWORD_POOL_QUEUE, constants.PASSWORD_POOL_TIMEOUT)
+        constants.PASSWORD_POOL_SIZE = 1
+        constants.PASSWORD_POOL_QUEUE = 1
+        constants.PASSWORD_POOL_TIMEOUT = 5
+        password_pool.clear()
+
+    def tearDown(self):
+        (constants.PASSWORD_POOL_SIZE, constants.PASSWORD_POOL_QUEUE,
+            constants.PASSWORD_POOL_TIMEOUT) = self._settings
+        password_pool.clear()
+
+    def _password_grant(self):
+        c = self.get_client()
+        c.client_type = constants.CONFIDENTIAL
+        c.save()
+        return self.client.post(self.access_token_url(), {
+            'grant_type': 'password',
+            'client_id': c.client_id,
+            'client_secret': c.client_secret,
+            'username': self.get_user().username,
+            'password': self.get_password(),
+        })
+
+    def test_password_grant(self):
+        response = self._password_grant()
+        self.assertEqual(200, response.status_code, response.content)
+        stats = password_pool.stats()
+        self.assertEqual(1, stats['admitted'])
+        self.assertEqual(0, stats['active'])
+
+    def test_saturated_pool_rejects_at_once(self):
+        constants.PASSWORD_POOL_QUEUE = 0
+        password_pool.acquire()
+        try:
+            start = time.time()
+            response = self._password_grant()
+            self.assertLess(time.time() - start, 1)
+        finally:
+            password_pool.release()
+
+        self.assertEqual(503, response.status_code, response.content)
+        self.assertEqual('temporarily_unavailable',
+            json.loads(response.content.decode('utf-8'))['error'])
+        self.assertEqual(1, password_pool.stats()['rejected'])
+
+    def test_queued_verification_waits_for_a_slot(self):
+        pool = PasswordPool()
+        pool.acquire()
+
+        def verify():
+            pool.acquire()
+            pool.release()
+
+        thread = threading.Thread(target=verify)
+        thread.start()
+        while pool.stats()['waiting'] < 1:
+            time.sleep(0.01)
+
+        # The queue is full
+        with self.assertRaises(OAuthValidationError):
+            pool.acquire()
+
+        time.sleep(0.05)
+        pool.release()
+        thread.join()
+
+        stats = pool.stats()
+        self.assertEqual(2, stats['admitted'])
+        self.assertEqual(1, stats['queued'])
+        self.assertEqual(1, stats['rejected'])
+        self.assertGreaterEqual(stats['max_wait_time'], 0.05)
+        self.assertEqual(0, stats['active'])
+
+    def test_queued_verification_times_out(self):
+        constants.PASSWORD_POOL_TIMEOUT = 0.05
+        pool = PasswordPool()
+        pool.acquire()
+        with self.assertRaises(OAuthValidationError) as cm:
+            pool.acquire()
+        pool.release()
+
+        self.assertEqual('temporarily_unavailable',
+            cm.exception.args[0]['error'])
+        stats = pool.stats()
+        self.assertEqual(1, stats['timeouts'])
+        self.assertEqual(0, stats['waiting'])
+
+    def test_disabled(self):
+        constants.PASSWORD_POOL_SIZE = 0
+        response = self._password_grant()
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(0, password_pool.stats()['admitted'])
+
+
+@skipIfCustomUser
+class RateLimitTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._limits = constants.TOKEN_RATE_LIMITS
+        cache.clear()
+
+    def tearDown(self):
+        constants.TOKEN_RATE_LIMITS = self._limits
+        cache.clear()
+
+    def _set_limits(self, **limits):
+        constants.TOKEN_RATE_LIMITS = {self.get_client().status: limits}
+
+    def _post(self, grant_type, **data):
+        client = self.get_client()
+        data.update(grant_type=grant_type, client_id=client.client_id,
+            client_secret=client.client_secret)
+        return self.client.post(self.access_token_url(), data)
+
+    def test_client_limit(self):
+        self._set_limits(client=(2, 60))
+        for i in range(2):
+            response = self._post('password', username='test-user-1',
+                password='wrong')
+            self.assertNotEqual(429, response.status_code)
+
+        response = self._post('password', username='test-user-1',
+            password='wrong')
+        self.assertEqual(429, response.status_code, response.content)
+        self.assertEqual('temporarily_unavailable',
+            json.loads(response.content.decode('utf-8'))['error'])
+        self.assertTrue(0 < int(response['Retry-After']) <= 60)
+
+        # Each grant type is counted on its own
+        response = self._post('refresh_token', refresh_token='invalid')
+        self.assertNotEqual(429, response.status_code)
+
+    def test_user_limit(self):
+        self._set_limits(user=(1, 60))
+        response = self._post('password', username='test-user-1',
+            password='wrong')
+        self.assertNotEqual(429, response.status_code)
+        response = self._post('password', username='test-user-1',
+            password='wrong')
+        self.assertEqual(429, response.status_code, response.content)
+
+        response = self._post('password', username='test-user-2',
+            password='wrong')
+        self.assertNotEqual(429, response.status_code)
+
+        # Other grant types name no user
+        for i in range(2):
+            response = self._post('refresh_token', refresh_token='invalid')
+            self.assertNotEqual(429, response.status_code)
+
+    def test_unlisted_status_is_not_limited(self):
+        constants.TOKEN_RATE_LIMITS = {
+            self.get_client().status + 1: {'client': (1, 60)}}
+        for i in range(3):
+            response = self._post('refresh_token', refresh_token='invalid')
+            self.assertNotEqual(429, response.status_code)
+
+    def test_sliding_window(self):
+        self._set_limits(client=(10, 60))
+        client = self.get_client()
+        with patch('provider.oauth2.ratelimit.time.time') as clock:
+            clock.return_value = 630
+            for i in range(10):
+                self.assertIsNone(rate_limiter.check(client, 'password'))
+            self.assertEqual(30, rate_limiter.check(client, 'password'))
+
+            # The next window still sees all of the previous one
+            clock.return_value = 660
+            self.assertEqual(1, rate_limiter.check(client, 'password'))
+
+            # A quarter of the previous window has slid out
+            clock.return_value = 675
+            for i in range(3):
+                self.assertIsNone(rate_limiter.check(client, 'password'))
+            self.assertEqual(3, rate_limiter.check(client, 'password'))
+
+
+@skipIfCustomUser
+class ClientCredentialsBatchTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._size = constants.CLIENT_CREDENTIALS_BATCH_SIZE
+        self._capacity = constants.TOKEN_BLOOM_CAPACITY
+        token_filter.clear()
+        c = self.get_client()
+        c.client_type = constants.CONFIDENTIAL
+        c.scope = constants.READ_WRITE
+        c.save()
+
+    def tearDown(self):
+        constants.CLIENT_CREDENTIALS_BATCH_SIZE = self._size
+        constants.TOKEN_BLOOM_CAPACITY = self._capacity
+        token_filter.clear()
+
+    def _batch(self, scopes, client=None):
+        client = client or self.get_client()
+        response = self.client.post(self.access_token_url(), {
+            'grant_type': 'client_credentials_batch',
+            'client_id': client.client_id,
+            'client_secret': client.client_secret,
+            'scope': scopes,
+        })
+        return response.status_code, json.loads(response.content.decode('utf-8'))
+
+    def test_batch(self):
+        client = self.get_client()
+        with CaptureQueriesContext(connection) as queries:
+            status, data = self._batch(['read', 'write', 'read write',
+                'invalid'], client)
+        self.assertEqual(200, status, data)
+
+        table = AccessToken._meta.db_table
+        inserts = [q for q in queries.captured_queries
+            if 'INSERT INTO "{}"'.format(table) in q['sql']]
+        self.assertEqual(1, len(inserts))
+
+        tokens = data['tokens']
+        self.assertEqual(4, len(tokens))
+        self.assertEqual('invalid_request', tokens[3]['error'])
+        for item, value in zip(tokens, (constants.READ, constants.WRITE,
+                constants.READ_WRITE)):
+            self.assertEqual('Bearer', item['token_type'])
+            self.assertNotIn('refresh_token', item)
+            at = AccessToken.objects.get_token(item['access_token'])
+            self.assertEqual(value, at.scope)
+            self.assertEqual(' '.join(scope.names(value)), item['scope'])
+            self.assertIsNone(at.user)
+            self.assertEqual(client, at.client)
+            self.assertEqual(at.get_expire_delta(), item['expires_in'])
+
+    def test_new_tokens_are_added_to_bloom_filter(self):
+        constants.TOKEN_BLOOM_CAPACITY = 1000
+        AccessToken.objects.create(user=self.get_user(),
+            client=self.get_client())
+        token_filter.rebuild()
+        status, data = self._batch(['read', 'write'])
+        self.assertEqual(200, status, data)
+        for item in data['tokens']:
+            digest = hash_token(item['access_token'])
+            self.assertIn(digest, token_filter._state[0])
+            self.assertIsNotNone(cache.get(token_filter.make_key(digest)))
+
+    def test_scope_not_allowed(self):
+        c = self.get_client()
+        c.scope = constants.READ
+        c.save()
+        count = AccessToken.objects.count()
+        status, data = self._batch(['read', 'write'])
+        self.assertEqual(200, status, data)
+        self.assertEqual('read', data['tokens'][0]['scope'])
+        self.assertEqual('invalid_scope', data['tokens'][1]['error'])
+        self.assertEqual(count + 1, AccessToken.objects.count())
+
+    def test_batch_size(self):
+        constants.CLIENT_CREDENTIALS_BATCH_SIZE = 2
+        status, data = self._batch(['read', 'write', 'read'])
+        self.assertEqual(400, status, data)
+        self.assertEqual('invalid_request', data['error'])
+
+        status, data = self._batch([])
+        self.assertEqual(400, status, data)
+        self.assertEqual('invalid_request', data['error'])
+
+    def test_public_client(self):
+        c = self.get_client()
+        c.client_type = constants.PUBLIC
+        c.save()
+        response = self.client.post(self.access_token_url(), {
+            'grant_type': 'client_credentials_batch',
+            'client_id': c.client_id,
+            'scope': 'read',
+        })
+        self.assertEqual('invalid_client',
+            json.loads(response.content.decode('utf-8'))['error'])
+
+
+@skipIfCustomUser
+class TokenResponseTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        self._settings = (constants.SINGLE_ACCESS_TOKEN,
+            constants.TOKEN_FORMAT)
+        self.queries = []
+        c = self.get_client()
+        c.client_type = constants.CONFIDENTIAL
+        c.save()
+
+    def tearDown(self):
+        constants.SINGLE_ACCESS_TOKEN, constants.TOKEN_FORMAT = self._settings
+
+    def _post(self, grant_type, client=None, **data):
+        """
+        Post a token request, recording the queries taken to build the
+        token response.
+        """
+        client = client or self.get_client()
+        data.update(grant_type=grant_type, client_id=client.client_id,
+            client_secret=client.client_secret)
+
+        access_token_response = AccessTokenView.access_token_response
+
+        def record(view, *args, **kwargs):
+            with CaptureQueriesContext(connection) as queries:
+                response = access_token_response(view, *args, **kwargs)
+            self.queries.append(len(queries))
+            return response
+
+        with patch.object(AccessTokenView, 'access_token_response', record):
+            response = self.client.post(self.access_token_url(), data)
+        self.assertEqual(200, response.status_code, response.content)
+        return response
+
+    def _password(self, client=None):
+        return self._post('password', client, username='test-user-1',
+            password=self.get_password())
+
+    def _all_grants(self):
+        data = json.loads(self._password().content.decode('utf-8'))
+        self._post('refresh_token', refresh_token=data['refresh_token'])
+        grant = Grant.objects.create(user=self.get_user(),
+            client=self.get_client())
+        self._post('authorization_code', code=grant.code)
+        self._post('client_credentials')
+
+        c = self.get_client()
+        c.client_type = constants.PUBLIC
+        c.save()
+        self._password(c)
+        self.assertEqual(5, len(self.queries))
+        self.assertEqual([0] * 5, self.queries)
+
+    def test_no_queries(self):
+        self._all_grants()
+
+    def test_no_queries_single_access_token(self):
+        constants.SINGLE_ACCESS_TOKEN = True
+        self._all_grants()
+
+        # Handing out a token again
+        self.queries = []
+        self._password()
+        self._post('client_credentials')
+        self.assertEqual([0, 0], self.queries)
+
+    def test_no_queries_signed_token(self):
+        constants.SINGLE_ACCESS_TOKEN = True
+        constants.TOKEN_FORMAT = 'signed'
+        self._password()
+        self._password()
+        self.assertEqual([0, 0], self.queries)
+
+    def test_response(self):
+        response = self._password()
+        self.assertEqual('no-store', response['Cache-Control'])
+        self.assertEqual('no-cache', response['Pragma'])
+        self.assertEqual('application/json', response['Content-Type'])
+        data = json.loads(response.content.decode('utf-8'))
+        at = AccessToken.objects.get_token(data['access_token'])
+        self.assertEqual(' '.join(scope.names(at.scope)), data['scope'])
+        self.assertEqual(scope.to_string(constants.READ_WRITE),
+            ' '.join(scope.names(constants.READ_WRITE)))
+
+
+class JsonRequestTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def _post(self, data, client=None, secret=True, **extra):
+        client = client or self.get_client()
+        data = dict(data, client_id=client.client_id)
+        if secret:
+            data['client_secret'] = client.client_secret
+        return self.client.post(self.access_token_url(), json.dumps(data),
+            content_type='application/json', **extra)
+
+    def _password(self, **kwargs):
+        return self._post({'grant_type': 'password',
+            'username': 'test-user-1', 'password': self.get_password()},
+            **kwargs)
+
+    def test_password_grant(self):
+        response = self._password(HTTP_ORIGIN='https://example.com')
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual('https://example.com',
+            response['Access-Control-Allow-Origin'])
+        data = json.loads(response.content.decode('utf-8'))
+        at = AccessToken.objects.get_token(data['access_token'])
+        self.assertEqual(self.get_user(), at.user)
+
+        response = self._post({'grant_type': 'refresh_token',
+            'refresh_token': data['refresh_token']})
+        self.assertEqual(200, response.status_code, response.content)
+
+    def test_public_client(self):
+        client = self.get_client()
+        client.client_type = constants.PUBLIC
+        client.save()
+
+        response = self._password(client=client, secret=False)
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertIn('access_token',
+            json.loads(response.content.decode('utf-8')))
+
+        response = self._post({'grant_type': 'client_credentials'}, client,
+            secret=False)
+        self.assertEqual(404, response.status_code)
+
+    def test_errors(self):
+        response = self._post({'grant_type': 'unknown'})
+        self.assertEqual('unsupported_grant_type',
+            json.loads(response.content.decode('utf-8'))['error'])
+        response = self.client.post(self.access_token_url(), '{',
+            content_type='application/json')
+        self.assertEqual('invalid_request',
+            json.loads(response.content.decode('utf-8'))['error'])
+
+    def test_body_parsed_once(self):
+        with patch('provider.utils._json_params',
+                wraps=utils._json_params) as parse:
+            response = self._password()
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(1, parse.call_count)
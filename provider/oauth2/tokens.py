@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Self-contained access tokens.
+
+Besides the default opaque tokens, which can only be validated by looking
+them up in the database, access tokens can be handed out as signed
+envelopes embedding the token id, user id, client id, scope and expiry.
+Their signature and expiry are verified in-process.
+
+``"signed"`` tokens are signed with a shared secret. ``"jwt"`` tokens are
+JSON Web Tokens signed with a private key (see :attr:`provider.oauth2.jws`)
+and can be verified by resource servers holding only the public keys
+published at :func:`provider.oauth2.views.jwks`.
+
+The format is selected with :attr:`provider.constants.TOKEN_FORMAT` and can
+be overridden per client with
+:attr:`provider.constants.CLIENT_TOKEN_FORMATS`.
+
+Since a signed token remains valid until it expires, revoking it requires
+one of the checks selected with
+:attr:`provider.constants.SIGNED_TOKEN_REVOCATION`:
+
+* ``"database"`` - look the token up by primary key.
+* ``"cache"`` - look the token up in a revocation list kept in the shared
+  cache (:attr:`provider.constants.TOKEN_SHARED_CACHE`). Revoked tokens must
+  not be evicted from that cache before they expire.
+* ``None`` - trust signature and expiry only.
+"""
+
+import time
+from datetime import timedelta
+
+from django.core import signing
+from django.db.models.signals import post_delete, post_save
+
+from .. import constants, scope
+from ..compat import get_cache, get_user_model
+from ..utils import now
+from . import jws
+from .cache import TokenRecord
+from .models import AccessToken
+from .signals import access_tokens_invalidated
+
+OPAQUE = 'opaque'
+SIGNED = 'signed'
+JWT = 'jwt'
+
+SALT = 'provider.oauth2.tokens'
+
+
+def get_token_format(client):
+    """
+    Return the format of the access tokens issued to ``client``.
+    """
+    return constants.CLIENT_TOKEN_FORMATS.get(client.client_id,
+        constants.TOKEN_FORMAT)
+
+
+def is_signed(value):
+    """
+    Opaque tokens never contain colons or dots (see
+    :func:`provider.generators.check_characters`), signed tokens are
+    separated by colons and JSON Web Tokens consist of three dot separated
+    parts.
+    """
+    return ':' in value or is_jwt(value)
+
+
+def is_jwt(value):
+    return value.count('.') == 2
+
+
+def encode(access_token):
+    """
+    Return the value handed out to the client for ``access_token``.
+    """
+    token_format = get_token_format(access_token.client)
+    if token_format not in (SIGNED, JWT):
+        return access_token.token
+
+    issued = int(time.time())
+    expires = int(issued + access_token.get_expire_delta())
+    if token_format == JWT:
+        return encode_jwt(access_token, issued, expires)
+    return signing.dumps([access_token.id, access_token.user_id,
+        access_token.client_id, access_token.scope, expires],
+        key=constants.TOKEN_SIGNING_KEY, salt=SALT)
+
+
+def encode_jwt(access_token, issued, expires):
+    """
+    Return ``access_token`` as a JSON Web Token. Besides the registered
+    claims, the token holds the public ``client_id``, the space separated
+    ``scope`` names and the client's primary key in ``cid``.
+    """
+    claims = {
+        'jti': str(access_token.id),
+        'client_id': access_token.client.client_id,
+        'cid': access_token.client_id,
+        'scope': scope.to_string(access_token.scope),
+        'iat': issued,
+        'exp': expires,
+    }
+    if access_token.user_id is not None:
+        claims['sub'] = str(access_token.user_id)
+    return jws.dumps(claims)
+
+
+def decode_jwt(value):
+    claims = jws.loads(value)
+    user_id = claims.get('sub')
+    if user_id is not None:
+        user_id = get_user_model()._meta.pk.to_python(user_id)
+    return (AccessToken._meta.pk.to_python(claims['jti']), user_id,
+        claims['cid'], scope.to_int(*claims['scope'].split()), claims['exp'])
+
+
+def decode(value):
+    """
+    Return the :class:`provider.oauth2.cache.TokenRecord` of a signed token
+    or ``None`` if the signature is invalid or the token expired.
+    """
+    try:
+        if is_jwt(value):
+            id, user_id, client_id, scope, expires = decode_jwt(value)
+        else:
+            id, user_id, client_id, scope, expires = signing.loads(value,
+                key=constants.TOKEN_SIGNING_KEY, salt=SALT)
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        return None
+
+    expires_in = expires - time.time()
+    if expires_in <= 0:
+        return None
+    return TokenRecord(id, user_id, client_id, scope,
+        now() + timedelta(seconds=expires_in))
+
+
+class RevocationList(object):
+    """
+    Ids of revoked access tokens stored in the shared cache.
+    """
+    key_prefix = 'oauth2:revoked'
+
+    @property
+    def cache(self):
+        if not constants.TOKEN_SHARED_CACHE:
+            return None
+        return get_cache(constants.TOKEN_SHARED_CACHE)
+
+    def make_key(self, id):
+        return '{}:{}'.format(self.key_prefix, id)
+
+    def revoke(self, id):
+        self.revoke_many([id])
+
+    def revoke_many(self, ids):
+        cache = self.cache
+        if cache is None or not ids:
+            return
+        # The original expiry may have been overwritten already, so keep the
+        # entries for as long as any token can live
+        lifetime = max(constants.EXPIRE_DELTA, constants.EXPIRE_DELTA_PUBLIC)
+        cache.set_many(dict((self.make_key(id), True) for id in ids),
+            int(lifetime.days * 86400 + lifetime.seconds))
+
+    def is_revoked(self, id):
+        cache = self.cache
+        if cache is None:
+            return False
+        return cache.get(self.make_key(id)) is not None
+
+    def get_revoked(self, ids):
+        """
+        Return the set of revoked ids among ``ids`` in a single round trip.
+        """
+        cache = self.cache
+        if cache is None or not ids:
+            return set()
+        keys = dict((self.make_key(id), id) for id in ids)
+        return set(keys[key] for key in cache.get_many(list(keys)))
+
+
+revocation_list = RevocationList()
+
+
+def resolve(value, loader):
+    """
+    Verify the signed token ``value``. ``loader`` is called with the token id
+    when the token has to be checked against the database and must return the
+    access token or ``None``.
+
+    Returns a :class:`provider.oauth2.cache.TokenRecord`, the result of
+    ``loader`` or ``None`` if the token is not valid.
+    """
+    record = decode(value)
+    if record is None:
+        return None
+
+    if constants.SIGNED_TOKEN_REVOCATION == 'database':
+        return loader(record.id)
+    if constants.SIGNED_TOKEN_REVOCATION == 'cache' and \
+            revocation_list.is_revoked(record.id):
+        return None
+    return record
+
+
+def resolve_many(values, loader):
+    """
+    Batch version of :func:`resolve`. ``loader`` is called once with the ids
+    of the tokens to check against the database and must return a ``dict``
+    mapping the ids of the valid ones to their access token.
+
+    Returns a ``dict`` mapping the valid tokens among ``values`` to their
+    :class:`provider.oauth2.cache.TokenRecord` or loader result.
+    """
+    records = {}
+    for value in values:
+        record = decode(value)
+        if record is not None:
+            records[value] = record
+    if not records:
+        return records
+
+    if constants.SIGNED_TOKEN_REVOCATION == 'database':
+        loaded = loader([record.id for record in records.values()])
+        return dict((value, loaded[record.id])
+            for value, record in records.items() if record.id in loaded)
+    if constants.SIGNED_TOKEN_REVOCATION == 'cache':
+        revoked = revocation_list.get_revoked(
+            [record.id for record in records.values()])
+        return dict((value, record) for value, record in records.items()
+            if record.id not in revoked)
+    return records
+
+
+def revoke_access_token(sender, instance, **kwargs):
+    """
+    Signal handler adding changed or deleted access tokens to the revocation
+    list. Deleting tokens that expired on their own needs no revocation.
+    """
+    if constants.SIGNED_TOKEN_REVOCATION != 'cache' or kwargs.get('created'):
+        return
+    if kwargs.get('signal') is post_delete and instance.expires <= now():
+        return
+    revocation_list.revoke(instance.id)
+
+
+def revoke_invalidated_access_tokens(sender, tokens, **kwargs):
+    """
+    Signal handler adding access tokens invalidated in bulk to the
+    revocation list, skipping those that had expired already.
+    """
+    if constants.SIGNED_TOKEN_REVOCATION != 'cache':
+        return
+    reference = now()
+    revocation_list.revoke_many([id for id, digest, expires in tokens
+        if expires > reference])
+
+
+post_save.connect(revoke_access_token, sender=AccessToken,
+    dispatch_uid='provider.oauth2.tokens.revoke_access_token.save')
+post_delete.connect(revoke_access_token, sender=AccessToken,
+    dispatch_uid='provider.oauth2.tokens.revoke_access_token.delete')
+access_tokens_invalidated.connect(revoke_invalidated_access_tokens,
+    sender=AccessToken,
+    dispatch_uid='provider.oauth2.tokens.revoke_invalidated_access_tokens')
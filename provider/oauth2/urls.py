@@ -31,12 +31,26 @@ that are meant for client (as defined in :rfc:`1`) interaction.
 
     Errors are outlined in :rfc:`5.2`.
 
+.. attribute:: ^access_token/introspect/$
+
+    This is the URL where resource servers check one or more access tokens
+    as defined in :rfc:`7662`. See
+    :class:`provider.oauth2.views.IntrospectTokenView`.
+
+.. attribute:: ^keys/$
+
+    This is the URL where resource servers fetch the JSON Web Key Set
+    (:rfc:`7517`) to verify `"jwt"` access tokens without calling back into
+    the provider. See :attr:`provider.oauth2.jws`.
+
 """
 
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from ..compat.urls import *
-from .views import Authorize, Redirect, Capture, AccessTokenView, revoke_token
+from .views import (
+    Authorize, Redirect, Capture, AccessTokenView, IntrospectTokenView,
+    revoke_token, jwks)
 
 
 urlpatterns = patterns('',
@@ -54,4 +68,10 @@ urlpatterns = patterns('',
         name='access_token'),
     url('^access_token/revoke/?$',
         csrf_exempt(revoke_token)),
+    url(r'^access_token/introspect/?$',
+        csrf_exempt(IntrospectTokenView.as_view()),
+        name='introspect'),
+    url(r'^keys/?$',
+        jwks,
+        name='jwks'),
 )
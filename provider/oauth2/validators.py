@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Validation of token endpoint requests.
+
+The forms in :attr:`provider.oauth2.forms` bind, clean and collect errors for
+every field of every request. The token endpoint answers machines, not
+humans, so the validators here check the grant parameters in a single pass
+against precomputed lookups and stop at the first error. They raise
+:class:`provider.forms.OAuthValidationError` with the same :rfc:`5.2` error
+dicts as the forms, which remain in use for the HTML authorization flow.
+"""
+
+from django.utils.translation import ugettext as _
+
+from .. import constants, scope
+from ..compat import get_user_model
+from ..forms import OAuthValidationError
+from ..utils import hash_token, now
+from .models import Grant, RefreshToken
+from .passwords import password_pool
+
+INVALID_REQUEST = {'error': 'invalid_request'}
+
+
+def get_scope(data, client=None):
+    """
+    Return the scope requested in ``data`` as an integer or ``0`` if none was
+    requested. Every requested scope must be allowed for ``client``.
+    """
+    if 'scope' not in data:
+        return 0
+
+    if hasattr(data, 'getlist'):
+        values = data.getlist('scope')
+    else:
+        values = data['scope']
+        if not isinstance(values, (list, tuple)):
+            values = [values] if values else []
+
+    wanted = 0
+    if values:
+        for name in ' '.join(values).split(' '):
+            value = scope.SCOPE_NAME_DICT.get(name)
+            if value is None:
+                raise OAuthValidationError({
+                    'error': 'invalid_request',
+                    'error_description': _("'{}' is not a valid scope.").format(
+                        name)})
+            wanted |= value
+
+    if client is not None and not scope.check(wanted, client.scope):
+        raise OAuthValidationError({
+            'error': 'invalid_scope',
+            'error_description': _("The requested scope is not allowed "
+                "for this client")
+        })
+    return wanted
+
+
+class GrantValidator(object):
+    """
+    Validate the parameters of a token request for one grant type.
+
+    Each name in :attr:`fields` is checked in order by the matching
+    ``clean_<name>`` method, which receives the raw value and returns the
+    cleaned one. :meth:`clean` then checks the cleaned values together.
+    """
+    #: Names of the validated parameters, in the order they are checked.
+    fields = ('scope',)
+
+    def __init__(self, client=None):
+        self.client = client
+
+    def validate(self, data):
+        """
+        Return the cleaned parameters of ``data``. Raises
+        :class:`provider.forms.OAuthValidationError` on the first error.
+        """
+        cleaned = {}
+        for name in self.fields:
+            if name == 'scope':
+                cleaned['scope'] = get_scope(data, self.client)
+            else:
+                cleaned[name] = getattr(self, 'clean_' + name)(
+                    data.get(name), cleaned)
+        return self.clean(cleaned)
+
+    def clean(self, cleaned):
+        return cleaned
+
+    def require(self, value):
+        if not value:
+            raise OAuthValidationError(INVALID_REQUEST)
+        return value
+
+
+class AuthorizationCodeGrantValidator(GrantValidator):
+    """
+    Check and return an authorization grant as ``grant``.
+    """
+    fields = ('code', 'scope')
+
+    def clean_code(self, code, cleaned):
+        self.require(code)
+        try:
+            cleaned['grant'] = Grant.objects.get(code_hash=hash_token(code),
+                client=self.client, expires__gt=now())
+        except Grant.DoesNotExist:
+            raise OAuthValidationError({'error': 'invalid_grant'})
+        return code
+
+    def clean(self, cleaned):
+        """
+        Make sure that the scope is less or equal to the scope allowed on the
+        grant!
+        """
+        if cleaned['scope'] and not scope.check(cleaned['scope'],
+                cleaned['grant'].scope):
+            raise OAuthValidationError({'error': 'invalid_scope'})
+        return cleaned
+
+
+class RefreshTokenGrantValidator(GrantValidator):
+    """
+    Check and return a refresh token as ``refresh_token``.
+    """
+    fields = ('refresh_token', 'scope')
+
+    def clean_refresh_token(self, token, cleaned):
+        self.require(token)
+        try:
+            refresh_token = RefreshToken.objects.select_related(
+                'access_token', 'user').get(token_hash=hash_token(token),
+                expired=False, client=self.client)
+        except RefreshToken.DoesNotExist:
+            raise OAuthValidationError({'error': 'invalid_grant'})
+
+        # The plaintext may not be stored
+        refresh_token.token = token
+        return refresh_token
+
+    def clean(self, cleaned):
+        """
+        Make sure that the scope is less or equal to the previous scope!
+        """
+        access_token = getattr(cleaned['refresh_token'], 'access_token', None)
+        has_scope = access_token.scope if access_token else 0
+        if cleaned['scope'] and not scope.check(cleaned['scope'], has_scope):
+            raise OAuthValidationError({'error': 'invalid_scope'})
+        return cleaned
+
+
+class PasswordGrantValidator(GrantValidator):
+    """
+    Validate the password of a user on a password grant request and return
+    the user as ``user``.
+    """
+    fields = ('username', 'password', 'scope')
+    error = 'authentication_failed'
+
+    def clean_username(self, username, cleaned):
+        return self.require(username)
+
+    def clean_password(self, password, cleaned):
+        return self.require(password)
+
+    def clean(self, cleaned):
+        user = password_pool.authenticate(username=cleaned['username'],
+            password=cleaned['password'])
+        if user is None:
+            raise OAuthValidationError({'error': self.error})
+        cleaned['user'] = user
+        return cleaned
+
+
+class EmailAndPasswordGrantValidator(PasswordGrantValidator):
+    """
+    :class:`PasswordGrantValidator` identifying the user by ``email``
+    instead of ``username``.
+    """
+    fields = ('email', 'password', 'scope')
+    error = 'invalid_grant'
+
+    def clean_email(self, email, cleaned):
+        self.require(email)
+        User = get_user_model()
+        try:
+            cleaned['username'] = User.objects.get(email=email).username
+        except User.DoesNotExist:
+            raise OAuthValidationError(INVALID_REQUEST)
+        return email
+
+
+class ClientCredentialsGrantValidator(GrantValidator):
+    """
+    Validate a client credentials grant request.
+    """
+
+
+class ClientCredentialsBatchGrantValidator(GrantValidator):
+    """
+    Validate a batch of client credentials grant requests, one per ``scope``
+    value, and return their scopes as ``scopes``. A scope that is invalid or
+    not allowed is returned as the error dict it was rejected with, leaving
+    the others unaffected.
+    """
+
+    def validate(self, data):
+        if hasattr(data, 'getlist'):
+            values = data.getlist('scope')
+        else:
+            values = data.get('scope') or []
+        if not values or len(values) > constants.CLIENT_CREDENTIALS_BATCH_SIZE:
+            raise OAuthValidationError({
+                'error': 'invalid_request',
+                'error_description': _("Between 1 and {} scopes are "
+                    "required.").format(
+                    constants.CLIENT_CREDENTIALS_BATCH_SIZE)})
+
+        scopes = []
+        for value in values:
+            try:
+                scopes.append(get_scope({'scope': value}, self.client))
+            except OAuthValidationError as e:
+                scopes.append(e.args[0])
+        return {'scopes': scopes}
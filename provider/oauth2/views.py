@@ -1,17 +1,31 @@
-from datetime import timedelta
+import json
+import time
+from collections import OrderedDict
+from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
-from .. import constants
+from django.utils.translation import ugettext as _
+from .. import constants, scope
+from . import jws, tokens
+from .cache import resolve_tokens
+from .ratelimit import rate_limiter
+from .refresh import refresh_flights
+from .registry import client_registry
 from ..views import (
-    Capture, Authorize, Redirect, AccessToken as AccessTokenView, OAuthError)
-from ..utils import now
-from .forms import (
-    AuthorizationCodeGrantForm, PasswordGrantForm, EmailAndPasswordGrantForm,
-    RefreshTokenGrantForm, AuthorizationRequestForm, AuthorizationForm,
-    ClientCredentialsGrantForm)
-from .models import Client, RefreshToken, AccessToken
-from .backends import BasicClientBackend, RequestParamsClientBackend, PublicClientBackend, PublicPasswordJsonBackend
+    Capture, Authorize, Redirect, AccessToken as AccessTokenView, OAuthError,
+    OAuthView, Mixin)
+from ..forms import OAuthValidationError
+from ..utils import hash_token, now, request_data
+from .forms import AuthorizationRequestForm, AuthorizationForm
+from .models import Client, Grant, RefreshToken, AccessToken
+from .validators import (
+    AuthorizationCodeGrantValidator, ClientCredentialsBatchGrantValidator,
+    ClientCredentialsGrantValidator, EmailAndPasswordGrantValidator,
+    PasswordGrantValidator, RefreshTokenGrantValidator)
+from .backends import (
+    HTTP_HEADER_ENCODING, ClientBackend, ConfidentialClientBackend)
 from django.http import HttpResponseForbidden, HttpResponse
-from ..utils import now
+from django.utils.cache import patch_cache_control
+from ..compat.http import JsonResponse
 
 
 class Capture(Capture):
@@ -33,10 +47,7 @@ class Authorize(Authorize):
         return AuthorizationForm(data)
 
     def get_client(self, client_id):
-        try:
-            return Client.objects.get(client_id=client_id)
-        except Client.DoesNotExist:
-            return None
+        return client_registry.get(client_id)
 
     def get_redirect_url(self, request):
         return reverse('oauth2:redirect')
@@ -72,67 +83,134 @@ class AccessTokenView(AccessTokenView):
         *or* the :attr:`grant_types` list.
     """
     authentication = (
-        BasicClientBackend,
-        RequestParamsClientBackend,
-        PublicClientBackend,
-        PublicPasswordJsonBackend,
+        ClientBackend,
     )
 
+    def validate(self, validator_class, data, client):
+        """
+        Return the parameters of ``data`` cleaned by ``validator_class`` or
+        raise :class:`provider.views.OAuthError`.
+        """
+        try:
+            return validator_class(client).validate(data)
+        except OAuthValidationError as e:
+            raise OAuthError(e.args[0])
+
     def get_authorization_code_grant(self, request, data, client):
-        form = AuthorizationCodeGrantForm(data, client=client)
-        if not form.is_valid():
-            raise OAuthError(form.errors)
-        return form.cleaned_data.get('grant')
+        return self.validate(AuthorizationCodeGrantValidator, data,
+            client)['grant']
 
     def get_refresh_token_grant(self, request, data, client):
-        form = RefreshTokenGrantForm(data, client=client)
-        if not form.is_valid():
-            raise OAuthError(form.errors)
-        return form.cleaned_data.get('refresh_token')
+        return self.validate(RefreshTokenGrantValidator, data,
+            client)['refresh_token']
 
     def get_password_grant(self, request, data, client):
-        form = PasswordGrantForm(data, client=client)
-        if not form.is_valid():
-            raise OAuthError(form.errors)
-        return form.cleaned_data
+        return self.validate(PasswordGrantValidator, data, client)
 
     def get_client_credentials_grant(self, request, data, client):
-        form = ClientCredentialsGrantForm(data, client=client)
-        if not form.is_valid():
-            raise OAuthError(form.errors)
-        return form.cleaned_data
+        return self.validate(ClientCredentialsGrantValidator, data, client)
+
+    def get_client_credentials_batch_grant(self, request, data, client):
+        return self.validate(ClientCredentialsBatchGrantValidator, data,
+            client)
 
     def get_email_and_password_grant(self, request, data, client):
-        form = EmailAndPasswordGrantForm(data, client=client)
-        if not form.is_valid():
-            raise OAuthError(form.errors)
-        return form.cleaned_data
+        return self.validate(EmailAndPasswordGrantValidator, data, client)
+
+    def throttle(self, request, grant_type, client):
+        """
+        Count the request against the limits of the client, see
+        :attr:`provider.oauth2.ratelimit`.
+        """
+        user = None
+        if grant_type == 'password':
+            user = request_data(request).get('username')
+        elif grant_type == 'email_and_password':
+            user = request_data(request).get('email')
+        return rate_limiter.check(client, grant_type, user)
+
+    def refresh_token(self, request, data, client):
+        """
+        Coalesce concurrent refreshes with the same refresh token, see
+        :attr:`provider.oauth2.refresh`.
+        """
+        value = data.get('refresh_token')
+        if not refresh_flights.enabled or not value:
+            return super(AccessTokenView, self).refresh_token(request, data,
+                client)
+
+        key = refresh_flights.make_key(client, value)
+        result = refresh_flights.get(key)
+        if result is not None:
+            return self.token_response(result)
+        if not refresh_flights.acquire(key):
+            result = refresh_flights.wait(key)
+            if result is not None:
+                return self.token_response(result)
+            # The leader failed, try once to take over its lease
+            if not refresh_flights.acquire(key):
+                raise OAuthError({'error': 'invalid_grant'})
 
-    def get_access_token(self, request, user, scope, client, refreshable=True):
         try:
-            # Attempt to fetch an existing access token.
-            at = AccessToken.objects.get(
-                user=user, client=client, scope=scope, expires__gt=now())
-        except AccessToken.DoesNotExist:
-            # None found... make a new one!
-            at = self.create_access_token(request, user, scope, client)
-            if refreshable:
-                self.create_refresh_token(request, user, scope, at, client)
-        except AccessToken.MultipleObjectsReturned:
-            # Simultaneously created tokens must be destroyeds
-            at = AccessToken.objects.filter(
-                user=user, client=client, scope=scope, expires__gt=now()).latest("pk")
-            AccessToken.objects.filter(user=user, client=client,
-                                       scope=scope, expires__gt=now()).exclude(pk=at.pk).delete()
+            response = super(AccessTokenView, self).refresh_token(request,
+                data, client)
+            if response.status_code == 200:
+                result = json.loads(response.content.decode('utf-8'))
+            return response
+        finally:
+            refresh_flights.release(key, result)
+
+    def post_response(self, request):
+        # Single access tokens issued from now on were issued by concurrent
+        # requests
+        self.started = now()
+        return super(AccessTokenView, self).post_response(request)
+
+    def get_single_access_token(self, user, scope, client, replace=False):
+        """
+        Return ``(access_token, created)`` for the single access token of
+        ``user``, ``client`` and ``scope``, see
+        :meth:`provider.oauth2.managers.AccessTokenManager.get_or_create_single`.
+        """
+        at, created = AccessToken.objects.get_or_create_single(user, client,
+            scope, replace=replace, since=getattr(self, 'started', None))
+        if replace and not created:
+            # A concurrent request just issued the token, it can't be handed
+            # out twice
+            raise OAuthError({
+                'error': 'temporarily_unavailable',
+                'error_description': _("An access token is being issued "
+                    "concurrently, try again.")})
+        return at, created
+
+    def get_access_token(self, request, user, scope, client, refreshable=True):
+        # Existing tokens can't be handed out again without their plaintext,
+        # replace them instead
+        at, created = self.get_single_access_token(user, scope, client,
+            replace=constants.HASH_TOKENS)
+        if created and refreshable:
+            self.create_refresh_token(request, user, scope, at, client)
         return at
 
+    def encode_access_token(self, access_token):
+        return tokens.encode(access_token)
+
     def create_access_token(self, request, user, scope, client):
+        if constants.SINGLE_ACCESS_TOKEN:
+            # Refreshing is the only grant creating tokens in single token
+            # mode, the new token takes the key over from the refreshed one
+            return self.get_single_access_token(user, scope, client,
+                replace=True)[0]
         return AccessToken.objects.create(
             user=user,
             client=client,
             scope=scope
         )
 
+    def create_access_tokens(self, request, user, scopes, client):
+        return AccessToken.objects.create_many([AccessToken(user=user,
+            client=client, scope=scope) for scope in scopes])
+
     def create_refresh_token(self, request, user, scope, access_token, client):
         return RefreshToken.objects.create(
             user=user,
@@ -142,42 +220,125 @@ class AccessTokenView(AccessTokenView):
 
     def update_refresh_token(self, rt, at):
         rt.access_token = at
-        rt.save()
+        rt.save(update_fields=['access_token', 'modified'])
 
     def invalidate_grant(self, grant):
-        if constants.DELETE_EXPIRED:
-            grant.delete()
-        else:
-            grant.expires = now() - timedelta(days=1)
-            grant.save()
+        Grant.objects.filter(pk=grant.pk).invalidate()
 
     def invalidate_refresh_token(self, rt):
-        if constants.DELETE_EXPIRED:
-            rt.delete()
-        else:
-            rt.expired = True
-            rt.save()
+        RefreshToken.objects.filter(pk=rt.pk).invalidate()
 
     def invalidate_refresh_tokens_over_limit(self, user, scope, client, limit):
         if limit > 0:
-            rt_list = RefreshToken.objects.filter(
+            RefreshToken.objects.filter(
                 user=user,
                 client=client,
                 access_token__scope=scope,
-                expired=False).order_by('-pk')[limit:]
-            for rt in rt_list:
-                self.invalidate_refresh_token(rt)
+                expired=False).invalidate_over_limit(limit)
 
     def invalidate_access_token(self, at):
-        if constants.DELETE_EXPIRED:
-            at.delete()
-        else:
-            at.expires = now() - timedelta(days=1)
-            at.save()
+        AccessToken.objects.filter(pk=at.pk).invalidate()
 
 
-# TODO this is a quick fix from rest_framework
-HTTP_HEADER_ENCODING = 'iso-8859-1'
+class IntrospectTokenView(OAuthView, Mixin):
+    """
+    Token introspection as outlined in :rfc:`7662` for resource servers,
+    which authenticate as a confidential client.
+
+    Several ``token`` parameters may be posted at once; they are resolved
+    with a single query (or cache round trip) and answered with a list of
+    results in the same order under ``tokens``. A single token is answered
+    with a plain :rfc:`7662` response.
+    """
+    authentication = (
+        ConfidentialClientBackend,
+    )
+
+    def error_response(self, error, status=400):
+        return JsonResponse(error, status=status)
+
+    def get(self, request):
+        return self.error_response({
+            'error': 'invalid_request',
+            'error_description': _("Only POST requests allowed.")})
+
+    def post(self, request):
+        if self.authenticate(request) is None:
+            return self.error_response({'error': 'invalid_client'},
+                status=401)
+
+        values = request_data(request).getlist('token')
+        if not values:
+            return self.error_response({
+                'error': 'invalid_request',
+                'error_description': _("No 'token' included in the "
+                    "request.")})
+        if len(values) > constants.INTROSPECTION_MAX_TOKENS:
+            return self.error_response({
+                'error': 'invalid_request',
+                'error_description': _("Too many tokens included in the "
+                    "request.")})
+
+        results = self.introspect(values)
+        if len(values) == 1:
+            return JsonResponse(results[0])
+        return JsonResponse({'tokens': results})
+
+    def introspect(self, values):
+        """
+        Return the introspection response for each of ``values``, in order.
+        Repeated values are only looked up once.
+        """
+        unique = list(OrderedDict.fromkeys(values))
+        found = resolve_tokens([v for v in unique if not tokens.is_signed(v)],
+            AccessToken.objects.get_tokens)
+        found.update(tokens.resolve_many(
+            [v for v in unique if tokens.is_signed(v)],
+            lambda ids: dict((at.pk, at) for at in
+                AccessToken.objects.with_user_is_active().filter(
+                    pk__in=ids, expires__gt=now()))))
+
+        client_ids = {}
+        inactive = set()
+        if found:
+            client_ids = client_registry.get_client_ids(
+                token.client_id for token in found.values())
+            inactive = self.get_inactive_users(found.values())
+        return [self.describe(found.get(value), client_ids, inactive)
+            for value in values]
+
+    def get_inactive_users(self, tokens):
+        """
+        Return the ids of the inactive users among those of ``tokens``. Only
+        users of tokens that don't tell, such as signed ones, are queried.
+        """
+        inactive = set()
+        unknown = set()
+        for token in tokens:
+            if token.user_id is None:
+                continue
+            if token.user_is_active is None:
+                unknown.add(token.user_id)
+            elif not token.user_is_active:
+                inactive.add(token.user_id)
+        if unknown:
+            inactive.update(unknown.difference(get_user_model().objects.filter(
+                pk__in=unknown, is_active=True).values_list('pk', flat=True)))
+        return inactive
+
+    def describe(self, token, client_ids, inactive=()):
+        if token is None or token.user_id in inactive:
+            return {'active': False}
+        data = {
+            'active': True,
+            'scope': ' '.join(scope.names(token.scope)),
+            'client_id': client_ids.get(token.client_id),
+            'token_type': constants.TOKEN_TYPE,
+            'exp': int(time.time() + token.get_expire_delta()),
+        }
+        if token.user_id is not None:
+            data['sub'] = str(token.user_id)
+        return data
 
 
 def revoke_token(request):
@@ -186,10 +347,24 @@ def revoke_token(request):
     auth = request.META.get('HTTP_AUTHORIZATION', b'')
     if isinstance(auth, type('')):
         auth = auth.encode(HTTP_HEADER_ENCODING)
-    auth = auth.split(' ')
+    auth = auth.split(b' ')
     if len(auth) != 2:
         return HttpResponseForbidden()
-    access_token = auth[1]
-    token = AccessToken.objects.get(token=access_token, expires__gt=now())
+    access_token = auth[1].decode(HTTP_HEADER_ENCODING)
+    if tokens.is_signed(access_token):
+        record = tokens.decode(access_token)
+        lookup = {'pk': record.id if record else None}
+    else:
+        lookup = {'token_hash': hash_token(access_token)}
+    token = AccessToken.objects.get(expires__gt=now(), **lookup)
     token.delete()
     return HttpResponse()
+
+
+def jwks(request):
+    '''View publishing the public keys "jwt" access tokens are signed with
+    '''
+    response = JsonResponse(jws.jwks())
+    patch_cache_control(response, public=True,
+        max_age=constants.JWKS_MAX_AGE)
+    return response
@@ -81,6 +81,25 @@ def to_names(scope):
 names = to_names
 
 
+_strings = {}
+
+
+def to_string(scope):
+    """
+    Returns the space separated scope names of a given scope integer, as
+    sent in token responses. The names of each scope value are only looked
+    up once.
+
+        >>> scope.to_string(provider.constants.READ)
+        'read'
+
+    """
+    try:
+        return _strings[scope]
+    except KeyError:
+        return _strings.setdefault(scope, ' '.join(to_names(scope)))
+
+
 def to_int(*names, **kwargs):
     """
     Turns a list of scope names into an integer value.
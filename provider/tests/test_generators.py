@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import string
+from collections import Counter
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from mock import patch
+
+from .. import constants, generators, utils
+
+
+class ReversedGenerator(generators.RandomTokenGenerator):
+    def generate(self, length):
+        return super(ReversedGenerator, self).generate(length)[::-1]
+
+
+class GeneratorsTestCase(TestCase):
+    def setUp(self):
+        self._settings = (constants.TOKEN_GENERATOR, constants.TOKEN_ALPHABET,
+            constants.TOKEN_LENGTH, constants.TOKEN_PREFIXES)
+
+    def tearDown(self):
+        (constants.TOKEN_GENERATOR, constants.TOKEN_ALPHABET,
+            constants.TOKEN_LENGTH, constants.TOKEN_PREFIXES) = self._settings
+
+    def test_generate(self):
+        generator = generators.RandomTokenGenerator(string.hexdigits[:16])
+        tokens = set(generator.generate(40) for i in range(10000))
+        self.assertEqual(10000, len(tokens))
+        for token in tokens:
+            self.assertEqual(40, len(token))
+            self.assertTrue(set(token) <= set(string.hexdigits[:16]))
+
+        # Longer than the buffer
+        self.assertEqual(10000, len(generator.generate(10000)))
+
+    def test_no_bias(self):
+        # 256 isn't a multiple of 3, so byte 255 has to be dropped
+        generator = generators.RandomTokenGenerator('abc')
+        self.assertEqual(b'\xff', generator._deleted)
+        counts = Counter(generator.generate(30000))
+        self.assertEqual(set('abc'), set(counts))
+        for count in counts.values():
+            self.assertTrue(9000 < count < 11000, counts)
+
+    def test_invalid_alphabet(self):
+        for alphabet in ('', 'a', 'aab', u'ab\xe9', string.printable * 2):
+            self.assertRaises(ValueError, generators.RandomTokenGenerator,
+                alphabet)
+
+    def test_buffer_is_refilled_after_fork(self):
+        generator = generators.RandomTokenGenerator(string.ascii_letters)
+        generator.generate(10)
+        with patch('provider.generators.os.urandom',
+                wraps=os.urandom) as urandom:
+            generator.generate(10)
+            self.assertFalse(urandom.called)
+            with patch('provider.generators.os.getpid',
+                    return_value=os.getpid() + 1):
+                generator.generate(10)
+            self.assertTrue(urandom.called)
+
+    def test_settings(self):
+        constants.TOKEN_ALPHABET = string.ascii_letters + string.digits
+        constants.TOKEN_LENGTH = 32
+        constants.TOKEN_PREFIXES = {'access_token': 'at_'}
+
+        token = generators.generate_access_token()
+        self.assertEqual(35, len(token))
+        self.assertTrue(token.startswith('at_'))
+        self.assertEqual(32, len(generators.generate_refresh_token()))
+        self.assertEqual(32, len(utils.long_token()))
+        self.assertEqual(constants.CLIENT_ID_LENGTH,
+            len(generators.generate_client_id()))
+
+        constants.TOKEN_GENERATOR = \
+            'provider.tests.test_generators.ReversedGenerator'
+        self.assertIsInstance(generators.get_generator(), ReversedGenerator)
+
+    def test_reserved_characters(self):
+        # Colons and dots would make values look like signed access tokens
+        constants.TOKEN_ALPHABET = string.hexdigits[:16] + '.'
+        self.assertRaises(ImproperlyConfigured,
+            generators.generate_access_token)
+
+        constants.TOKEN_ALPHABET = string.hexdigits[:16]
+        constants.TOKEN_PREFIXES = {'access_token': 'at:'}
+        self.assertRaises(ImproperlyConfigured,
+            generators.generate_access_token)
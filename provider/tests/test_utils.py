@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 
 
+import json
 from datetime import datetime, time, date
 
 from django.db import models
 from django.test import TestCase
+from django.test.client import RequestFactory
 
 from .. import utils
 
@@ -34,3 +36,27 @@ class UtilsTestCase(TestCase):
             #   datetime.time(10, 6, 28, 705000)
             self.assertEqual(int(t1.microsecond/1000),
                              int(t2.microsecond/1000))
+
+    def test_request_data(self):
+        factory = RequestFactory()
+        request = factory.post('/', {'grant_type': 'password',
+            'token': ['a', 'b']})
+        data = utils.request_data(request)
+        self.assertIs(data, request.POST)
+        self.assertIs(data, utils.request_data(request))
+
+        request = factory.post('/', json.dumps({'grant_type': 'password',
+            'token': ['a', 'b'], 'scope': None, 'remember': True, 'n': 1}),
+            content_type='application/json')
+        data = utils.request_data(request)
+        self.assertEqual('password', data['grant_type'])
+        self.assertEqual(['a', 'b'], data.getlist('token'))
+        self.assertNotIn('scope', data)
+        self.assertEqual(('true', '1'), (data['remember'], data['n']))
+        self.assertRaises(AttributeError, data.__setitem__, 'n', '2')
+        self.assertIs(data, utils.request_data(request))
+
+        for body in ('[1]', '{', ''):
+            request = factory.post('/', body,
+                content_type='application/json')
+            self.assertEqual({}, dict(utils.request_data(request)))
@@ -2,15 +2,17 @@
 
 
 import hashlib
-import shortuuid
 import json
 
-from django.conf import settings
+from django.contrib.auth.hashers import identify_hasher, make_password
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models.fields import (
     DateTimeField, DateField, TimeField, FieldDoesNotExist)
+from django.http import QueryDict
 from django.utils import dateparse, timezone
+from . import constants
 from .constants import EXPIRE_DELTA, EXPIRE_DELTA_PUBLIC, EXPIRE_CODE_DELTA
+from .generators import get_generator
 
 
 try:
@@ -24,20 +26,46 @@ def now():
 
 def short_token():
     """
-    Generate a hash that can be used as an application identifier
+    Generate a random string that can be used as an application identifier,
+    see :attr:`provider.generators`.
     """
-    hash = hashlib.sha1(shortuuid.uuid().encode('utf-8'))
-    hash.update(settings.SECRET_KEY.encode('utf-8'))
-    return hash.hexdigest()[::2]
+    return get_generator().generate(constants.CLIENT_ID_LENGTH)
 
 
 def long_token():
     """
-    Generate a hash that can be used as an application secret
+    Generate a random string that can be used as an application secret,
+    see :attr:`provider.generators`.
     """
-    hash = hashlib.sha1(shortuuid.uuid().encode('utf-8'))
-    hash.update(settings.SECRET_KEY.encode('utf-8'))
-    return hash.hexdigest()
+    return get_generator().generate(constants.TOKEN_LENGTH)
+
+
+def hash_token(token):
+    """
+    Return the fixed width digest tokens and codes are stored and looked up
+    by. Tokens are random, so an unsalted digest is enough to keep them from
+    being usable if the database leaks.
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def hash_secret(secret):
+    """
+    Return ``secret`` hashed with the slow salted hasher configured in
+    ``PASSWORD_HASHERS``.
+    """
+    return make_password(secret)
+
+
+def is_hashed_secret(value):
+    """
+    Return whether ``value`` was returned by :func:`hash_secret`.
+    """
+    try:
+        identify_hasher(value)
+    except ValueError:
+        return False
+    return True
 
 
 def get_token_expiry(public=True):
@@ -62,6 +90,55 @@ def get_code_expiry():
     return now() + EXPIRE_CODE_DELTA
 
 
+# Content types the request body is decoded from by django itself
+FORM_CONTENT_TYPES = ('multipart/', 'application/x-www-form-urlencoded')
+
+
+def _json_params(body, encoding=None):
+    """
+    Return the JSON object in ``body`` as an immutable
+    :class:`django.http.QueryDict` or ``None`` if it is not one. Arrays become
+    lists of values, ``null`` values are left out and other values become
+    their JSON representation, except for strings.
+    """
+    try:
+        if isinstance(body, bytes):
+            body = body.decode(encoding or 'utf-8')
+        value = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(value, dict):
+        return None
+
+    params = QueryDict('', mutable=True, encoding=encoding)
+    for key, item in value.items():
+        items = item if isinstance(item, list) else [item]
+        values = [i if isinstance(i, str) else json.dumps(i)
+            for i in items if i is not None]
+        if values:
+            params.setlist(key, values)
+    params._mutable = False
+    return params
+
+
+def request_data(request):
+    """
+    Return the parameters posted in the body of ``request``, form encoded or
+    as a JSON object, as an immutable :class:`django.http.QueryDict`.
+
+    The body is decoded once per request, the result is shared by
+    authentication backends, grant handlers and views.
+    """
+    data = getattr(request, '_oauth_data', None)
+    if data is None:
+        content_type = request.META.get('CONTENT_TYPE', '')
+        if not content_type.startswith(FORM_CONTENT_TYPES) and request.body:
+            data = _json_params(request.body, request.encoding)
+        data = data or request.POST
+        request._oauth_data = data
+    return data
+
+
 def serialize_instance(instance):
     """
     Since Django 1.6 items added to the session are no longer pickled,
@@ -5,6 +5,7 @@ import urllib.parse
 import logging
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.http import HttpResponse, QueryDict
 from django.utils.timezone import now
 from django.utils.translation import ugettext as _
@@ -14,12 +15,20 @@ from oauth2.models import Client, ClientStatus
 from . import constants, scope
 from provider.compat.http import JsonResponse
 from provider.oauth2.models import AccessToken as AccessTokenModel
+from .utils import request_data
 
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
 
+# Tells access_token_data to look the refresh token up itself
+_UNKNOWN = object()
+
+# Token responses only hold strings and numbers, so one plain encoder serves
+# all of them
+TOKEN_RESPONSE_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
 
 class OAuthError(Exception):
     """
@@ -420,6 +429,7 @@ class AccessToken(OAuthView, Mixin):
     * :attr:`get_access_token`
     * :attr:`create_access_token`
     * :attr:`create_refresh_token`
+    * :attr:`update_refresh_token`
     * :attr:`invalidate_grant`
     * :attr:`invalidate_access_token`
     * :attr:`invalidate_refresh_token`
@@ -443,7 +453,8 @@ class AccessToken(OAuthView, Mixin):
     """
 
     grant_types = ['authorization_code', 'refresh_token', 'password',
-                   'email_and_password', 'client_credentials']
+                   'email_and_password', 'client_credentials',
+                   'client_credentials_batch']
     """
     The default grant types supported by this view.
     """
@@ -479,6 +490,15 @@ class AccessToken(OAuthView, Mixin):
         """
         raise NotImplementedError
 
+    def get_client_credentials_batch_grant(self, request, data, client):
+        """
+        Return the scopes requested by a batch of client credentials grants
+        as ``scopes``. A rejected scope is given as its error dict.
+
+        :return: ``dict`` - ``{'scopes': [scope or error_dict, ...]}``
+        """
+        raise NotImplementedError
+
     def get_access_token(self, request, user, scope, client):
         """
         Override to handle fetching of an existing access token.
@@ -495,6 +515,16 @@ class AccessToken(OAuthView, Mixin):
         """
         raise NotImplementedError
 
+    def create_access_tokens(self, request, user, scopes, client):
+        """
+        Override to create one access token per scope of ``scopes`` at
+        once. Defaults to calling :meth:`create_access_token` for each.
+
+        :return: ``list`` - Access tokens in the order of ``scopes``
+        """
+        return [self.create_access_token(request, user, scope, client)
+            for scope in scopes]
+
     def create_refresh_token(self, request, user, scope, access_token, client):
         """
         Override to handle refresh token creation.
@@ -503,6 +533,21 @@ class AccessToken(OAuthView, Mixin):
         """
         raise NotImplementedError
 
+    def issue_tokens(self, request, user, scope, client, refreshable=True):
+        """
+        Create an access token and, if ``refreshable``, a refresh token bound
+        to it. Handlers call this inside the transaction that also
+        invalidates the grant or refresh token they were given, so a failure
+        leaves no half issued pair behind.
+
+        :return: ``tuple`` - ``(access_token, refresh_token or None)``
+        """
+        at = self.create_access_token(request, user, scope, client)
+        rt = None
+        if refreshable:
+            rt = self.create_refresh_token(request, user, scope, at, client)
+        return at, rt
+
     def update_refresh_token(self, refresh_token, access_token):
         """
         Override to handle refresh token updating. Bind the access token to
@@ -549,6 +594,15 @@ class AccessToken(OAuthView, Mixin):
         """
         raise NotImplementedError
 
+    def throttle(self, request, grant_type, client):
+        """
+        Override to limit the rate of token requests.
+
+        :return: ``int`` - Number of seconds the client has to wait before
+            trying again, or ``None`` if the request may proceed
+        """
+        return None
+
     def error_response(self, error, content_type='application/json', status=400,
             **kwargs):
         """
@@ -557,48 +611,85 @@ class AccessToken(OAuthView, Mixin):
         """
         return JsonResponse(error, status=status, **kwargs)
 
-    def access_token_response(self, access_token):
+    def encode_access_token(self, access_token):
         """
-        Returns a successful response after creating the access token
-        as defined in :rfc:`5.1`.
+        Override to change the representation of the access token handed out
+        to the client.
+
+        :return: ``str`` - The access token value
+        """
+        return access_token.token
+
+    def access_token_data(self, access_token, refresh_token=_UNKNOWN):
+        """
+        Returns the parameters of a successful response after creating the
+        access token as defined in :rfc:`5.1`.
+
+        Pass the ``refresh_token`` issued with ``access_token``, or ``None``
+        if there is none, to save looking it up. The built-in handlers pass
+        it or have it cached on ``access_token``, so building the response
+        takes no query.
         """
 
         response_data = {
-            'access_token': access_token.token,
+            'access_token': self.encode_access_token(access_token),
             'token_type': constants.TOKEN_TYPE,
             'expires_in': access_token.get_expire_delta(),
-            'scope': ' '.join(scope.names(access_token.scope)),
+            'scope': scope.to_string(access_token.scope),
         }
 
         # Not all access_tokens are given a refresh_token
         # (for example, public clients doing password auth)
-        try:
-            rt = access_token.refresh_token
-            response_data['refresh_token'] = rt.token
-        except ObjectDoesNotExist:
-            pass
+        if refresh_token is _UNKNOWN:
+            try:
+                refresh_token = access_token.refresh_token
+            except ObjectDoesNotExist:
+                refresh_token = None
+        if refresh_token is not None:
+            response_data['refresh_token'] = refresh_token.token
+
+        return response_data
+
+    def token_response(self, data):
+        """
+        Returns a successful response holding ``data``, which must only
+        contain strings, numbers, lists and dicts. Token responses must not
+        be cached as per :rfc:`5.1`.
+        """
+        response = HttpResponse(TOKEN_RESPONSE_ENCODER.encode(data),
+            content_type='application/json')
+        response['Cache-Control'] = 'no-store'
+        response['Pragma'] = 'no-cache'
+        return response
 
-        return JsonResponse(response_data)
+    def access_token_response(self, access_token, refresh_token=_UNKNOWN):
+        """
+        Returns a successful response after creating the access token
+        as defined in :rfc:`5.1`, see :meth:`access_token_data`.
+        """
+        return self.token_response(self.access_token_data(access_token,
+            refresh_token))
 
     def authorization_code(self, request, data, client):
         """
         Handle ``grant_type=authorization_code`` requests as defined in
         :rfc:`4.1.3`.
         """
-        grant = self.get_authorization_code_grant(request, request.POST,
-                client)
-        if constants.SINGLE_ACCESS_TOKEN:
-            at = self.get_access_token(request, grant.user, grant.scope, client)
-        else:
-            at = self.create_access_token(request, grant.user, grant.scope, client)
-            rt = self.create_refresh_token(request, grant.user, grant.scope, at, client)
-            if constants.LIMIT_NUM_REFRESH_TOKEN > 0:
-                self.invalidate_refresh_tokens_over_limit(
-                    grant.user, grant.scope, client, constants.LIMIT_NUM_REFRESH_TOKEN)
+        grant = self.get_authorization_code_grant(request, data, client)
+        rt = _UNKNOWN
+        with transaction.atomic():
+            if constants.SINGLE_ACCESS_TOKEN:
+                at = self.get_access_token(request, grant.user, grant.scope, client)
+            else:
+                at, rt = self.issue_tokens(request, grant.user, grant.scope,
+                    client)
+                if constants.LIMIT_NUM_REFRESH_TOKEN > 0:
+                    self.invalidate_refresh_tokens_over_limit(
+                        grant.user, grant.scope, client, constants.LIMIT_NUM_REFRESH_TOKEN)
 
-        self.invalidate_grant(grant)
+            self.invalidate_grant(grant)
 
-        return self.access_token_response(at)
+        return self.access_token_response(at, rt)
 
     def refresh_token(self, request, data, client):
         """
@@ -606,19 +697,25 @@ class AccessToken(OAuthView, Mixin):
         """
         rt = self.get_refresh_token_grant(request, data, client)
 
-        # this must be called first in case we need to purge expired tokens
-        if not constants.KEEP_REFRESH_TOKEN:
-            self.invalidate_refresh_token(rt)
-        self.invalidate_access_token(rt.access_token)
-
-        at = self.create_access_token(request, rt.user, rt.access_token.scope,
-                client)
-        if not constants.KEEP_REFRESH_TOKEN:
-            rt = self.create_refresh_token(request, at.user, at.scope, at, client)
-        else:
-            self.update_refresh_token(rt, at)
-
-        return self.access_token_response(at)
+        with transaction.atomic():
+            if not constants.KEEP_REFRESH_TOKEN:
+                # this must be called first in case we need to purge expired
+                # tokens
+                self.invalidate_refresh_token(rt)
+                self.invalidate_access_token(rt.access_token)
+                at, rt = self.issue_tokens(request, rt.user,
+                    rt.access_token.scope, client)
+            else:
+                # Bind the kept refresh token to the new access token before
+                # the old one is invalidated, deleting it would delete the
+                # refresh token too
+                old_at = rt.access_token
+                at = self.issue_tokens(request, rt.user, old_at.scope, client,
+                    refreshable=False)[0]
+                self.update_refresh_token(rt, at)
+                self.invalidate_access_token(old_at)
+
+        return self.access_token_response(at, rt)
 
     def password(self, request, data, client):
         """
@@ -633,22 +730,25 @@ class AccessToken(OAuthView, Mixin):
                 status = 401
             elif e.args[0]['error'] == 'invalid_scope':
                 status = 403
+            elif e.args[0]['error'] == 'temporarily_unavailable':
+                status = 503
             return self.error_response(e.args[0], status=status)
         user = data.get('user')
         scope = data.get('scope')
 
-        if constants.SINGLE_ACCESS_TOKEN:
-            at = self.get_access_token(request, user, scope, client)
-        else:
-            at = self.create_access_token(request, user, scope, client)
-            # Public clients don't get refresh tokens
-            if client.client_type == constants.CONFIDENTIAL:
-                rt = self.create_refresh_token(request, user, scope, at, client)
-                if constants.LIMIT_NUM_REFRESH_TOKEN > 0:
+        rt = _UNKNOWN
+        with transaction.atomic():
+            if constants.SINGLE_ACCESS_TOKEN:
+                at = self.get_access_token(request, user, scope, client)
+            else:
+                # Public clients don't get refresh tokens
+                at, rt = self.issue_tokens(request, user, scope, client,
+                    client.client_type == constants.CONFIDENTIAL)
+                if rt is not None and constants.LIMIT_NUM_REFRESH_TOKEN > 0:
                     self.invalidate_refresh_tokens_over_limit(
                         user, scope, client, constants.LIMIT_NUM_REFRESH_TOKEN)
 
-        return self.access_token_response(at)
+        return self.access_token_response(at, rt)
 
     def email_and_password(self, request, data, client):
         """
@@ -659,15 +759,16 @@ class AccessToken(OAuthView, Mixin):
         user = data.get('user')
         scope = data.get('scope')
 
-        if constants.SINGLE_ACCESS_TOKEN:
-            at = self.get_access_token(request, user, scope, client)
-        else:
-            at = self.create_access_token(request, user, scope, client)
-            # Public clients don't get refresh tokens
-            if client.client_type == constants.CONFIDENTIAL:
-                rt = self.create_refresh_token(request, user, scope, at, client)
+        rt = _UNKNOWN
+        with transaction.atomic():
+            if constants.SINGLE_ACCESS_TOKEN:
+                at = self.get_access_token(request, user, scope, client)
+            else:
+                # Public clients don't get refresh tokens
+                at, rt = self.issue_tokens(request, user, scope, client,
+                    client.client_type == constants.CONFIDENTIAL)
 
-        return self.access_token_response(at)
+        return self.access_token_response(at, rt)
 
     def client_credentials(self, request, data, client):
         """
@@ -680,12 +781,38 @@ class AccessToken(OAuthView, Mixin):
         # Client credentials should operate on public data and the
         # client only -- exposing the user has the potential to compromise
         # other assets associated with the user but not necessarily the client
+        rt = None
         if constants.SINGLE_ACCESS_TOKEN:
-            at = self.get_access_token(request, None, scope, client, refreshable=False)
+            with transaction.atomic():
+                at = self.get_access_token(request, None, scope, client, refreshable=False)
         else:
-            at = self.create_access_token(request, None, scope, client)
+            at, rt = self.issue_tokens(request, None, scope, client,
+                refreshable=False)
+
+        return self.access_token_response(at, rt)
+
+    def client_credentials_batch(self, request, data, client):
+        """
+        Handle ``grant_type=client_credentials_batch`` requests, which issue
+        one client credentials access token per ``scope`` value in a single
+        call. Item *i* of ``tokens`` in the response holds the token issued
+        for the *i*-th scope or the error it was rejected with.
+        """
+        scopes = self.get_client_credentials_batch_grant(request, data,
+            client)['scopes']
+        valid = [s for s in scopes if not isinstance(s, dict)]
 
-        return self.access_token_response(at)
+        with transaction.atomic():
+            if constants.SINGLE_ACCESS_TOKEN:
+                tokens = [self.get_access_token(request, None, s, client,
+                    refreshable=False) for s in valid]
+            else:
+                tokens = self.create_access_tokens(request, None, valid,
+                    client)
+
+        tokens = iter(tokens)
+        return self.token_response({'tokens': [s if isinstance(s, dict) else
+            self.access_token_data(next(tokens), None) for s in scopes]})
 
     def get_handler(self, grant_type):
         """
@@ -703,6 +830,8 @@ class AccessToken(OAuthView, Mixin):
             return self.email_and_password
         elif grant_type == 'client_credentials':
             return self.client_credentials
+        elif grant_type == 'client_credentials_batch':
+            return self.client_credentials_batch
         return None
 
     def get(self, request):
@@ -723,13 +852,15 @@ class AccessToken(OAuthView, Mixin):
                 'error': 'invalid_request',
                 'error_description': _("A secure connection is required.")})
 
-        if not 'grant_type' in request.POST:
+        data = request_data(request)
+
+        if not 'grant_type' in data:
             return self.error_response({
                 'error': 'invalid_request',
                 'error_description': _("No 'grant_type' included in the "
                     "request.")})
 
-        grant_type = request.POST['grant_type']
+        grant_type = data['grant_type']
 
         if grant_type not in self.grant_types:
             return self.error_response({'error': 'unsupported_grant_type'})
@@ -739,17 +870,30 @@ class AccessToken(OAuthView, Mixin):
         if client is None:
             return self.error_response({'error': 'invalid_client'}, status=404)
 
+        retry_after = self.throttle(request, grant_type, client)
+
+        if retry_after is not None:
+            response = self.error_response({
+                'error': 'temporarily_unavailable',
+                'error_description': _("Too many requests, try again "
+                    "later.")}, status=429)
+            response['Retry-After'] = str(retry_after)
+            return response
+
         handler = self.get_handler(grant_type)
 
         try:
-            return handler(request, request.POST, client)
+            return handler(request, data, client)
         except OAuthError as e:
-            return self.error_response(e.args[0])
+            error = e.args[0]
+            if error.get('error') == 'temporarily_unavailable':
+                return self.error_response(error, status=503)
+            return self.error_response(error)
 
     def post(self, request):
         response = self.post_response(request)
 
-        grant_type = request.POST.get('grant_type', None)
+        grant_type = request_data(request).get('grant_type', None)
 
         if grant_type == 'password':
             return self.add_allow_cors_header_to_response(request, response)
@@ -21,9 +21,11 @@ setup(
         'Framework :: Django',
     ],
     install_requires=[
-        "shortuuid>=0.4",
         "pillow>=2.0.0"
     ],
+    extras_require={
+        "jwt": ["cryptography"],
+    },
     test_requires=[
         "mock>=1.0.1",
     ],